@@ -19,10 +19,10 @@
 #
 import os
 from pathlib import Path
-import shutil
+import sys
+sys.path.insert(0, os.path.abspath('.'))
 
-# import sys
-# sys.path.insert(0, os.path.abspath('.'))
+from notebook_sync import copy_if_changed, sync_notebooks
 
 
 # -- General configuration ------------------------------------------------
@@ -118,7 +118,8 @@ language = 'en'
 # List of patterns, relative to source directory, that match files and
 # directories to ignore when looking for source files.
 # This patterns also effect to html_static_path and html_extra_path
-exclude_patterns = ['_build', 'pleasant-example.rst',  "Thumbs.db", ".DS_Store", "**.ipynb_checkpoints"]
+exclude_patterns = ['_build', 'pleasant-example.rst',  "Thumbs.db", ".DS_Store", "**.ipynb_checkpoints",
+                    ".notebook_cache"]
 
 # The name of the Pygments (syntax highlighting) style to use.
 pygments_style = 'sphinx'
@@ -250,9 +251,9 @@ tls_verify = False
 #   }
 #}
 # copy notebooks to docs folder
+# (only new or changed files are copied, so that Sphinx only rebuilds
+# the pages for those notebooks; see notebook_sync.py)
 dest_path = Path('notebooks')
-shutil.rmtree(dest_path, ignore_errors=True)
-dest_path.mkdir()
 source_path = Path('../../notebooks')
 copy_notebooks = [
     source_path / 'part0_python_intro/00_python_basics_review.ipynb',
@@ -296,24 +297,24 @@ copy_notebooks = [
     # "bonus" notebooks
     source_path / 'part0_python_intro/bonus_examples/Geopandas_ABQ.ipynb'
 ]
-# copy the notebooks
-for f in copy_notebooks:
-    dest_f = dest_path / f.relative_to(source_path)
-    dest_f.parent.mkdir(exist_ok=True, parents=True)
-    if f.is_dir():
-        shutil.copytree(f, dest_f, dirs_exist_ok=True)
-    else:
-        shutil.copy(f, dest_f)
-    print(f"copied {f} to {dest_f}")
-    
-shutil.copy('../../more_resources/glossary_of_jargon.md', '.')
-shutil.copy('../../SOME_HELPFUL_LINKS.md', '.')
+copy_if_changed('../../more_resources/glossary_of_jargon.md', 'glossary_of_jargon.md')
+copy_if_changed('../../SOME_HELPFUL_LINKS.md', 'SOME_HELPFUL_LINKS.md')
 
 #nbsphinx settings
 nbsphinx_allow_errors = True
 # disable automatic notebook execution (nbs are built in CI for now)
 # nbsphinx_execute = "never"
 
+# copy the notebooks; notebooks without outputs are executed here
+# (in parallel), and the executed notebooks are cached by their content
+# in .notebook_cache, so that only new or changed notebooks are executed
+# (set DOCS_NOTEBOOK_CACHE=0 to leave the execution to nbsphinx)
+use_cache = os.environ.get('DOCS_NOTEBOOK_CACHE', '1') != '0'
+sync_notebooks(copy_notebooks, source_path, dest_path,
+               cache_dir=Path('.notebook_cache') if use_cache else None,
+               execute=globals().get('nbsphinx_execute', 'auto') != 'never',
+               allow_errors=nbsphinx_allow_errors)
+
 nbsphinx_thumbnails = {
     'notebooks/part1_flopy/01-Flopy-intro': 
         '_images/flopylogo_sm.png',
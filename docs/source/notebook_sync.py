@@ -0,0 +1,292 @@
+"""Incremental copy of the notebooks (and their data) into the docs
+source folder, with cached notebook execution.
+
+Sphinx decides which pages to rebuild from the modification times of
+the source files, so deleting and re-copying all of the notebooks for
+every build makes Sphinx rebuild every notebook page. Here, only the
+files that are new or have changed (by size and modification time, or
+else by content) are copied, with their modification times, and files
+that are no longer in the list are removed.
+
+Notebooks that are saved without outputs (which nbsphinx would execute
+for every build in which they are rebuilt) are executed here instead,
+and the executed notebooks are kept in a cache folder, by a hash of
+the notebook and the Python files in its folder. The executed notebook
+is copied to the docs (with execution turned off for nbsphinx), so a
+notebook is only executed again after it (or a module next to it)
+changes. Executions with errors in the outputs (which may be transient,
+e.g. a failed download) are copied to the docs, but not cached.
+
+Each notebook is executed in its own scratch copy of the repository
+(see ``make_scratch_dir`` in ``tests/notebook_runner.py``), so that
+notebooks running at the same time don't write over each other's
+output (e.g. the project notebooks that all write ``../figures``).
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, str(Path(__file__).parents[2] / 'tests'))
+
+# folders that aren't copied
+skip_folders = {'.ipynb_checkpoints', '__pycache__'}
+
+
+def file_hash(filename, blocksize=2**20):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as src:
+        for block in iter(lambda: src.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def expand(paths, source_root):
+    """Map the files to copy (with the files in folders listed)
+    to their paths relative to source_root.
+
+    Returns
+    -------
+    files : dict
+        {relative path: source file}
+    """
+    source_root = Path(source_root)
+    files = {}
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            for folder, dirs, names in os.walk(path):
+                dirs[:] = [d for d in dirs if d not in skip_folders]
+                for name in names:
+                    f = Path(folder, name)
+                    files[f.relative_to(source_root)] = f
+        else:
+            files[path.relative_to(source_root)] = path
+    return files
+
+
+def copy_if_changed(src, dest):
+    """Copy a file (with its modification time), unless dest is
+    the same. Returns True if the file was copied."""
+    src, dest = Path(src), Path(dest)
+    if dest.is_file():
+        src_stat, dest_stat = src.stat(), dest.stat()
+        if src_stat.st_size == dest_stat.st_size:
+            if src_stat.st_mtime == dest_stat.st_mtime:
+                return False
+            if file_hash(src) == file_hash(dest):
+                # same content; only update the modification time,
+                # for the quick comparison next time
+                os.utime(dest, (src_stat.st_atime, src_stat.st_mtime))
+                return False
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy2(src, dest)
+    return True
+
+
+def sync_files(files, dest_root, remove=True):
+    """Copy files to dest_root, only copying new or changed files,
+    and (optionally) removing files under dest_root that aren't in
+    files.
+
+    Parameters
+    ----------
+    files : dict
+        {relative path: source file}
+    dest_root : pathlike
+    remove : bool
+
+    Returns
+    -------
+    copied, removed : lists of relative paths
+    """
+    dest_root = Path(dest_root)
+    copied = [rel for rel, src in files.items()
+              if copy_if_changed(src, dest_root / rel)]
+    removed = []
+    if remove and dest_root.is_dir():
+        keep = {Path(rel) for rel in files}
+        for folder, dirs, names in os.walk(dest_root, topdown=False):
+            for name in names:
+                rel = Path(folder, name).relative_to(dest_root)
+                if rel not in keep:
+                    (dest_root / rel).unlink()
+                    removed.append(rel)
+            if folder != str(dest_root) and not os.listdir(folder):
+                os.rmdir(folder)
+    return copied, removed
+
+
+def has_outputs(notebook):
+    """Check whether any code cells in a notebook have outputs."""
+    with open(notebook, encoding='utf-8') as src:
+        nb = json.load(src)
+    return any(cell.get('outputs') for cell in nb.get('cells', [])
+               if cell.get('cell_type') == 'code')
+
+
+def execution_key(notebook, kernel_name=None):
+    """Hash of a notebook, the Python files in its folder
+    and the kernel name."""
+    notebook = Path(notebook)
+    sha = hashlib.sha256()
+    sha.update(str(kernel_name).encode())
+    for path in [notebook] + sorted(notebook.parent.glob('*.py')):
+        sha.update(path.name.encode())
+        sha.update(file_hash(path).encode())
+    return sha.hexdigest()
+
+
+def has_errors(nb):
+    """Check whether any cells in an executed notebook have errors."""
+    return any(output.get('output_type') == 'error'
+               for cell in nb.cells for output in cell.get('outputs', []))
+
+
+def execute_notebook(notebook, workdir, outfile, timeout=None,
+                     allow_errors=True, kernel_name=None):
+    """Execute a notebook (in workdir) with nbclient, and save the
+    executed notebook, with execution turned off for nbsphinx.
+
+    Returns
+    -------
+    errors : bool
+        True if any cells have errors in their outputs.
+    """
+    import nbformat
+    from nbclient import NotebookClient
+
+    nb = nbformat.read(notebook, as_version=4)
+    kwargs = {'kernel_name': kernel_name} if kernel_name else {}
+    client = NotebookClient(nb, timeout=timeout, allow_errors=allow_errors,
+                            resources={'metadata': {'path': str(workdir)}},
+                            **kwargs)
+    client.execute()
+    nb.metadata['nbsphinx'] = {'execute': 'never'}
+    outfile = Path(outfile)
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+    tmp = outfile.with_suffix('.tmp')
+    nbformat.write(nb, tmp)
+    os.replace(tmp, outfile)
+    return has_errors(nb)
+
+
+def sync_notebooks(paths, source_root, dest_root, cache_dir=None,
+                   execute=True, max_workers=None, timeout=None,
+                   allow_errors=True, kernel_name=None):
+    """Copy notebooks and other files for the docs, only copying
+    new or changed files, and executing notebooks without outputs
+    (or getting them from the cache).
+
+    Parameters
+    ----------
+    paths : list of pathlike
+        Files and folders to copy, under source_root.
+    source_root : pathlike
+    dest_root : pathlike
+        Folder to copy to (with the same layout as source_root).
+        Files under dest_root that aren't in paths are removed.
+    cache_dir : pathlike, optional
+        Folder for executed notebooks. By default, notebooks aren't
+        executed here (they are copied without outputs, for nbsphinx
+        to execute).
+    execute : bool
+        Option to execute notebooks without outputs. By default, True.
+    max_workers : int, optional
+        Number of notebooks to execute at once (each in its own
+        scratch copy of the repository). By default, the number of cores.
+    timeout : int, optional
+        Time limit for each cell, in seconds.
+    allow_errors : bool
+        Option to continue executing a notebook after an error
+        (the error is shown in the output). By default, True.
+        Notebooks with errors aren't cached.
+    kernel_name : str, optional
+        By default, the kernel in the notebook metadata.
+    """
+    files = expand(paths, source_root)
+    to_execute = {}
+    if execute and cache_dir is not None:
+        to_execute = {rel: src for rel, src in files.items()
+                      if rel.suffix == '.ipynb' and not has_outputs(src)}
+    # copy the other files first, so that the data are in place
+    # for executing the notebooks
+    copied_first, _ = sync_files({rel: src for rel, src in files.items()
+                                  if rel not in to_execute},
+                                 dest_root, remove=False)
+
+    executed, with_errors, failed = [], [], []
+    if to_execute:
+        from notebook_runner import make_scratch_dir, remove_scratch_dir
+
+        cache_dir = Path(cache_dir)
+        names, cached = {}, {}
+        for rel, src in to_execute.items():
+            names[rel] = rel.with_suffix('').as_posix().replace('/', '__')
+            key = execution_key(src, kernel_name)[:16]
+            cached[rel] = cache_dir / f'{names[rel]}-{key}.ipynb'
+        # executed notebooks with errors (used for this build only)
+        errors_dir = cache_dir / 'errors'
+        if errors_dir.exists():
+            shutil.rmtree(errors_dir)
+        missing = [rel for rel, path in cached.items() if not path.exists()]
+        scratch_root = Path(tempfile.mkdtemp(prefix='docs_notebooks_'))
+
+        def run(rel):
+            scratch = scratch_root / names[rel]
+            try:
+                workdir = make_scratch_dir(to_execute[rel], scratch)
+                errors = execute_notebook(to_execute[rel], workdir,
+                                          cached[rel], timeout=timeout,
+                                          allow_errors=allow_errors,
+                                          kernel_name=kernel_name)
+                if errors:
+                    errors_dir.mkdir(exist_ok=True)
+                    os.replace(cached[rel], errors_dir / cached[rel].name)
+                    return 'errors'
+                return 'executed'
+            except Exception as e:
+                print(f'could not execute {to_execute[rel]}:\n{e}')
+                return 'failed'
+            finally:
+                if scratch.exists():
+                    remove_scratch_dir(scratch)
+
+        if missing:
+            # each notebook may run models, so use no more
+            # threads (kernels) than cores
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()
+                                        ) as executor:
+                    for rel, result in zip(missing, executor.map(run, missing)):
+                        {'executed': executed, 'errors': with_errors,
+                         'failed': failed}[result].append(rel)
+            finally:
+                shutil.rmtree(scratch_root, ignore_errors=True)
+        for rel, path in cached.items():
+            # notebooks that couldn't be executed are left
+            # for nbsphinx to execute
+            if rel in failed:
+                files[rel] = to_execute[rel]
+            elif rel in with_errors:
+                files[rel] = errors_dir / path.name
+            else:
+                files[rel] = path
+        # remove outdated notebooks from the cache
+        for path in cache_dir.glob('*.ipynb'):
+            if path not in cached.values():
+                path.unlink()
+
+    copied, removed = sync_files(files, dest_root, remove=True)
+    copied = copied_first + copied
+    print(f'docs notebooks: {len(copied)} of {len(files)} files copied, '
+          f'{len(removed)} removed, '
+          f'{len(executed) + len(with_errors)} notebooks executed '
+          f'({len(with_errors)} with errors, not cached), '
+          f'{len(to_execute) - len(executed) - len(with_errors) - len(failed)} '
+          'from the cache')
+    return copied, removed
@@ -1,131 +1,368 @@
+"""Self-check of the basic class environment (Part 0).
+
+Each package is checked in its own Python process (so that the checks
+are independent, like the imports in a fresh notebook kernel), with
+the checks running concurrently. The processes are run with
+``python -X importtime``, to find how long the imports take, and which
+modules are the slowest to import.
+
+The checks don't need a network connection: the dataretrieval check
+downloads stand-in data (fixtures/nwis_iv_03339000.json) from a local
+server instead of the USGS water services.
+
+Usage::
+
+    python test_installation.py               # all of the checks
+    python test_installation.py numpy pandas  # some of the checks
+    python test_installation.py -j 1          # one at a time (the import
+                                              # times are more accurate)
+    python test_installation.py --json check.json
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import http.server
+import json
+import os
 import pathlib as pl
+import re
+import subprocess
+import sys
+import threading
+import time
+
+here = pl.Path(__file__).parent.resolve()
+data_path = here / "../notebooks/part0_python_intro/data"
+fixtures_path = here / "fixtures"
+
+# stand-in responses for the USGS water services, by path
+standin_responses = {
+    "/nwis/iv": fixtures_path / "nwis_iv_03339000.json",
+}
 
-print('This may take a few minutes....note that various package versions will be printed')
 
+def check_numpy():
+    import numpy as np
 
-# numpy
-import numpy as np
+    err_msg = "invalid numpy installation"
+    arr = np.random.random((5, 5))
+    assert arr.shape == (5, 5), err_msg
+    assert arr.reshape(25).shape == (25,), err_msg
+    assert arr.flatten().shape == (25,), err_msg
+    return np.__version__
 
-err_msg = "invalid numpy installation"
-print(f"numpy version: {np.__version__}")
-arr = np.random.random((5, 5))
-assert arr.shape == (5, 5), err_msg
-assert arr.reshape(25).shape == (25,), err_msg
-assert arr.flatten().shape == (25,), err_msg
 
-x = np.linspace(0, 2 * np.pi)
-y = np.sin(x)
+def check_matplotlib():
+    import numpy as np
+    import matplotlib as mpl
+    mpl.use("Agg")
+    import matplotlib.pyplot as plt
 
-# matplotlib
-import matplotlib as mpl
-import matplotlib.pyplot as plt
+    err_msg = "invalid matplotlib installation"
+    arr = np.random.random((5, 5))
+    x = np.linspace(0, 2 * np.pi)
+    y = np.sin(x)
+    p = plt.imshow(arr)
+    assert isinstance(p, mpl.image.AxesImage), err_msg
+    p = plt.plot(x, y)
+    assert isinstance(p[0], mpl.lines.Line2D), err_msg
+    return mpl.__version__
 
-print(f"matplotlib version: {mpl.__version__}")
 
-err_msg = "invalid matplotlib installation"
-p = plt.imshow(arr)
-assert isinstance(p, mpl.image.AxesImage), err_msg
+def check_pandas():
+    import pandas as pd
+
+    err_msg = "invalid pandas installation"
+    df = pd.read_csv(data_path / "pandas/site_info.csv")
+    assert isinstance(df, pd.DataFrame) and len(df) > 0, err_msg
+    return pd.__version__
+
+
+def check_dataretrieval():
+    import pandas as pd
+    import dataretrieval as dr
+    import dataretrieval.nwis as nwis
+
+    err_msg = "invalid dataretrival/pandas installation"
+    # download from the local stand-in server
+    nwis.WATERSERVICE_URL = os.environ["NWIS_STANDIN_URL"]
+    df = nwis.get_record(
+        sites="03339000",
+        service="iv",
+        start="2017-12-31",
+        end="2018-01-01",
+    )
+    assert isinstance(df, pd.DataFrame), err_msg
+    assert len(df) == 8 and "00060" in df.columns, err_msg
+    return dr.__version__
+
 
-p = plt.plot(x, y)
-assert isinstance(p[0], mpl.lines.Line2D), err_msg
+def check_geopandas():
+    import geopandas as gp
 
-# dataretrival and pandas
-import pandas as pd
-import dataretrieval as dr
-import dataretrieval.nwis as nwis
+    err_msg = "invalid geopandas installation"
+    parks = gp.read_file(data_path / "geopandas/Madison_Parks.geojson")
+    assert isinstance(parks, gp.geodataframe.GeoDataFrame), err_msg
+    temp = here / "temp"
+    temp.mkdir(exist_ok=True)
+    shp_path = temp / "parks.shp"
+    for ext in (".shp", ".dbf", ".prj", ".cpg", ".shx"):
+        path = shp_path.with_suffix(ext)
+        if path.is_file():
+            path.unlink()
+    parks.to_file(shp_path)
+    assert shp_path.is_file(), err_msg
 
-print(f"dataretrieval version: {dr.__version__}")
-print(f"pandas version: {pd.__version__}")
+    json_path = temp / "parks.json"
+    if json_path.is_file():
+        json_path.unlink()
+    parks.to_file(json_path, driver="GeoJSON")
+    assert json_path.is_file(), err_msg
+    return gp.__version__
 
-err_msg = "invalid dataretrival/pandas installation"
-df = nwis.get_record(
-    sites="03339000",
-    service="iv",
-    start="2017-12-31",
-    end="2018-01-01",
-)
-assert isinstance(df, pd.DataFrame), err_msg
 
-# geopandas
-import geopandas as gp
+def check_rasterio():
+    import rasterio
 
-print(f"geopandas version: {gp.__version__}")
+    err_msg = "invalid rasterio installation"
+    rasterio_path = data_path / "rasterio"
+    input_rasters = {
+        1970: rasterio_path / "19700901_ned1_2003_adj_warp.tif",
+        2008: rasterio_path / "20080901_rainierlidar_30m-adj.tif",
+        2015: rasterio_path / "20150818_rainier_summer-tile-30.tif",
+    }
+    meta = {}
+    for year, f in input_rasters.items():
+        with rasterio.open(f) as src:
+            meta[year] = src.meta
+    for key in meta.keys():
+        assert key in (1970, 2008, 2015), err_msg
+        assert isinstance(meta[key], dict), err_msg
+    return rasterio.__version__
 
-err_msg = "invalid geopandas installation"
-parks = gp.read_file(
-    pl.Path(
-        "../notebooks/part0_python_intro/data/geopandas/Madison_Parks.geojson"
+
+def check_xarray():
+    import xarray as xr
+
+    err_msg = "invalid xarray installation"
+    da = xr.DataArray([9, 0, 2, 1, 0])
+    assert isinstance(da, xr.DataArray), err_msg
+
+    coords = [10.0, 20.0, 30.0, 40.0, 50.0]
+    da = xr.DataArray([9, 0, 2, 1, 0], dims=["x"], coords={"x": coords})
+    assert da["x"].values.tolist() == coords, err_msg
+    return xr.__version__
+
+
+def check_pyproj():
+    import pyproj
+    from pyproj import Transformer
+
+    err_msg = "invalid pyproj installation"
+    daymet_proj_string = (
+        "+proj=lcc +lon_0=-100 +lat_0=42.5 +x_0=0 +y_0=0 "
+        "+lat_1=25 +lat_2=60 +ellps=WGS84"
     )
-)
-assert isinstance(parks, gp.geodataframe.GeoDataFrame), err_msg
-if not pl.Path("temp").exists():
-    pl.Path("temp").mkdir()
-shp_path = pl.Path("temp/parks.shp")
-for ext in (".shp", ".dbf", ".prj", ".cpg", ".shx"):
-    path = shp_path.with_suffix(ext)
-    if path.is_file():
-        path.unlink()
-parks.to_file(shp_path)
-assert shp_path.is_file(), err_msg
-
-json_path = pl.Path("temp/parks.json")
-if json_path.is_file():
-    json_path.unlink()
-parks.to_file(json_path, driver="GeoJSON")
-assert json_path.is_file(), err_msg
-
-# rasterio
-import rasterio
-
-print(f"rasterio version: {rasterio.__version__}")
-
-err_msg = "invalid rasterio installation"
-data_path = pl.Path("../notebooks/part0_python_intro/data/rasterio")
-
-dem_file_1970 = data_path / "19700901_ned1_2003_adj_warp.tif"
-dem_file_2008 = data_path / "20080901_rainierlidar_30m-adj.tif"
-dem_file_2015 = data_path / "20150818_rainier_summer-tile-30.tif"
-
-input_rasters = {1970: dem_file_1970, 2008: dem_file_2008, 2015: dem_file_2015}
-meta = {}
-for i, (year, f) in enumerate(input_rasters.items()):
-    with rasterio.open(f) as src:
-        # get the metadata
-        meta[year] = src.meta
-for key in meta.keys():
-    assert key in (1970, 2008, 2015), err_msg
-    assert isinstance(meta[key], dict), err_msg
-
-# xarray
-import xarray as xr
-
-print(f"xarray version: {xr.__version__}")
-
-err_msg = "invalid xarray installation"
-da = xr.DataArray([9, 0, 2, 1, 0])
-assert isinstance(da, xr.DataArray), err_msg
-
-coords = [10.0, 20.0, 30.0, 40.0, 50.0]
-da = xr.DataArray([9, 0, 2, 1, 0], dims=["x"], coords={"x": coords})
-assert da["x"].values.tolist() == coords, err_msg
-
-# pyproj
-import pyproj
-from pyproj import Transformer
-
-print(f"pyproj version: {pyproj.__version__}")
-
-err_msg = "invalid pyproj installation"
-daymet_proj_string = (
-    "+proj=lcc +lon_0=-100 +lat_0=42.5 +x_0=0 +y_0=0 "
-    "+lat_1=25 +lat_2=60 +ellps=WGS84"
-)
-transformer = Transformer.from_crs(4269, daymet_proj_string)
-assert (
-    transformer.definition
-    == "proj=pipeline step proj=axisswap order=2,1 step proj=unitconvert xy_in=deg xy_out=rad step proj=lcc lat_0=42.5 lon_0=-100 lat_1=25 lat_2=60 x_0=0 y_0=0 ellps=WGS84"
-), err_msg
-
-# final message
-msg = "Successful testing of the basic class environment for Part 0"
-print(msg)
+    transformer = Transformer.from_crs(4269, daymet_proj_string)
+    assert (
+        transformer.definition
+        == "proj=pipeline step proj=axisswap order=2,1 step proj=unitconvert xy_in=deg xy_out=rad step proj=lcc lat_0=42.5 lon_0=-100 lat_1=25 lat_2=60 x_0=0 y_0=0 ellps=WGS84"
+    ), err_msg
+    return pyproj.__version__
+
+
+checks = {
+    "numpy": check_numpy,
+    "matplotlib": check_matplotlib,
+    "pandas": check_pandas,
+    "dataretrieval": check_dataretrieval,
+    "geopandas": check_geopandas,
+    "rasterio": check_rasterio,
+    "xarray": check_xarray,
+    "pyproj": check_pyproj,
+}
+
+# written to stderr before a check is run, so that the imports
+# of this script aren't counted
+start_marker = "--- start of check ---"
+
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the stand-in responses for the USGS water services."""
+
+    def do_GET(self):
+        path = standin_responses.get(self.path.split("?")[0].rstrip("/"))
+        if path is None:
+            self.send_error(404)
+            return
+        body = path.read_bytes()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_standin_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandinHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_check_here(name):
+    """Run a check in this process (in the subprocess), and print
+    the package version and the elapsed time as JSON."""
+    sys.stderr.write(start_marker + "\n")
+    sys.stderr.flush()
+    start = time.perf_counter()
+    version = checks[name]()
+    print(json.dumps({"version": version,
+                      "elapsed": time.perf_counter() - start}))
+
+
+import_line = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)")
+
+
+def parse_importtime(stderr):
+    """Parse the ``-X importtime`` output after the start marker.
+
+    Returns
+    -------
+    imports : list of dicts
+        With module, self and cumulative (import times, in seconds)
+        and top_level (True for the modules imported by the check
+        itself, rather than by other modules) items.
+    other : str
+        Other output.
+    """
+    imports = []
+    other = []
+    started = False
+    for line in stderr.splitlines():
+        if line == start_marker:
+            started = True
+            continue
+        match = import_line.match(line)
+        if match is None:
+            if not line.startswith("import time:"):
+                other.append(line)
+            continue
+        if started:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append({"module": module,
+                            "self": int(self_us) / 1e6,
+                            "cumulative": int(cumulative_us) / 1e6,
+                            "top_level": len(indent) == 1})
+    return imports, "\n".join(other)
+
+
+def run_check(name, env):
+    """Run a check in a subprocess, with import timing.
+
+    Returns
+    -------
+    result : dict
+    """
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", __file__, "--run-check", name],
+        capture_output=True, text=True, cwd=here, env=env)
+    wall_time = time.perf_counter() - start
+    imports, stderr = parse_importtime(proc.stderr)
+    result = {"check": name, "passed": proc.returncode == 0,
+              "wall_time": wall_time,
+              "import_time": sum(i["cumulative"] for i in imports
+                                 if i["top_level"]),
+              "imports": imports, "version": None, "elapsed": None,
+              "error": None}
+    if proc.returncode == 0:
+        result.update(json.loads(proc.stdout.strip().splitlines()[-1]))
+    else:
+        result["error"] = stderr.strip() or proc.stdout.strip()
+    return result
+
+
+def print_summary(results, top=15):
+    print(f"\n{'check':<14} {'status':<7} {'version':<12} {'import (s)':>10} "
+          f"{'check (s)':>10} {'total (s)':>10}  slowest import")
+    for result in results:
+        slowest = max((i for i in result["imports"] if i["top_level"]),
+                      key=lambda i: i["cumulative"], default=None)
+        slowest = "" if slowest is None else \
+            f"{slowest['module']} ({slowest['cumulative']:.2f} s)"
+        check_time = "" if result["elapsed"] is None else \
+            f"{result['elapsed'] - result['import_time']:10.2f}"
+        print(f"{result['check']:<14} "
+              f"{'ok' if result['passed'] else 'FAILED':<7} "
+              f"{result['version'] or '':<12} {result['import_time']:10.2f} "
+              f"{check_time:>10} {result['wall_time']:10.2f}  {slowest}")
+
+    # slowest modules by their own import time (not including the
+    # modules they import), across all of the checks
+    modules = {}
+    for result in results:
+        for i in result["imports"]:
+            prev = modules.get(i["module"])
+            if prev is None or i["self"] > prev["self"]:
+                modules[i["module"]] = {**i, "check": result["check"]}
+    slowest = sorted(modules.values(), key=lambda i: i["self"],
+                     reverse=True)[:top]
+    print(f"\nslowest modules to import (self time, not including the "
+          f"modules they import):\n\n{'self (s)':>9} {'cumulative (s)':>15}  module")
+    for i in slowest:
+        print(f"{i['self']:9.3f} {i['cumulative']:15.3f}  {i['module']}")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("checks", nargs="*",
+                        help=f"checks to run ({', '.join(checks)}; "
+                             "by default, all)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of checks to run at once")
+    parser.add_argument("--top", type=int, default=15,
+                        help="number of slow modules to list")
+    parser.add_argument("--json", help="write the results to a JSON file")
+    parser.add_argument("--run-check", help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+    if args.run_check:
+        run_check_here(args.run_check)
+        return 0
+
+    names = args.checks or list(checks)
+    unknown = set(names) - set(checks)
+    if unknown:
+        parser.error(f"unknown checks: {', '.join(sorted(unknown))}")
+    server = start_standin_server()
+    env = dict(os.environ, NWIS_STANDIN_URL=
+               f"http://127.0.0.1:{server.server_address[1]}/nwis/")
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+            results = list(executor.map(lambda name: run_check(name, env),
+                                        names))
+    finally:
+        server.shutdown()
+    print_summary(results, top=args.top)
+    print(f"\n{len(names)} checks in {time.perf_counter() - start:.1f} s"
+          + (f" ({args.jobs} at a time; use -j 1 for more accurate "
+             "import times)" if args.jobs > 1 else ""))
+    if args.json:
+        with open(args.json, "w") as dest:
+            json.dump(results, dest, indent=2)
+
+    failed = [result for result in results if not result["passed"]]
+    for result in failed:
+        print(f"\n{result['check']} check failed:\n{result['error']}")
+    if failed:
+        return 1
+    # final message
+    msg = "Successful testing of the basic class environment for Part 0"
+    print(f"\n{msg}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,11 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
 import os
 from pathlib import Path
-import json
-import subprocess
+import nbformat
 
 notebook_count = 0
-# add the basenames of any notebooks we want to keep the results of 
+# add the basenames of any notebooks we want to keep the results of
 # all solutions are still not being cleared
 
 skip_notebooks = [
@@ -18,22 +19,77 @@ skip_notebooks = [
     'Modpath_particle_tracking-demo.ipynb'
     ]
 
+# notebook metadata that is kept when clearing
+# (everything else is removed, as with the nbconvert
+# ClearMetadataPreprocessor and preserve_nb_metadata_mask={'kernelspec'})
+preserve_nb_metadata = {'kernelspec'}
+
+
+def scan_notebook(notebook):
+    """Read a notebook as JSON (without validating it) and check
+    whether it has outputs, and whether it is already clear.
+
+    Parameters
+    ----------
+    notebook : pathlike
+
+    Returns
+    -------
+    has_outputs : bool
+        True if any code cells have outputs.
+    is_clear : bool
+        True if no code cells have outputs, execution counts or
+        metadata, and the notebook metadata has nothing but the
+        kernelspec (so clearing the notebook wouldn't change it).
+    """
+    with open(notebook, encoding='utf-8') as src:
+        nb = json.load(src)
+    code_cells = [cell for cell in nb.get('cells', [])
+                  if cell.get('cell_type') == 'code']
+    has_outputs = any(cell.get('outputs') for cell in code_cells)
+    is_clear = not has_outputs and \
+        set(nb.get('metadata', {})) <= preserve_nb_metadata and \
+        all(cell.get('execution_count') is None and not cell.get('metadata')
+            for cell in code_cells)
+    return has_outputs, is_clear
+
+
+def clear_notebook(notebook):
+    """Clear the outputs, execution counts and metadata of a notebook
+    (in place), as with ``jupyter nbconvert --ClearOutputPreprocessor.enabled=True
+    --ClearMetadataPreprocessor.enabled=True
+    --ClearMetadataPreprocessor.preserve_nb_metadata_mask={('kernelspec')}
+    --inplace``.
+    """
+    nb = nbformat.read(notebook, as_version=4)
+    for cell in nb.cells:
+        if cell.cell_type == 'code':
+            cell.outputs = []
+            cell.execution_count = None
+            cell.metadata = {}
+    nb.metadata = nbformat.NotebookNode(
+        {k: v for k, v in nb.metadata.items() if k in preserve_nb_metadata})
+    nbformat.write(nb, notebook)
+
+
+def notebooks_to_clear(nbdir='.'):
+    """Notebooks under nbdir, except for solutions and the notebooks
+    in skip_notebooks."""
+    return [nb for nb in sorted(Path(nbdir).rglob("*.ipynb"))
+            if 'solutions' not in str(nb) and nb.name not in skip_notebooks]
+
+
 if __name__ == "__main__":
-    nbdir = Path(".")
-    nbs = nbdir.rglob("*.ipynb")
-    for nb in nbs:
-        if ('solutions' not in str(nb) and 
-                    nb.name not in skip_notebooks):
-            print("clearing", nb)
-            cmd = (
-                "jupyter",
-                "nbconvert",
-                "--ClearOutputPreprocessor.enabled=True",
-                "--ClearMetadataPreprocessor.enabled=True",
-                "--ClearMetadataPreprocessor.preserve_nb_metadata_mask={('kernelspec')}",
-                "--inplace",
-                nb,
-            )
-            proc = subprocess.run(cmd)
-            assert proc.returncode == 0, f"Error running command: {' '.join(cmd)}"
-        
\ No newline at end of file
+    nbs = notebooks_to_clear(".")
+    # only notebooks with something to clear are written
+    # (so that the modification times of the others are kept)
+    dirty = [nb for nb in nbs if not scan_notebook(nb)[1]]
+    if len(dirty) > 1:
+        with ProcessPoolExecutor(max_workers=min(len(dirty), os.cpu_count())) as executor:
+            list(executor.map(clear_notebook, dirty))
+    else:
+        for nb in dirty:
+            clear_notebook(nb)
+    for nb in dirty:
+        print("cleared", nb)
+    print(f"{len(dirty)} of {len(nbs)} notebooks cleared")
@@ -0,0 +1,722 @@
+"""Helpers for working with Daymet climate data in xarray.
+
+The xarray notebook loads the whole daily Daymet cube into memory
+with ``xr.load_dataset``, and recomputes the same monthly and annual
+groupby reductions in several cells. The functions here open the cube
+lazily (in time chunks), compute climatologies out of core, and cache
+the results to a local store, so that repeat analyses only have to
+open a small, precomputed file.
+
+Examples
+--------
+>>> ds = open_daymet('data/xarray/daymet_prcp_rainier_1980-2018.nc')
+>>> monthly = climatology('data/xarray/daymet_prcp_rainier_1980-2018.nc',
+...                       'monthly_mean')
+>>> annual = climatology('data/xarray/daymet_prcp_rainier_1980-2018.nc',
+...                      'annual_sum')
+>>> sites = {'summit': (46.852886, -121.760374),
+...          'paradise': (46.7868, -121.7338)}
+>>> df = extract_sites(ds['prcp'], sites).to_pandas()
+>>> glaciers = gpd.read_file('data/rasterio/rgi60_glacierpoly_rainier.shp')
+>>> weights = polygon_weights(ds['prcp'], glaciers, grid_crs=daymet_proj_string)
+>>> glacier_prcp = polygon_means(ds['prcp'], weights, names=glaciers['Name'])
+>>> ds.rio.write_crs(daymet_proj_string, inplace=True)
+>>> prcp_4269 = reproject(ds['prcp'], 4269)
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+from pathlib import Path
+import time
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.warp import calculate_default_transform
+from scipy import sparse
+from scipy.spatial import cKDTree
+import shapely
+import xarray as xr
+
+try:
+    import dask
+except ImportError:
+    dask = False
+
+
+daymet_proj_string = ('+proj=lcc +lon_0=-100 +lat_0=42.5 +x_0=0 +y_0=0 '
+                      '+lat_1=25 +lat_2=60 +ellps=WGS84')
+
+# reduction name: (groupby key, groupby method)
+reductions = {
+    'monthly_mean': ('time.month', 'mean'),
+    'monthly_sum': ('time.month', 'sum'),
+    'annual_mean': ('time.year', 'mean'),
+    'annual_sum': ('time.year', 'sum'),
+}
+
+
+def open_daymet(path, time_chunk=None):
+    """Open a Daymet NetCDF file lazily.
+
+    Parameters
+    ----------
+    path : str or pathlike
+        Daymet NetCDF file.
+    time_chunk : int, optional
+        Number of days in each chunk along the time dimension,
+        if dask is installed. By default, None, in which case the
+        chunking of the file on disk is used. With dask, all
+        computations are done chunk-by-chunk, in parallel.
+        Without dask, data are only read from disk when they are
+        accessed (for example, by :func:`climatology`, which
+        streams through the file one year at a time).
+
+    Returns
+    -------
+    ds : xarray.Dataset
+    """
+    if dask:
+        chunks = {} if time_chunk is None else {'time': time_chunk}
+        return xr.open_dataset(path, chunks=chunks)
+    return xr.open_dataset(path)
+
+
+def file_hash(path, blocksize=2**20):
+    """Get the sha256 hash of a file's contents.
+
+    Parameters
+    ----------
+    path : str or pathlike
+    blocksize : int
+        Number of bytes to read at a time.
+
+    Returns
+    -------
+    hash : str
+        Hexadecimal digest.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as src:
+        for block in iter(lambda: src.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _source_hash(path, cache_dir):
+    """Get the sha256 hash of a source file, from a record of the
+    previous hash in cache_dir if the file has the same size and
+    modification time (so that the file isn't read on a cache hit)."""
+    record = Path(cache_dir) / f'{path.name}.sha256.json'
+    stat = os.stat(path)
+    signature = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if record.exists():
+        with open(record) as src:
+            previous = json.load(src)
+        if {k: previous.get(k) for k in signature} == signature:
+            return previous['sha256']
+    sha256 = file_hash(path)
+    Path(cache_dir).mkdir(exist_ok=True, parents=True)
+    with open(record, 'w') as dest:
+        json.dump({**signature, 'sha256': sha256}, dest)
+    return sha256
+
+
+def climatology(path, reduction='monthly_mean', variable='prcp',
+                cache_dir='daymet_cache', store='netcdf', time_chunk=None,
+                overwrite=False):
+    """Get a monthly or annual climatology for a Daymet variable,
+    computing it out of core and caching it on the first call.
+
+    Parameters
+    ----------
+    path : str or pathlike
+        Daymet NetCDF file.
+    reduction : str, {'monthly_mean', 'monthly_sum', 'annual_mean', 'annual_sum'}
+        Reduction to compute. Monthly reductions are grouped by
+        calendar month (e.g. all Januaries), annual reductions
+        by year.
+    variable : str
+        Daymet variable to reduce. By default, 'prcp'.
+    cache_dir : str or pathlike
+        Folder for the cached reductions. Cached files are keyed by
+        the source file contents, variable and reduction, so that
+        a change to the source file results in a new computation.
+        The source file is only hashed again if its size or
+        modification time have changed.
+    store : str, {'netcdf', 'zarr'}
+        Format for the cached reductions. Zarr requires the
+        zarr package.
+    time_chunk : int, optional
+        Number of days to read at a time, if dask is installed.
+        See :func:`open_daymet`.
+    overwrite : bool
+        Option to recompute the reduction even if a cached
+        version exists.
+
+    Returns
+    -------
+    reduced : xarray.DataArray
+        With a 'month' or 'year' dimension in place of 'time'.
+    """
+    if reduction not in reductions:
+        raise ValueError(f"reduction must be one of {list(reductions)}")
+    path = Path(path)
+    cache_dir = Path(cache_dir)
+    suffix = {'netcdf': '.nc', 'zarr': '.zarr'}[store]
+    sha256 = _source_hash(path, cache_dir)
+    cached = cache_dir / f"{path.stem}_{variable}_{reduction}_{sha256[:16]}{suffix}"
+    if cached.exists() and not overwrite:
+        return xr.open_dataarray(cached, engine={'netcdf': None, 'zarr': 'zarr'}[store])
+
+    group, how = reductions[reduction]
+    ds = open_daymet(path, time_chunk=time_chunk)
+    if dask:
+        reduced = getattr(ds[variable].groupby(group), how)(dim='time')
+        reduced = reduced.compute()
+    else:
+        reduced = _stream_reduction(ds[variable], group, how)
+    reduced.name = variable
+    reduced.attrs = ds[variable].attrs.copy()
+    reduced.attrs['reduction'] = reduction
+    reduced.attrs['source'] = path.name
+    reduced.attrs['source_sha256'] = sha256
+    ds.close()
+
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    if store == 'zarr':
+        reduced.to_dataset().to_zarr(cached, mode='w')
+    else:
+        encoding = {variable: {'zlib': True,
+                               'complevel': 4,
+                               'dtype': 'float32',
+                               '_FillValue': -9999,
+                               'chunksizes': (1,) + reduced.shape[1:]
+                               }}
+        reduced.to_dataset().to_netcdf(cached, encoding=encoding)
+    print(f'wrote {cached}')
+    return reduced
+
+
+def _stream_reduction(da, group, how):
+    """Compute a groupby reduction over time one year at a time,
+    without dask, so that only one year of data is in memory."""
+    years = np.unique(da['time.year'].values)
+    if group == 'time.year':
+        results = [getattr(da.sel(time=str(year)).load(), how)(dim='time')
+                   for year in years]
+        return xr.concat(results, dim=xr.DataArray(years, dims='year', name='year'))
+    sums, counts = 0, 0
+    for year in years:
+        data = da.sel(time=str(year)).load()
+        grouped = data.groupby('time.month')
+        year_sums = grouped.sum(dim='time').reindex(month=np.arange(1, 13), fill_value=0)
+        year_counts = grouped.count(dim='time').reindex(month=np.arange(1, 13), fill_value=0)
+        sums = sums + year_sums
+        counts = counts + year_counts
+    if how == 'mean':
+        return sums / counts
+    return sums
+
+
+def _lat_lon_to_xyz(lat, lon):
+    """Convert latitudes and longitudes (in degrees) to
+    3D cartesian coordinates on the unit sphere, so that
+    euclidean nearest neighbors are also the nearest on the globe."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)])
+
+
+class SiteIndex:
+    """Nearest-cell lookup for points on a curvilinear (2D lat/lon) grid,
+    using a KD-tree.
+
+    Parameters
+    ----------
+    lat, lon : 2D arrays or xarray.DataArrays
+        Latitude and longitude of the grid cell centers
+        (for example, ``ds['lat']`` and ``ds['lon']`` for Daymet).
+    """
+    def __init__(self, lat, lon):
+        lat = np.asarray(lat)
+        lon = np.asarray(lon)
+        self.shape = lat.shape
+        self.tree = cKDTree(_lat_lon_to_xyz(lat.ravel(), lon.ravel()))
+
+    def query(self, lat, lon):
+        """Get the (row, column) indices of the grid cells
+        nearest to points.
+
+        Parameters
+        ----------
+        lat, lon : sequences of floats
+
+        Returns
+        -------
+        i, j : 1D integer arrays
+            Row and column indices.
+        """
+        _, nodes = self.tree.query(_lat_lon_to_xyz(np.atleast_1d(lat),
+                                                   np.atleast_1d(lon)))
+        return np.unravel_index(nodes, self.shape)
+
+
+def extract_sites(da, sites, crs=4269, index=None):
+    """Extract time series at many sites from a gridded DataArray,
+    with a single vectorized read.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        Gridded data with dimensions (time, y, x) and 2D 'lat'
+        and 'lon' coordinates (for example, ``ds['prcp']`` for Daymet).
+    sites : dict or DataFrame
+        Site locations. Either a dict of (lat, lon) tuples keyed
+        by site name, or a DataFrame indexed by site name, with
+        'lat' and 'lon' columns, or 'x' and 'y' columns in crs.
+    crs : obj
+        Coordinate reference system of the site locations, in any
+        format accepted by :meth:`pyproj.Transformer.from_crs`.
+        By default, 4269 (NAD83 geographic coordinates). All sites
+        are transformed to geographic coordinates in one call.
+    index : SiteIndex, optional
+        Precomputed nearest-cell lookup for the grid, to reuse
+        across calls. Built from da.lat and da.lon if not supplied.
+
+    Returns
+    -------
+    extracted : xarray.DataArray
+        With dimensions (time, site). The row and column indices
+        of each site are included as 'i' and 'j' coordinates along
+        the site dimension. Use ``extracted.to_pandas()`` to get a
+        DataFrame with one column per site.
+    """
+    if isinstance(sites, dict):
+        sites = pd.DataFrame(sites, index=['lat', 'lon']).T
+    names = sites.index.values
+    if {'lat', 'lon'}.issubset(sites.columns):
+        lat, lon = sites['lat'].values, sites['lon'].values
+        xx, yy = lon, lat
+    else:
+        xx, yy = sites['x'].values, sites['y'].values
+    transformer = Transformer.from_crs(crs, 4269, always_xy=True)
+    lon, lat = transformer.transform(xx, yy)
+
+    if index is None:
+        index = SiteIndex(da['lat'], da['lon'])
+    i, j = index.query(lat, lon)
+    ydim, xdim = da['lat'].dims
+    extracted = da.isel({ydim: xr.DataArray(i, dims='site'),
+                         xdim: xr.DataArray(j, dims='site')})
+    extracted = extracted.drop_vars([c for c in ('lat', 'lon', 'x', 'y')
+                                     if c in extracted.coords])
+    return extracted.assign_coords(site=names,
+                                   i=('site', i), j=('site', j))
+
+
+def _cell_polygons(x, y):
+    """Make shapely boxes for the cells of a regular grid,
+    from 1D arrays of cell center coordinates."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    dx = np.abs(np.diff(x).mean()) if len(x) > 1 else 1.
+    dy = np.abs(np.diff(y).mean()) if len(y) > 1 else 1.
+    xx, yy = np.meshgrid(x, y)
+    return shapely.box(xx.ravel() - dx/2, yy.ravel() - dy/2,
+                       xx.ravel() + dx/2, yy.ravel() + dy/2)
+
+
+def polygon_weights(da, polygons, grid_crs=None, cache_dir='daymet_cache',
+                    overwrite=False):
+    """Compute the fractional area of each grid cell that falls within
+    each polygon, as a sparse (polygon, cell) matrix.
+
+    The weights only depend on the grid and the polygons, so they are
+    cached to disk (keyed by a hash of both) and reused for any variable
+    or time period on the same grid.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        Gridded data with 1D 'x' and 'y' (cell center) coordinates,
+        and dimensions ending with (y, x).
+    polygons : geopandas.GeoDataFrame or GeoSeries
+        Polygons (for example, basins or glaciers) to compute the
+        weights for. Reprojected to grid_crs if they have a crs.
+    grid_crs : obj, optional
+        Coordinate reference system of the grid, in any format accepted
+        by :meth:`geopandas.GeoDataFrame.to_crs`. By default, the crs
+        attached to da by rioxarray (``da.rio.crs``), if any.
+    cache_dir : str or pathlike, optional
+        Folder for the cached weights. If None, weights are not cached.
+    overwrite : bool
+        Option to recompute the weights even if they are cached.
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_array
+        Of shape (n polygons, n cells), where the cells are numbered
+        in row-major order (y, then x). Each entry is the fraction of
+        the cell area within the polygon.
+    """
+    if grid_crs is None and hasattr(da, 'rio'):
+        grid_crs = da.rio.crs
+    if grid_crs is not None and polygons.crs is not None:
+        polygons = polygons.to_crs(grid_crs)
+    geoms = np.asarray(polygons.geometry.values)
+    x, y = da['x'].values, da['y'].values
+
+    cached = None
+    if cache_dir is not None:
+        sha = hashlib.sha256()
+        sha.update(x.tobytes())
+        sha.update(y.tobytes())
+        for wkb in shapely.to_wkb(geoms):
+            sha.update(wkb)
+        cached = Path(cache_dir) / f"polygon_weights_{sha.hexdigest()[:16]}.npz"
+        if cached.exists() and not overwrite:
+            return sparse.csr_array(sparse.load_npz(cached))
+
+    cells = _cell_polygons(x, y)
+    cell_area = shapely.area(cells)
+    tree = shapely.STRtree(cells)
+    poly_idx, cell_idx = tree.query(geoms, predicate='intersects')
+    overlap = shapely.area(shapely.intersection(cells[cell_idx],
+                                                geoms[poly_idx]))
+    fraction = overlap / cell_area[cell_idx]
+    weights = sparse.csr_array((fraction, (poly_idx, cell_idx)),
+                               shape=(len(geoms), len(cells)))
+    weights.eliminate_zeros()
+    if cached is not None:
+        cached.parent.mkdir(exist_ok=True, parents=True)
+        sparse.save_npz(cached, sparse.csr_matrix(weights))
+    return weights
+
+
+def polygon_means(da, weights, names=None, time_chunk=365):
+    """Get area-weighted average time series for many polygons,
+    from one sparse matrix product per block of time steps.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        Gridded data with dimensions (time, y, x), on the same grid that
+        was used to make weights. Can be lazily loaded; only time_chunk
+        time steps are read at a time.
+    weights : scipy.sparse array
+        (polygon, cell) weights from :func:`polygon_weights`.
+    names : sequence, optional
+        Polygon names, for the 'polygon' coordinate of the result.
+        By default, polygons are numbered from 0.
+    time_chunk : int
+        Number of time steps to process at a time.
+
+    Returns
+    -------
+    means : xarray.DataArray
+        With dimensions (time, polygon). Missing (nan) values in da
+        are excluded from the averages; polygons with no valid
+        cells at a time step are nan.
+    """
+    weights = sparse.csr_array(weights)
+    ntimes = da.sizes['time']
+    ncells = weights.shape[1]
+    means = np.empty((ntimes, weights.shape[0]), dtype=float)
+    for t0 in range(0, ntimes, time_chunk):
+        block = np.asarray(da.isel(time=slice(t0, t0 + time_chunk)).values,
+                           dtype=float).reshape(-1, ncells)
+        valid = np.isfinite(block)
+        sums = weights @ np.where(valid, block, 0.).T
+        area = weights @ valid.T.astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[t0:t0 + len(block)] = (sums / area).T
+    if names is None:
+        names = np.arange(weights.shape[0])
+    return xr.DataArray(means, dims=('time', 'polygon'),
+                        coords={'time': da['time'].values,
+                                'polygon': np.asarray(names)},
+                        name=da.name, attrs=da.attrs)
+
+
+class Reprojector:
+    """Reusable mapping from one grid to another, for reprojecting
+    stacks of rasters that all share the same grid (for example,
+    each day in a Daymet cube).
+
+    :meth:`rioxarray.raster_array.RasterArray.reproject` recomputes
+    the transformation and resampling geometry for every call.
+    Here the source cell index (nearest) or source cell weights
+    (bilinear) for each destination cell are computed once, and
+    then applied to each time slice as a gather or sparse
+    matrix product.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        Data on the source grid, with a crs attached by rioxarray
+        (``da.rio.write_crs()``) and dimensions ending with (y, x).
+    dst_crs : obj
+        Destination coordinate reference system, in any format
+        accepted by :meth:`rasterio.crs.CRS.from_user_input`.
+    resampling : str, {'nearest', 'bilinear'}
+        Resampling method. The source cell (nearest) or cell weights
+        (bilinear) for each destination cell are found with GDAL, and
+        the results match rio.reproject of a single time slice (to
+        round-off, for bilinear). rio.reproject of a whole stack at
+        once isn't the same as reprojecting its slices one at a time:
+        GDAL splits large warps into chunks, each with its own
+        approximate transformation, which can move the sampling
+        points by up to 1/8 of a cell. For the Mount Rainier Daymet
+        precipitation (1980-2018), 0.4% of the nearest neighbor
+        values differ from rio.reproject of the stack (by up to
+        48 mm), and 28% of the bilinear values differ by more than
+        0.001 mm (by up to 13 mm). NaNs are treated as nodata (as in
+        rio.reproject of data with a nodata value); without a nodata
+        value, GDAL spreads NaNs to all of the bilinear neighbors.
+    resolution : float or tuple of floats, optional
+        Destination cell size. By default, computed by
+        :func:`rasterio.warp.calculate_default_transform`,
+        as with rio.reproject.
+    """
+    def __init__(self, da, dst_crs, resampling='nearest', resolution=None):
+        if resampling not in {'nearest', 'bilinear'}:
+            raise ValueError("resampling must be 'nearest' or 'bilinear'")
+        self.resampling = resampling
+        self.src_crs = CRS.from_user_input(da.rio.crs)
+        self.dst_crs = CRS.from_user_input(dst_crs)
+        self.src_transform = da.rio.transform()
+        self.src_shape = da.rio.shape
+        kwargs = {}
+        if resolution is not None:
+            kwargs['resolution'] = resolution
+        self.dst_transform, width, height = calculate_default_transform(
+            self.src_crs, self.dst_crs, self.src_shape[1], self.src_shape[0],
+            *da.rio.bounds(), **kwargs)
+        self.dst_shape = (height, width)
+        if resampling == 'nearest':
+            self.mapping = self._nearest_index()
+        else:
+            self.mapping = self._bilinear_weights()
+
+    def _nearest_index(self):
+        """Reproject the source cell numbers, to get the source
+        cell for each destination cell (-1 = outside of the source grid)."""
+        src_index = np.arange(np.prod(self.src_shape), dtype=float)
+        dst_index = np.full(self.dst_shape, -1.)
+        rasterio.warp.reproject(src_index.reshape(self.src_shape), dst_index,
+                                src_transform=self.src_transform,
+                                src_crs=self.src_crs, src_nodata=-1,
+                                dst_transform=self.dst_transform,
+                                dst_crs=self.dst_crs, dst_nodata=-1,
+                                resampling=Resampling.nearest)
+        return dst_index.ravel().astype(np.int64)
+
+    def _bilinear_weights(self):
+        """Sparse (destination cell, source cell) weights of GDAL's
+        bilinear resampling.
+
+        GDAL's weights depend on its (approximate) transformation, and
+        on the ratio of the cell sizes (the kernel is widened when
+        the destination cells are larger), so they are found by
+        reprojecting probe arrays with GDAL, rather than computed here.
+        The source cells are split into k x k classes (by row and
+        column modulo k), with k wider than the kernel, so that each
+        destination cell gets at most one cell of each class. For each
+        class, reprojecting an array of ones on the cells of the class
+        gives the weight of that cell, and an array of the cell
+        numbers gives which cell it is.
+        """
+        nrow, ncol = self.dst_shape
+        src_nrow, src_ncol = self.src_shape
+        k = 2 * int(np.ceil(self._scale())) + 2
+        src_rows, src_cols = np.indices(self.src_shape)
+        numbers = np.arange(src_nrow * src_ncol, dtype=float
+                            ).reshape(self.src_shape) + 1
+        rows, cols, weights = [], [], []
+        for a in range(k):
+            for b in range(k):
+                in_class = (src_rows % k == a) & (src_cols % k == b)
+                if not in_class.any():
+                    continue
+                weight, number = [self._gdal_reproject(np.where(in_class, values, 0.))
+                                  for values in (1., numbers)]
+                # weights that are too small to identify the cell
+                # (and don't affect the results) are dropped
+                used = np.isfinite(weight) & (weight > 1e-9)
+                dst_idx = np.flatnonzero(used)
+                src_idx = np.rint(number.ravel()[dst_idx] /
+                                  weight.ravel()[dst_idx]).astype(np.int64) - 1
+                rows.append(dst_idx)
+                cols.append(src_idx)
+                weights.append(weight.ravel()[dst_idx])
+        weights = sparse.csr_array(
+            (np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(nrow * ncol, src_nrow * src_ncol))
+        weights.sum_duplicates()
+        return weights
+
+    def _gdal_reproject(self, values, resampling=Resampling.bilinear):
+        """Reproject a 2D array on the source grid with GDAL
+        (as rio.reproject does), with NaN outside of the source grid."""
+        out = np.full(self.dst_shape, np.nan)
+        rasterio.warp.reproject(values, out,
+                                src_transform=self.src_transform,
+                                src_crs=self.src_crs,
+                                dst_transform=self.dst_transform,
+                                dst_crs=self.dst_crs, dst_nodata=np.nan,
+                                resampling=resampling)
+        return out
+
+    def _scale(self):
+        """Largest size of the destination cells, in source cells."""
+        nrow, ncol = self.dst_shape
+        cols, rows = np.meshgrid(np.arange(ncol + 1), np.arange(nrow + 1))
+        x, y = self.dst_transform * (cols.ravel(), rows.ravel())
+        transformer = Transformer.from_crs(self.dst_crs, self.src_crs,
+                                           always_xy=True)
+        x, y = transformer.transform(x, y)
+        src_col, src_row = ~self.src_transform * (x, y)
+        corners = np.stack([src_col, src_row]).reshape(2, nrow + 1, ncol + 1)
+        sizes = [np.abs(np.diff(corners, axis=axis)).max()
+                 for axis in (1, 2)]
+        return max(1., *[float(size) for size in sizes if np.isfinite(size)])
+
+    @property
+    def coords(self):
+        """x and y coordinates of the destination cell centers."""
+        nrow, ncol = self.dst_shape
+        x, _ = self.dst_transform * (np.arange(ncol) + 0.5, np.zeros(ncol))
+        _, y = self.dst_transform * (np.zeros(nrow), np.arange(nrow) + 0.5)
+        return {'x': x, 'y': y}
+
+    def apply(self, values):
+        """Reproject an array of shape (..., y, x) on the source grid."""
+        values = np.asarray(values, dtype=float)
+        lead = values.shape[:-2]
+        values = values.reshape(-1, np.prod(self.src_shape))
+        if self.resampling == 'nearest':
+            out = values[:, self.mapping]
+            out[:, self.mapping < 0] = np.nan
+        else:
+            # as in GDAL, NaNs are left out of the weighted average,
+            # unless they make up half or more of the weight
+            valid = np.isfinite(values)
+            sums = self.mapping @ np.where(valid, values, 0.).T
+            weights = self.mapping @ valid.T.astype(float)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out = (sums / np.where(weights >= 0.5, weights, np.nan)).T
+        return out.reshape(lead + self.dst_shape)
+
+    def __call__(self, da, time_chunk=365, max_workers=None):
+        """Reproject a DataArray, in chunks of time_chunk time steps,
+        with chunks processed concurrently on max_workers threads.
+
+        Returns
+        -------
+        reprojected : xarray.DataArray
+            On the destination grid, with the destination crs attached.
+        """
+        ydim, xdim = da.dims[-2:]
+        if 'time' not in da.dims:
+            values = self.apply(da.values)
+        else:
+            ntimes = da.sizes['time']
+            chunks = [slice(t0, t0 + time_chunk)
+                      for t0 in range(0, ntimes, time_chunk)]
+            if max_workers is None:
+                max_workers = os.cpu_count()
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = executor.map(
+                    lambda s: self.apply(da.isel(time=s).values), chunks)
+                values = np.concatenate(list(results), axis=da.dims.index('time'))
+        coords = {k: v for k, v in da.coords.items()
+                  if not set(v.dims).intersection((ydim, xdim))}
+        coords.update({xdim: self.coords['x'], ydim: self.coords['y']})
+        reprojected = xr.DataArray(values, dims=da.dims, coords=coords,
+                                   name=da.name, attrs=da.attrs)
+        return reprojected.rio.write_crs(self.dst_crs)
+
+
+_reprojectors = {}
+
+
+def reproject(da, dst_crs, resampling='nearest', resolution=None,
+              time_chunk=365, max_workers=None):
+    """Reproject a stack of rasters that share the same grid,
+    reusing the source-to-destination mapping across calls.
+
+    A :class:`Reprojector` is created and cached in memory for each
+    unique combination of source grid, destination crs, resolution
+    and resampling method.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        Data with dimensions (time, y, x) or (y, x), and a crs
+        attached by rioxarray.
+    dst_crs : obj
+        Destination coordinate reference system.
+    resampling : str, {'nearest', 'bilinear'}
+        Resampling method. By default, 'nearest' (the rio.reproject
+        default).
+    resolution : float or tuple of floats, optional
+        Destination cell size.
+    time_chunk : int
+        Number of time steps to reproject at a time.
+    max_workers : int, optional
+        Number of threads for processing time chunks concurrently.
+        By default, the number of cores.
+
+    Returns
+    -------
+    reprojected : xarray.DataArray
+    """
+    key = (da.rio.crs.to_wkt(), tuple(da.rio.transform()), da.rio.shape,
+           CRS.from_user_input(dst_crs).to_wkt(), resolution, resampling)
+    if key not in _reprojectors:
+        _reprojectors[key] = Reprojector(da, dst_crs, resampling=resampling,
+                                         resolution=resolution)
+    return _reprojectors[key](da, time_chunk=time_chunk,
+                              max_workers=max_workers)
+
+
+def benchmark_reproject(path, dst_crs=4269, resampling='nearest', variable='prcp'):
+    """Compare :func:`reproject` to rio.reproject, for a Daymet file.
+
+    Returns
+    -------
+    results : dict
+        Run times (in seconds) for rio.reproject, the first call
+        to :func:`reproject` (which includes computing the mapping),
+        and a repeat call, along with the maximum absolute difference
+        between the results and the fraction of values that differ
+        by more than 1e-3.
+    """
+    ds = xr.load_dataset(path)
+    ds.rio.write_crs(CRS.from_user_input(daymet_proj_string), inplace=True)
+    da = ds[variable]
+    results = {}
+    t0 = time.perf_counter()
+    expected = da.rio.reproject(dst_crs, resampling=Resampling[resampling])
+    results['rio.reproject'] = time.perf_counter() - t0
+    _reprojectors.clear()
+    for label in 'reproject (first call)', 'reproject (cached mapping)':
+        t0 = time.perf_counter()
+        reprojected = reproject(da, dst_crs, resampling=resampling)
+        results[label] = time.perf_counter() - t0
+    diffs = np.abs(reprojected.values - expected.values)
+    results['max abs difference'] = float(np.nanmax(diffs))
+    results['fraction differing'] = float(np.mean(diffs > 1e-3))
+    return results
+
+
+if __name__ == "__main__":
+
+    results = benchmark_reproject('data/xarray/daymet_prcp_rainier_1980-2018.nc')
+    for label, value in results.items():
+        print(f"{label}: {value:.4g}")
@@ -0,0 +1,248 @@
+"""Lazy, block-wise access to a stack of aligned DEMs.
+
+The rasterio notebooks read every aligned DEM into memory and
+then compute every difference and rate as a full array. That works
+for 30 m tiles, but not for 1 m lidar covering a whole volcano.
+The :class:`DEMStack` here keeps the rasters on disk, exposes them
+as a (time, y, x) array that is read in blocks, and computes
+differences, rates, hillshades and sums one block at a time.
+
+Examples
+--------
+>>> stack = DEMStack({1970: 'aligned-1970.tif', 2015: 'aligned-2015.tif'})
+>>> stack.shape
+(2, 1000, 1000)
+>>> total_change = stack.masked_sum(1970, 2015, mask=glacier_footprints == 0)
+>>> stack.write(stack.difference, 'el_change.tif', 1970, 2015)
+"""
+from pathlib import Path
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from matplotlib.colors import LightSource
+
+
+class DEMStack:
+    """Stack of aligned single-band DEMs, read lazily in blocks.
+
+    Parameters
+    ----------
+    rasters : dict
+        Raster file paths keyed by epoch (e.g. year). All rasters must
+        share the same grid (shape and transform), for example after
+        alignment with a :class:`rasterio.vrt.WarpedVRT`.
+    block_shape : tuple of ints, optional
+        (nrow, ncol) size of the blocks that are read and processed
+        at one time. By default, (1024, 1024).
+    """
+    def __init__(self, rasters, block_shape=(1024, 1024)):
+        self.rasters = {epoch: Path(f) for epoch, f in sorted(rasters.items())}
+        self.block_shape = tuple(block_shape)
+        meta = None
+        for epoch, f in self.rasters.items():
+            with rasterio.open(f) as src:
+                if meta is None:
+                    meta = src.meta.copy()
+                elif (src.shape != (meta['height'], meta['width'])) or \
+                        (src.transform != meta['transform']):
+                    raise ValueError(f"{f} is not aligned with "
+                                     f"{next(iter(self.rasters.values()))}")
+        self.meta = meta
+
+    @property
+    def epochs(self):
+        return list(self.rasters.keys())
+
+    @property
+    def shape(self):
+        """(time, y, x) shape of the stack."""
+        return len(self.rasters), self.meta['height'], self.meta['width']
+
+    @property
+    def cellsize(self):
+        return self.meta['transform'].a
+
+    def __len__(self):
+        return len(self.rasters)
+
+    def __getitem__(self, key):
+        """Read a (time, y, x) subset of the stack.
+
+        Only the requested window is read from each raster.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        tkey, rows, cols = key
+        epochs = np.array(self.epochs, dtype=object)[tkey]
+        squeeze_t = np.ndim(epochs) == 0
+        epochs = np.atleast_1d(epochs)
+        squeeze_r, squeeze_c = isinstance(rows, int), isinstance(cols, int)
+        if squeeze_r:
+            rows = slice(rows, rows + 1)
+        if squeeze_c:
+            cols = slice(cols, cols + 1)
+        r0, r1, rstep = rows.indices(self.shape[1])
+        c0, c1, cstep = cols.indices(self.shape[2])
+        window = Window.from_slices((r0, r1), (c0, c1))
+        data = np.ma.stack([self.read(e, window)[::rstep, ::cstep]
+                            for e in epochs])
+        if squeeze_c:
+            data = data[:, :, 0]
+        if squeeze_r:
+            data = data[:, 0]
+        if squeeze_t:
+            data = data[0]
+        return data
+
+    def windows(self, pad=0):
+        """Iterate over the blocks of the stack.
+
+        Parameters
+        ----------
+        pad : int, optional
+            Number of cells to pad each block with, on all sides,
+            for operations that need neighboring cells (such as
+            slope or hillshade). Padding is clipped at the raster
+            edges. By default, 0.
+
+        Yields
+        ------
+        window : rasterio.windows.Window
+            Block window, without padding.
+        padded : rasterio.windows.Window
+            Block window with padding.
+        """
+        nrow, ncol = self.shape[1:]
+        brow, bcol = self.block_shape
+        for r0 in range(0, nrow, brow):
+            for c0 in range(0, ncol, bcol):
+                window = Window.from_slices((r0, min(r0 + brow, nrow)),
+                                            (c0, min(c0 + bcol, ncol)))
+                yield window, self._pad(window, pad)
+
+    def _pad(self, window, pad):
+        """Pad a window on all sides, clipped to the raster edges."""
+        rows, cols = window.toslices()
+        nrow, ncol = self.shape[1:]
+        return Window.from_slices((max(rows.start - pad, 0), min(rows.stop + pad, nrow)),
+                                  (max(cols.start - pad, 0), min(cols.stop + pad, ncol)))
+
+    def read(self, epoch, window=None):
+        """Read a block (or all) of one epoch as a masked array."""
+        with rasterio.open(self.rasters[epoch]) as src:
+            return src.read(1, window=window, masked=True).astype(float)
+
+    def difference(self, epoch0, epoch1, window=None):
+        """Elevation change from epoch0 to epoch1, for one block."""
+        return self.read(epoch1, window) - self.read(epoch0, window)
+
+    def rate(self, epoch0, epoch1, window=None):
+        """Average annual rate of elevation change from epoch0 to epoch1,
+        for one block. Epochs are assumed to be years."""
+        return self.difference(epoch0, epoch1, window) / (epoch1 - epoch0)
+
+    def hillshade(self, epoch, window=None, azdeg=315, altdeg=45,
+                  vert_exag=1):
+        """Hillshade of one epoch, for one block.
+
+        The block is read with a one-cell pad so that the gradients
+        match those for the whole array. Unlike
+        :meth:`matplotlib.colors.LightSource.hillshade`, the illumination
+        values are not contrast-stretched to the range of each array,
+        so that adjacent blocks are shaded consistently.
+        """
+        if window is None:
+            window = Window(0, 0, self.shape[2], self.shape[1])
+        padded = self._pad(window, 1)
+        elevation = vert_exag * self.read(epoch, padded)
+        # row 0 is the north edge, so the row spacing is negative
+        # (as in LightSource.hillshade)
+        e_dy, e_dx = np.gradient(elevation.filled(np.nan),
+                                 -self.cellsize, self.cellsize)
+        normal = np.stack([-e_dx, -e_dy, np.ones_like(e_dx)], axis=-1)
+        normal /= np.sqrt(np.sum(normal**2, axis=-1))[..., np.newaxis]
+        direction = LightSource(azdeg=azdeg, altdeg=altdeg).direction
+        intensity = np.clip(normal.dot(direction), 0, 1)
+        rows, cols = window.toslices()
+        r0, c0 = rows.start - padded.row_off, cols.start - padded.col_off
+        intensity = intensity[r0:r0 + window.height, c0:c0 + window.width]
+        return np.ma.masked_invalid(intensity)
+
+    def iter_blocks(self, func, *args, **kwargs):
+        """Apply func(*args, window=window, **kwargs) to each block.
+
+        Yields
+        ------
+        window : rasterio.windows.Window
+        result : masked array
+        """
+        for window, _ in self.windows():
+            yield window, func(*args, window=window, **kwargs)
+
+    def masked_sum(self, epoch0, epoch1, mask=None, zones=None,
+                   volume=False):
+        """Sum the elevation change between two epochs, one block
+        at a time.
+
+        Parameters
+        ----------
+        epoch0, epoch1 : int
+            Epochs to difference (epoch1 - epoch0).
+        mask : 2D boolean array, optional
+            Cells to exclude (True = excluded), on the stack grid.
+            Can be a memory-mapped array.
+        zones : 2D integer array, optional
+            Zone numbers on the stack grid (for example, from
+            :func:`rasterio.features.rasterize`). If supplied, the
+            sum is computed for each non-zero zone.
+        volume : bool
+            Option to multiply the sums by the cell area, to get
+            volume change.
+
+        Returns
+        -------
+        total : float, or dict of floats keyed by zone
+        """
+        total = 0. if zones is None else {}
+        for window, _ in self.windows():
+            rows, cols = window.toslices()
+            diffs = self.difference(epoch0, epoch1, window)
+            if mask is not None:
+                diffs = np.ma.masked_array(
+                    diffs, mask=np.ma.getmaskarray(diffs) | mask[rows, cols])
+            if zones is None:
+                total += diffs.sum() if diffs.count() else 0.
+                continue
+            zn = np.asarray(zones[rows, cols])
+            valid = ~np.ma.getmaskarray(diffs) & (zn != 0)
+            sums = np.bincount(zn[valid], weights=diffs.data[valid])
+            for zone in np.flatnonzero(np.bincount(zn[valid])):
+                total[zone] = total.get(zone, 0.) + sums[zone]
+        if volume:
+            area = self.cellsize ** 2
+            if zones is None:
+                return total * area
+            return {zone: value * area for zone, value in total.items()}
+        return total
+
+    def write(self, func, outfile, *args, **kwargs):
+        """Write the result of func to a GeoTIFF, one block at a time.
+
+        Parameters
+        ----------
+        func : callable
+            Block function, such as :meth:`difference`, :meth:`rate`
+            or :meth:`hillshade`.
+        outfile : str or pathlike
+        *args, **kwargs
+            Arguments to func (for example, the epochs).
+        """
+        meta = self.meta.copy()
+        meta.update({'count': 1, 'dtype': 'float32', 'compress': 'lzw',
+                     'nodata': -9999.})
+        with rasterio.open(outfile, 'w', **meta) as dest:
+            for window, result in self.iter_blocks(func, *args, **kwargs):
+                dest.write(np.ma.filled(result.astype('float32'), -9999.),
+                           1, window=window)
+        print(f'wrote {outfile}')
@@ -0,0 +1,588 @@
+"""Fast loading of daily values from USGS water data (NWIS) tables.
+
+The pandas notebook reads the daily values CSV written from
+``waterdata.get_daily`` and converts the time column with a
+python ``strptime`` call for each row. For decades of daily data
+at many gages, that is slow, and it is repeated on every load.
+:func:`load_gage_data` parses the dates in one vectorized call,
+uses compact column dtypes, and writes a columnar (Parquet or Feather)
+copy of the table next to the CSV, which is read instead of the CSV
+as long as the CSV hasn't changed.
+
+:class:`WaterDataCache` wraps the ``waterdata`` download functions
+with a local cache, so that repeated requests (for example, a nightly
+refresh) only download the dates that aren't already cached.
+
+Examples
+--------
+>>> df = load_gage_data('data/pandas/RR_gage_data.csv')
+>>> client = WaterDataCache('waterdata_cache')
+>>> df = client.get_daily(sites, parameter_code='00060',
+...                       time='1939-09-22/2026-07-31')
+>>> series, summary = site_analytics(df, resample='MS', pdf_file='sites.pdf')
+"""
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+import hashlib
+import json
+from multiprocessing import shared_memory
+import os
+from pathlib import Path
+import tempfile
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = False
+
+
+# columns with a small number of unique values, stored as categoricals
+categorical_columns = ['monitoring_location_id', 'parameter_code',
+                       'statistic_id', 'unit_of_measure', 'approval_status',
+                       'qualifier', 'time_series_id']
+
+
+def _file_signature(path, hash_contents=False):
+    """Get the modification time and size of a file,
+    and optionally the sha256 hash of its contents."""
+    stat = os.stat(path)
+    signature = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    if hash_contents:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as src:
+            for block in iter(lambda: src.read(2**20), b''):
+                sha.update(block)
+        signature['sha256'] = sha.hexdigest()
+    return signature
+
+
+def _read_csv(csv_file, datetime_column='time', datetime_format='%Y-%m-%d'):
+    """Read a daily values CSV file, keeping the identifier columns
+    as strings (so that parameter codes such as '00060' keep their
+    leading zeros). The multithreaded pyarrow CSV reader is used
+    if pyarrow is installed, which also parses the dates."""
+    header = pd.read_csv(csv_file, nrows=0).columns
+    string_columns = [col for col in categorical_columns if col in header]
+    if pa:
+        column_types = {col: pa.string() for col in string_columns}
+        if datetime_column in header:
+            column_types[datetime_column] = pa.timestamp('ns')
+        convert_options = pa_csv.ConvertOptions(
+            column_types=column_types, timestamp_parsers=[datetime_format])
+        table = pa_csv.read_csv(csv_file, convert_options=convert_options)
+        return table.to_pandas()
+    return pd.read_csv(csv_file, dtype={col: str for col in string_columns},
+                       low_memory=False)
+
+
+def optimize_dtypes(df, datetime_column='time', datetime_format='%Y-%m-%d'):
+    """Convert a table of daily values to compact dtypes.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Daily values, as returned by ``waterdata.get_daily``,
+        or read from a CSV file.
+    datetime_column : str
+        Column with dates (as strings), parsed vectorially
+        with datetime_format. By default, 'time'.
+    datetime_format : str
+        Format of the dates (see :func:`pandas.to_datetime`).
+        By default, '%Y-%m-%d'.
+
+    Returns
+    -------
+    df : DataFrame
+        With a 'datetime' column (in place of the datetime_column
+        strings), categorical identifier columns, and float32 values.
+    """
+    df = df.copy()
+    if datetime_column in df.columns:
+        df['datetime'] = pd.to_datetime(df[datetime_column],
+                                        format=datetime_format).astype('datetime64[ns]')
+        if datetime_column != 'datetime':
+            df.drop(columns=datetime_column, inplace=True)
+    for col in categorical_columns:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    if 'value' in df.columns:
+        df['value'] = pd.to_numeric(df['value'], errors='coerce').astype(np.float32)
+    return df
+
+
+def load_gage_data(csv_file, cache_format='parquet', index_col='datetime',
+                   datetime_column='time', datetime_format='%Y-%m-%d'):
+    """Load a CSV file of daily values, using a columnar cache
+    of the parsed table if the CSV hasn't changed.
+
+    Parameters
+    ----------
+    csv_file : str or pathlike
+        Daily values CSV file (for example, written from the output
+        of ``waterdata.get_daily``).
+    cache_format : str, {'parquet', 'feather', None}
+        Format for the cached table, which is written next to the
+        CSV file with the same name (e.g. ``RR_gage_data.parquet``).
+        Both formats require pyarrow. If None, no cache is used.
+        By default, 'parquet'.
+    index_col : str or None
+        Column to set as the index. By default, 'datetime'
+        (the parsed dates).
+    datetime_column : str
+        Column with dates, by default 'time'.
+    datetime_format : str
+        Format of the dates, by default '%Y-%m-%d'.
+
+    Returns
+    -------
+    df : DataFrame
+
+    Notes
+    -----
+    The cache is used if it was written with the same datetime_column
+    and datetime_format, and if the CSV file modification time and size
+    are the same as when the cache was written, or, if they aren't,
+    if the sha256 hash of the CSV file contents is the same. The file
+    signature and the options are stored in a small JSON sidecar
+    (e.g. ``RR_gage_data.parquet.json``).
+    """
+    csv_file = Path(csv_file)
+    if cache_format is None:
+        df = _read_csv(csv_file, datetime_column, datetime_format)
+        df = optimize_dtypes(df, datetime_column, datetime_format)
+        return df.set_index(index_col) if index_col else df
+
+    suffix = {'parquet': '.parquet', 'feather': '.feather'}[cache_format]
+    cache_file = csv_file.with_suffix(suffix)
+    sidecar = Path(f'{cache_file}.json')
+    read = {'parquet': pd.read_parquet, 'feather': pd.read_feather}[cache_format]
+
+    # the cached table depends on how the dates were parsed
+    options = {'datetime_column': datetime_column,
+               'datetime_format': datetime_format}
+    signature = _file_signature(csv_file)
+    if cache_file.exists() and sidecar.exists():
+        with open(sidecar) as src:
+            cached = json.load(src)
+        same_options = all(cached.get(k) == v for k, v in options.items())
+        valid = same_options and (cached['mtime'] == signature['mtime']) and \
+            (cached['size'] == signature['size'])
+        if same_options and not valid:
+            signature = _file_signature(csv_file, hash_contents=True)
+            valid = cached.get('sha256') == signature['sha256']
+            if valid:
+                # contents are unchanged (e.g. the file was touched);
+                # update the signature so that the next check is fast
+                cached.update(signature)
+                with open(sidecar, 'w') as dest:
+                    json.dump(cached, dest, indent=2)
+        if valid:
+            df = read(cache_file)
+            return df.set_index(index_col) if index_col else df
+
+    df = _read_csv(csv_file, datetime_column, datetime_format)
+    df = optimize_dtypes(df, datetime_column, datetime_format)
+    # write the cache without an index, so that feather can store it
+    getattr(df.reset_index(drop=True), f'to_{cache_format}')(cache_file)
+    signature = _file_signature(csv_file, hash_contents=True)
+    with open(sidecar, 'w') as dest:
+        json.dump({**signature, **options}, dest, indent=2)
+    print(f'wrote {cache_file}')
+    return df.set_index(index_col) if index_col else df
+
+
+def _merge_spans(spans):
+    """Merge overlapping or adjacent (start, end) date spans."""
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1] + pd.Timedelta(days=1):
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(span) for span in merged]
+
+
+def _missing_spans(start, end, cached_spans):
+    """Get the parts of the (start, end) date span that aren't
+    covered by cached_spans."""
+    missing = []
+    for cached_start, cached_end in _merge_spans(cached_spans):
+        if cached_end < start or cached_start > end:
+            continue
+        if cached_start > start:
+            missing.append((start, cached_start - pd.Timedelta(days=1)))
+        start = max(start, cached_end + pd.Timedelta(days=1))
+    if start <= end:
+        missing.append((start, end))
+    return missing
+
+
+class WaterDataCache:
+    """Local, incremental cache for daily values and monitoring
+    location information from the USGS water data APIs.
+
+    Daily values are stored in one Parquet file for each site and
+    parameter code, along with the date spans that have been requested
+    for each. Each call to :meth:`get_daily` only downloads the
+    spans that aren't cached yet, in batched multi-site requests,
+    with a bounded number of concurrent requests.
+
+    Parameters
+    ----------
+    cache_dir : str or pathlike
+        Folder for the cached data.
+    service : object, optional
+        Object with ``get_daily`` and ``get_monitoring_locations``
+        functions that take the same arguments and return the same
+        ``(DataFrame, metadata)`` tuples as those in
+        ``dataretrieval.waterdata``. By default, the
+        ``dataretrieval.waterdata`` module. Supply a different
+        object to use a local server or test fixture instead.
+    batch_size : int
+        Maximum number of sites in each request.
+    max_workers : int
+        Maximum number of concurrent requests.
+    """
+    def __init__(self, cache_dir='waterdata_cache', service=None,
+                 batch_size=50, max_workers=4):
+        if service is None:
+            from dataretrieval import waterdata as service
+        self.service = service
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.spans_file = self.cache_dir / 'cached_spans.json'
+        self.spans = {}
+        if self.spans_file.exists():
+            with open(self.spans_file) as src:
+                spans = json.load(src)
+            self.spans = {key: [(pd.Timestamp(s), pd.Timestamp(e)) for s, e in values]
+                          for key, values in spans.items()}
+
+    def _key(self, site, parameter_code, query=None):
+        """Cache key for a site and parameter code, and the other
+        arguments to the service (e.g. statistic_id), which filter
+        what is downloaded."""
+        key = f'{site}_{parameter_code}'
+        if query:
+            query = json.dumps(query, sort_keys=True, default=str)
+            key += '_' + hashlib.sha256(query.encode()).hexdigest()[:16]
+        return key
+
+    def _data_file(self, site, parameter_code, query=None):
+        return self.cache_dir / f'{self._key(site, parameter_code, query)}.parquet'
+
+    def _save_spans(self):
+        spans = {key: [(s.strftime('%Y-%m-%d'), e.strftime('%Y-%m-%d'))
+                       for s, e in values]
+                 for key, values in self.spans.items()}
+        with open(self.spans_file, 'w') as dest:
+            json.dump(spans, dest, indent=2)
+
+    def _read(self, site, parameter_code, query=None):
+        data_file = self._data_file(site, parameter_code, query)
+        if data_file.exists():
+            return pd.read_parquet(data_file)
+
+    def _update(self, site, parameter_code, new_data, spans, query=None):
+        """Merge downloaded data for a site into the cache."""
+        cached = self._read(site, parameter_code, query)
+        if len(new_data) > 0:
+            new_data = new_data.copy()
+            new_data['time'] = pd.to_datetime(new_data['time'])
+            for col in categorical_columns:
+                if col in new_data.columns:
+                    new_data[col] = new_data[col].astype(str)
+            if cached is not None:
+                new_data = pd.concat([cached, new_data])
+                # one row for each day and statistic (e.g. mean, min, max)
+                subset = [col for col in ('time', 'statistic_id')
+                          if col in new_data.columns]
+                new_data = new_data.drop_duplicates(subset=subset, keep='last')
+            new_data.sort_values(by='time').reset_index(drop=True).to_parquet(
+                self._data_file(site, parameter_code, query))
+        key = self._key(site, parameter_code, query)
+        self.spans[key] = _merge_spans(self.spans.get(key, []) + spans)
+
+    def missing_spans(self, site, parameter_code, start, end, **kwargs):
+        """Get the date spans between start and end that
+        aren't cached for a site and parameter code (and the other
+        arguments to :meth:`get_daily`)."""
+        key = self._key(site, parameter_code, kwargs)
+        return _missing_spans(pd.Timestamp(start), pd.Timestamp(end),
+                              self.spans.get(key, []))
+
+    def get_daily(self, monitoring_location_id, parameter_code='00060',
+                  time=None, **kwargs):
+        """Get daily values for one or more sites, downloading
+        only the dates that aren't already cached.
+
+        Parameters
+        ----------
+        monitoring_location_id : str or list of str
+            Site identifiers (e.g. 'USGS-11467000').
+        parameter_code : str
+            Parameter code, by default '00060' (discharge).
+        time : str
+            Date span, as 'start/end' (e.g. '1939-09-22/2026-07-31').
+        **kwargs
+            Other arguments to the service ``get_daily`` function.
+            Data requested with different arguments (e.g. a
+            statistic_id filter) are cached separately.
+
+        Returns
+        -------
+        df : DataFrame
+            Daily values for all sites between start and end.
+        """
+        sites = monitoring_location_id
+        if isinstance(sites, str):
+            sites = [sites]
+        start, end = [pd.Timestamp(t) for t in time.split('/')]
+
+        # group the sites by the spans that they are missing,
+        # so that sites that are missing the same span are requested together
+        requests = {}
+        for site in sites:
+            for span in self.missing_spans(site, parameter_code, start, end,
+                                           **kwargs):
+                requests.setdefault(span, []).append(site)
+        batches = [(span, site_list[i:i + self.batch_size])
+                   for span, site_list in requests.items()
+                   for i in range(0, len(site_list), self.batch_size)]
+
+        def fetch(span, batch):
+            span_str = '/'.join(t.strftime('%Y-%m-%d') for t in span)
+            df, _ = self.service.get_daily(monitoring_location_id=batch,
+                                           parameter_code=parameter_code,
+                                           time=span_str, **kwargs)
+            return df
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(fetch, span, batch): (span, batch)
+                       for span, batch in batches}
+            for future in as_completed(futures):
+                span, batch = futures[future]
+                df = future.result()
+                for site in batch:
+                    site_data = df.loc[df['monitoring_location_id'] == site] \
+                        if len(df) > 0 else df
+                    self._update(site, parameter_code, site_data, [span],
+                                 kwargs)
+                self._save_spans()
+
+        dfs = []
+        for site in sites:
+            df = self._read(site, parameter_code, kwargs)
+            if df is not None:
+                dfs.append(df.loc[(df['time'] >= start) & (df['time'] <= end)])
+        if not dfs:
+            return pd.DataFrame()
+        return pd.concat(dfs, ignore_index=True)
+
+    def get_monitoring_locations(self, refresh=False, **kwargs):
+        """Get monitoring location information, from the cache if
+        the same query has been made before.
+
+        Parameters
+        ----------
+        refresh : bool
+            Option to download the information even if it is cached.
+        **kwargs
+            Arguments to the service ``get_monitoring_locations``
+            function (e.g. ``bbox``).
+
+        Returns
+        -------
+        info : DataFrame
+        """
+        query = json.dumps(kwargs, sort_keys=True, default=str)
+        key = hashlib.sha256(query.encode()).hexdigest()[:16]
+        cached = self.cache_dir / f'monitoring_locations_{key}.parquet'
+        if cached.exists() and not refresh:
+            return pd.read_parquet(cached)
+        info, _ = self.service.get_monitoring_locations(**kwargs)
+        info.to_parquet(cached)
+        return info
+
+
+# shared-memory views of the time and value arrays, set in each worker
+_shared = {}
+
+
+def _attach_shared(times_name, values_name, n):
+    """Process pool initializer: attach to the shared time and
+    value arrays (instead of pickling them to each worker)."""
+    for key, name, dtype in (('times', times_name, np.int64),
+                             ('values', values_name, np.float64)):
+        shm = shared_memory.SharedMemory(name=name)
+        _shared[f'{key}_shm'] = shm
+        _shared[key] = np.ndarray((n,), dtype=dtype, buffer=shm.buf)
+
+
+def _analyze_site(group, start, stop, resample, lowess_frac, page_file=None,
+                  pdf_dpi=100):
+    """Resample, detrend, smooth and summarize the values for one
+    site and statistic (rows start:stop of the shared arrays), and
+    optionally write a figure of them to a single-page PDF file
+    (as vector graphics)."""
+    from scipy.signal import detrend
+    from statsmodels.nonparametric.smoothers_lowess import lowess
+
+    times = pd.to_datetime(_shared['times'][start:stop])
+    series = pd.Series(_shared['values'][start:stop], index=times)
+    if resample is not None:
+        series = series.resample(resample).mean()
+    series = series.dropna()
+
+    result = pd.DataFrame({**group,
+                           'datetime': series.index,
+                           'value': series.values})
+    summary = {**group,
+               'count': len(series),
+               'start': series.index.min() if len(series) else pd.NaT,
+               'end': series.index.max() if len(series) else pd.NaT,
+               'mean': series.mean(), 'std': series.std(),
+               'min': series.min(), 'max': series.max(),
+               'trend_per_year': np.nan}
+    if len(series) > 2:
+        result['detrended'] = detrend(series.values)
+        # LOWESS on time in years, so that frac is independent of units
+        years = (series.index - series.index[0]).days.values / 365.25
+        result['lowess'] = lowess(series.values, years, frac=lowess_frac,
+                                  return_sorted=False)
+        summary['trend_per_year'] = np.polyfit(years, series.values, 1)[0]
+    else:
+        result['detrended'] = np.nan
+        result['lowess'] = np.nan
+
+    if page_file is not None:
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(11, 8.5))
+        ax = fig.subplots()
+        ax.plot(result['datetime'], result['value'], lw=0.5, label='value')
+        ax.plot(result['datetime'], result['lowess'], 'r-', lw=1.5, label='LOWESS')
+        ax.set_title(' '.join(group.values()))
+        ax.set_xlabel('date')
+        ax.legend()
+        fig.savefig(page_file, format='pdf', dpi=pdf_dpi)
+    return result, summary
+
+
+def site_analytics(df, resample='MS', lowess_frac=0.1, max_workers=None,
+                   outfile=None, pdf_file=None, pdf_dpi=100):
+    """Resample, detrend, smooth (LOWESS) and summarize the daily
+    values for each site in a long-format table, with the sites
+    processed in parallel.
+
+    The values are analyzed separately for each site, parameter code
+    and statistic (e.g. the daily mean, minimum and maximum from
+    :meth:`WaterDataCache.get_daily`). The time and value columns are
+    copied once into shared memory, which the worker processes read
+    from directly, instead of a DataFrame being pickled for each site.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Long-format daily values, with 'monitoring_location_id' and
+        'value' columns, and a 'datetime' column, a DatetimeIndex
+        or a 'time' column of dates (for example, from
+        :func:`load_gage_data` or :meth:`WaterDataCache.get_daily`).
+    resample : str, optional
+        Pandas frequency string for resampling (by mean) before
+        the analysis, by default 'MS' (monthly). If None,
+        the daily values are used.
+    lowess_frac : float
+        Fraction of the data used for each LOWESS estimate.
+    max_workers : int, optional
+        Number of worker processes. By default, the number of cores.
+    outfile : str or pathlike, optional
+        CSV or Parquet file for the tidy table of results.
+    pdf_file : str or pathlike, optional
+        PDF file with one page for each site (and statistic). Each
+        worker writes its pages as single-page PDFs (vector graphics),
+        which are then joined in site order. Requires pypdf.
+    pdf_dpi : int
+        Resolution of any rasterized parts of the PDF pages.
+
+    Returns
+    -------
+    results : DataFrame
+        Tidy table of the resampled values, detrended values and
+        LOWESS fits, with one row for each site, statistic and time.
+    summary : DataFrame
+        Summary statistics for each site and statistic.
+    """
+    if 'datetime' not in df.columns:
+        if isinstance(df.index, pd.DatetimeIndex):
+            df = df.rename_axis('datetime').reset_index()
+        elif 'time' in df.columns:
+            df = df.assign(datetime=pd.to_datetime(df['time']))
+        else:
+            raise ValueError("df needs a 'datetime' column, a DatetimeIndex "
+                             "or a 'time' column")
+    # sort by the identifier strings (not categorical order),
+    # so that each site and statistic is a contiguous block of rows
+    group_columns = [col for col in ('monitoring_location_id', 'parameter_code',
+                                     'statistic_id') if col in df.columns]
+    df = df.assign(**{col: df[col].astype(str) for col in group_columns})
+    df = df.sort_values(by=group_columns + ['datetime'])
+    keys = df[group_columns].values
+    new_group = np.ones(len(df), dtype=bool)
+    new_group[1:] = (keys[1:] != keys[:-1]).any(axis=1)
+    starts = np.flatnonzero(new_group)
+    stops = np.append(starts[1:], len(df))
+    groups = [dict(zip(group_columns, keys[start])) for start in starts]
+
+    n = len(df)
+    times = pd.to_datetime(df['datetime']).values.astype('datetime64[ns]').view(np.int64)
+    values = df['value'].values.astype(np.float64)
+    shms = []
+    pages = [None] * len(groups)
+    page_dir = None
+    if pdf_file is not None:
+        page_dir = tempfile.TemporaryDirectory(dir=Path(pdf_file).parent)
+        pages = [Path(page_dir.name, f'{i:06d}.pdf') for i in range(len(groups))]
+    try:
+        for array in times, values:
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+            shms.append(shm)
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_attach_shared,
+                                 initargs=(shms[0].name, shms[1].name, n)) as executor:
+            futures = [executor.submit(_analyze_site, group, start, stop, resample,
+                                       lowess_frac, page, pdf_dpi)
+                       for group, start, stop, page
+                       in zip(groups, starts, stops, pages)]
+            outputs = [future.result() for future in futures]
+        if pdf_file is not None:
+            from pypdf import PdfWriter
+            writer = PdfWriter()
+            for page in pages:
+                writer.append(page)
+            with open(pdf_file, 'wb') as dest:
+                writer.write(dest)
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+        if page_dir is not None:
+            page_dir.cleanup()
+
+    results = pd.concat([output[0] for output in outputs], ignore_index=True)
+    summary = pd.DataFrame([output[1] for output in outputs])
+    if outfile is not None:
+        outfile = Path(outfile)
+        if outfile.suffix == '.parquet':
+            results.to_parquet(outfile)
+        else:
+            results.to_csv(outfile, index=False)
+        print(f'wrote {outfile}')
+    if pdf_file is not None:
+        print(f'wrote {pdf_file}')
+    return results, summary
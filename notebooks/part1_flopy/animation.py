@@ -0,0 +1,275 @@
+"""Parallel rendering of map view animations of model output.
+
+The concentration animation in the GWT notebook redraws a
+:class:`flopy.plot.PlotMapView` frame by frame, in one process, so
+the render time grows with the number of frames. :class:`MapAnimation`
+draws the static parts of the figure (grid, boundary condition cells,
+head contours and colorbar) once in each worker process, then only
+updates the data of the array collection for each frame, with ranges
+of frames rendered to PNG files across a process pool. The frames
+can then be stitched into an MP4 (with ffmpeg) or GIF.
+
+Examples
+--------
+>>> ani = MapAnimation(gwt.modelgrid, 'temp/voronoi-gwt/voronoi.ucn',
+...                    head=head, contour_levels=np.linspace(0, 30, 30),
+...                    norm=colors.LogNorm(vmin=1e-3, vmax=100.),
+...                    mask_below=1e-3)
+>>> frames = ani.render('temp/frames')
+>>> ani.save('temp/voronoi-conc-animation.mp4', frames, fps=10)
+"""
+from concurrent.futures import ProcessPoolExecutor
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import numpy as np
+from binary_output import BinaryGridFile
+
+
+def _init_worker():
+    """Use the non-interactive Agg backend in the rendering workers
+    (without changing the backend in the main process)."""
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _open_frames(pngs):
+    """Open the frames one at a time, closing each file once
+    the next frame is requested."""
+    from PIL import Image
+    for png in pngs:
+        with Image.open(png) as image:
+            yield image
+
+
+class MapAnimation:
+    """Animation of model output in map view, rendered in parallel.
+
+    Parameters
+    ----------
+    modelgrid : flopy.discretization.Grid
+        Model grid (e.g. ``gwt.modelgrid``).
+    data : str, pathlike or ndarray
+        Output to animate. Either a binary output file
+        (e.g. a ``.ucn`` or ``.hds`` file), which each worker reads
+        through a :class:`binary_output.BinaryGridFile` (so that only
+        the frames it renders are read), or an array of shape
+        (ntimes, nlay, ncpl) or (ntimes, nlay, nrow, ncol).
+    times : sequence of floats, optional
+        Time of each frame, for the frame titles. By default,
+        the times in the binary output file, or the frame numbers.
+    layer : int
+        Zero-based layer to plot. By default, 0.
+    head : ndarray, optional
+        Heads to contour (static), with the same shape as one frame.
+    contour_levels : sequence of floats, optional
+        Levels for the head contours.
+    boundaries : dict, optional
+        Boundary condition cells to highlight (static), as
+        {label: (node numbers in the layer, color)}.
+    plot_grid : bool
+        Option to draw the grid lines (static). By default, True.
+    mask_below : float, optional
+        Values below this are masked, for example to hide near-zero
+        concentrations on a log color scale.
+    figsize : tuple
+        Figure size, in inches.
+    title : str
+        Format string for the frame titles, with the time as
+        the only argument. By default, "Time = {:g} days".
+    **plot_array_kwargs
+        Other keyword arguments to
+        :meth:`flopy.plot.PlotMapView.plot_array`
+        (e.g. cmap, norm, vmin, vmax).
+    """
+    def __init__(self, modelgrid, data, times=None, layer=0, head=None,
+                 contour_levels=None, boundaries=None, plot_grid=True,
+                 mask_below=None, figsize=(4, 6), title="Time = {:g} days",
+                 **plot_array_kwargs):
+        self.modelgrid = modelgrid
+        if isinstance(data, (str, Path)):
+            self.data_file = Path(data)
+            self.data = None
+            nframes = BinaryGridFile(self.data_file).shape[0]
+            if times is None:
+                times = BinaryGridFile(self.data_file).times
+        else:
+            self.data_file = None
+            self.data = np.asarray(data)
+            nframes = len(self.data)
+        if times is None:
+            times = range(nframes)
+        self.times = list(times)
+        self.layer = layer
+        self.head = head
+        self.contour_levels = contour_levels
+        self.boundaries = boundaries or {}
+        self.plot_grid = plot_grid
+        self.mask_below = mask_below
+        self.figsize = figsize
+        self.title = title
+        self.plot_array_kwargs = plot_array_kwargs
+
+    def __len__(self):
+        return len(self.times)
+
+    def _frame_data(self, source, i):
+        """Get the layer data for frame i, flattened, with
+        values below mask_below masked."""
+        if self.data_file is not None:
+            frame = source.array[i][self.layer]
+        else:
+            frame = source[i][self.layer]
+        frame = np.ma.masked_invalid(np.array(frame, dtype=float).ravel())
+        if self.mask_below is not None:
+            frame = np.ma.masked_less(frame, self.mask_below)
+        return frame
+
+    def setup_figure(self):
+        """Draw the static parts of the figure.
+
+        Returns
+        -------
+        fig : matplotlib.figure.Figure
+        collection : matplotlib.collections.Collection
+            The array collection, which is updated for each frame.
+        title : matplotlib.text.Text
+        """
+        import matplotlib.pyplot as plt
+        from matplotlib.colors import ListedColormap
+        import flopy
+
+        fig, ax = plt.subplots(figsize=self.figsize, constrained_layout=True)
+        ax.set_aspect(1)
+        ax.set_xlabel('x')
+        ax.set_ylabel('y')
+        pmv = flopy.plot.PlotMapView(modelgrid=self.modelgrid, ax=ax,
+                                     layer=self.layer)
+        if self.plot_grid:
+            pmv.plot_grid(lw=0.5, color='0.5')
+        for label, (nodes, color) in self.boundaries.items():
+            cells = np.zeros(self.modelgrid.ncpl, dtype=float)
+            cells[np.asarray(nodes)] = 1
+            pmv.plot_array(np.ma.masked_equal(cells, 0),
+                           cmap=ListedColormap([color]), zorder=3)
+        if self.head is not None:
+            pmv.contour_array(self.head, levels=self.contour_levels,
+                              tri_mask=True, linestyles='-', colors='blue',
+                              linewidths=0.5)
+        source = self.data if self.data_file is None else \
+            BinaryGridFile(self.data_file)
+        collection = pmv.plot_array(self._frame_data(source, 0),
+                                    **self.plot_array_kwargs)
+        fig.colorbar(collection, shrink=0.5)
+        title = ax.set_title(self.title.format(self.times[0]))
+        return fig, collection, title
+
+    def render_range(self, frames, outdir, dpi=100):
+        """Render a range of frames to PNG files, drawing the
+        static parts of the figure only once.
+
+        Parameters
+        ----------
+        frames : sequence of ints
+            Frame numbers to render.
+        outdir : str or pathlike
+            Folder for the PNG files.
+        dpi : int
+            Resolution of the PNG files.
+
+        Returns
+        -------
+        pngs : list of Paths
+        """
+        import matplotlib.pyplot as plt
+
+        fig, collection, title = self.setup_figure()
+        source = self.data if self.data_file is None else \
+            BinaryGridFile(self.data_file, save_index=False)
+        pngs = []
+        for i in frames:
+            collection.set_array(self._frame_data(source, i))
+            title.set_text(self.title.format(self.times[i]))
+            png = Path(outdir) / f'frame_{i:05d}.png'
+            fig.savefig(png, dpi=dpi)
+            pngs.append(png)
+        plt.close(fig)
+        return pngs
+
+    def render(self, outdir, max_workers=None, dpi=100):
+        """Render all of the frames to PNG files, with contiguous
+        ranges of frames rendered in parallel.
+
+        Parameters
+        ----------
+        outdir : str or pathlike
+            Folder for the PNG files.
+        max_workers : int, optional
+            Number of worker processes. By default, the number of cores.
+        dpi : int
+            Resolution of the PNG files.
+
+        Returns
+        -------
+        pngs : list of Paths
+            In frame order.
+        """
+        outdir = Path(outdir)
+        outdir.mkdir(parents=True, exist_ok=True)
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        max_workers = max(1, min(max_workers, len(self)))
+        ranges = np.array_split(np.arange(len(self)), max_workers)
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_init_worker) as executor:
+            results = executor.map(self.render_range, ranges,
+                                   [outdir] * len(ranges), [dpi] * len(ranges))
+            pngs = [png for result in results for png in result]
+        print(f'wrote {len(pngs)} frames to {outdir}')
+        return pngs
+
+    @staticmethod
+    def save(outfile, pngs, fps=10):
+        """Stitch rendered frames into an animation.
+
+        Parameters
+        ----------
+        outfile : str or pathlike
+            Output file. GIF files are written with Pillow (which
+            reads the frames one at a time); other formats (e.g. MP4)
+            are written with ffmpeg, which must be installed.
+        pngs : list of pathlike
+            Frames, in order, as returned by :meth:`render`.
+        fps : int
+            Frames per second.
+        """
+        outfile = Path(outfile)
+        if outfile.suffix.lower() == '.gif':
+            from PIL import Image
+            with Image.open(pngs[0]) as first:
+                first.save(outfile, save_all=True,
+                           append_images=_open_frames(pngs[1:]),
+                           duration=1000 / fps, loop=0)
+        else:
+            if shutil.which('ffmpeg') is None:
+                raise OSError("ffmpeg is needed to write "
+                              f"{outfile.suffix} files")
+            listfile = outfile.with_suffix('.frames.txt')
+            with open(listfile, 'w') as dest:
+                for png in pngs:
+                    dest.write(f"file '{Path(png).resolve()}'\n"
+                               f"duration {1 / fps}\n")
+            cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat',
+                   '-safe', '0', '-i', str(listfile), '-vf',
+                   'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p',
+                   '-r', str(fps), str(outfile)]
+            try:
+                proc = subprocess.run(cmd, capture_output=True, text=True)
+            finally:
+                listfile.unlink()
+            if proc.returncode != 0:
+                raise RuntimeError(f"ffmpeg failed writing {outfile} "
+                                   f"(exit code {proc.returncode}):\n"
+                                   f"{proc.stderr.strip()}")
+        print(f'wrote {outfile}')
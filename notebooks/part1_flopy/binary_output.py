@@ -0,0 +1,545 @@
+"""Random-access readers for large MODFLOW 6 binary output files.
+
+``gwf.output.head().get_data()`` and ``gwt.output.concentration()``
+read the binary output file sequentially, and collecting every time
+step (for example, for an animation) puts the whole file in memory.
+The readers here scan the record headers once, save that index next
+to the output file, and then read the data through a memory map,
+so that any time step can be accessed directly, with memory use
+that doesn't depend on the size of the file.
+
+Examples
+--------
+>>> hds = BinaryGridFile('model.hds')
+>>> hds.times
+>>> heads = hds.get_data(totim=hds.times[-1])
+>>> hds.array.shape  # (ntimes, nlay, ncpl), read lazily
+>>> conc = BinaryGridFile('model.ucn')
+>>> for frame in conc.iter_frames():
+...     pass
+>>> cbc = BudgetFile('model.cbc')
+>>> spdis = cbc.get_data(text='DATA-SPDIS')[0]
+>>> chd_q = cbc.get_stack('CHD')  # (ntimes, nlist) flows
+"""
+from collections import OrderedDict
+import os
+from pathlib import Path
+import numpy as np
+
+
+# MODFLOW 6 binary grid output (head, concentration, etc.) record header
+grid_header_dtype = np.dtype([('kstp', '<i4'), ('kper', '<i4'),
+                              ('pertim', '<f8'), ('totim', '<f8'),
+                              ('text', 'S16'), ('ncol', '<i4'),
+                              ('nrow', '<i4'), ('ilay', '<i4')])
+
+index_dtype = np.dtype([('kstp', '<i4'), ('kper', '<i4'),
+                        ('pertim', '<f8'), ('totim', '<f8'),
+                        ('text', 'S16'), ('ncol', '<i4'),
+                        ('nrow', '<i4'), ('ilay', '<i4'),
+                        ('offset', '<i8')])
+
+
+def _load_index(filename, suffix):
+    """Load a saved record index, if it is current with the file."""
+    index_file = Path(f'{filename}{suffix}')
+    if not index_file.exists():
+        return None
+    stat = os.stat(filename)
+    with np.load(index_file) as saved:
+        if int(saved['size']) == stat.st_size and \
+                float(saved['mtime']) == stat.st_mtime:
+            return saved['index']
+    return None
+
+
+def _save_index(filename, suffix, index):
+    """Save a record index next to the file, along with the file
+    size and modification time (for checking that it is current)."""
+    stat = os.stat(filename)
+    try:
+        with open(f'{filename}{suffix}', 'wb') as dest:
+            np.savez(dest, index=index, size=stat.st_size,
+                     mtime=stat.st_mtime)
+    except OSError:
+        # read-only location; the index will be rebuilt next time
+        pass
+
+
+class BinaryGridFile:
+    """Random-access reader for MODFLOW 6 head, concentration,
+    or other binary grid output files (``.hds``, ``.ucn``, etc.).
+
+    Parameters
+    ----------
+    filename : str or pathlike
+        Binary output file.
+    cache_size : int
+        Maximum number of decoded time steps (frames) to keep
+        in memory. By default, 16.
+    save_index : bool
+        Option to save the record index next to the file
+        (as ``<filename>.idx.npz``), so that it can be reused
+        the next time the file is opened, without scanning the file.
+        The saved index is rebuilt if the file changes.
+
+    Notes
+    -----
+    Only double precision files (the MODFLOW 6 default) are supported.
+    Each layer of a time step is stored as a separate record; for
+    DISV and DISU grids, nrow is 1 and ncol is the number of cells
+    per layer.
+    """
+    def __init__(self, filename, cache_size=16, save_index=True):
+        self.filename = Path(filename)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        index = _load_index(self.filename, '.idx.npz')
+        if index is None:
+            index = self._scan()
+            if save_index:
+                _save_index(self.filename, '.idx.npz', index)
+        self.index = index
+        self._mm = np.memmap(self.filename, dtype=np.uint8, mode='r')
+
+        self.nrow = int(index['nrow'][0])
+        self.ncol = int(index['ncol'][0])
+        self.ncpl = self.nrow * self.ncol
+        self.nlay = int(index['ilay'].max())
+        # one frame (time step) for each unique kstp, kper, totim
+        keys = index[['kper', 'kstp', 'totim']]
+        _, first, self._frame_of_record = np.unique(
+            keys, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        remap = np.empty_like(order)
+        remap[order] = np.arange(len(order))
+        self._frame_of_record = remap[self._frame_of_record.ravel()]
+        self.frames = index[np.sort(first)]
+
+    def _scan(self):
+        """Read each record header, skipping over the data,
+        to build an index of the record positions."""
+        records = []
+        size = os.path.getsize(self.filename)
+        with open(self.filename, 'rb') as src:
+            pos = 0
+            while pos < size:
+                header = np.frombuffer(src.read(grid_header_dtype.itemsize),
+                                       dtype=grid_header_dtype)[0]
+                pos += grid_header_dtype.itemsize
+                records.append(tuple(header) + (pos,))
+                pos += int(header['ncol']) * int(header['nrow']) * 8
+                src.seek(pos)
+        return np.array(records, dtype=index_dtype)
+
+    @property
+    def times(self):
+        """Simulation times (totim) of each time step."""
+        return self.frames['totim'].tolist()
+
+    @property
+    def kstpkper(self):
+        """Zero-based (kstp, kper) of each time step, as in flopy."""
+        return [(kstp - 1, kper - 1) for kstp, kper
+                in zip(self.frames['kstp'], self.frames['kper'])]
+
+    @property
+    def shape(self):
+        """(ntimes, nlay, ncpl) shape of the output."""
+        return len(self.frames), self.nlay, self.ncpl
+
+    @property
+    def array(self):
+        """All of the output, as a read-only (ntimes, nlay, ncpl) array.
+
+        If the records are evenly spaced in the file (the usual case),
+        this is a strided view into the memory map, so nothing is
+        read until it is indexed. Otherwise, a :class:`LazyFrames`
+        object is returned, which reads and caches frames as they
+        are indexed.
+        """
+        offsets = self.index['offset']
+        record_bytes = self.ncpl * 8 + grid_header_dtype.itemsize
+        uniform = len(self.index) == self.shape[0] * self.nlay and \
+            np.all(np.diff(offsets) == record_bytes) and \
+            np.all(self.index['ilay'] == np.tile(np.arange(1, self.nlay + 1),
+                                                 self.shape[0]))
+        if uniform:
+            return np.ndarray(self.shape, dtype='<f8', buffer=self._mm,
+                              offset=int(offsets[0]),
+                              strides=(self.nlay * record_bytes,
+                                       record_bytes, 8))
+        return LazyFrames(self)
+
+    def _frame(self, i):
+        """Decode one time step, using the LRU cache."""
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        frame = np.full((self.nlay, self.ncpl), np.nan)
+        for record in np.flatnonzero(self._frame_of_record == i):
+            ilay = int(self.index['ilay'][record])
+            frame[ilay - 1] = np.frombuffer(self._mm, dtype='<f8', count=self.ncpl,
+                                            offset=int(self.index['offset'][record]))
+        self._cache[i] = frame
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return frame
+
+    def _frame_number(self, idx=None, kstpkper=None, totim=None):
+        if totim is not None:
+            matches = np.flatnonzero(np.isclose(self.frames['totim'], totim))
+        elif kstpkper is not None:
+            kstp, kper = kstpkper
+            matches = np.flatnonzero((self.frames['kstp'] == kstp + 1) &
+                                     (self.frames['kper'] == kper + 1))
+        elif idx is not None:
+            return range(len(self.frames))[idx]
+        else:
+            return len(self.frames) - 1
+        if len(matches) == 0:
+            raise ValueError(f"no records found for kstpkper={kstpkper}, "
+                             f"totim={totim} in {self.filename}")
+        return int(matches[0])
+
+    def get_data(self, idx=None, kstpkper=None, totim=None):
+        """Get the output for one time step, with the same arguments
+        and (nlay, nrow, ncol) result shape as
+        :meth:`flopy.utils.HeadFile.get_data`.
+
+        Parameters
+        ----------
+        idx : int, optional
+            Zero-based time step number.
+        kstpkper : tuple of ints, optional
+            Zero-based (time step, stress period).
+        totim : float, optional
+            Simulation time.
+
+        By default, the last time step is returned.
+
+        Returns
+        -------
+        data : ndarray
+        """
+        i = self._frame_number(idx=idx, kstpkper=kstpkper, totim=totim)
+        return self._frame(i).reshape(self.nlay, self.nrow, self.ncol).copy()
+
+    def iter_frames(self, layer=None):
+        """Iterate over the time steps, reading one at a time.
+
+        Parameters
+        ----------
+        layer : int, optional
+            Zero-based layer to read. By default, all layers.
+
+        Yields
+        ------
+        totim : float
+        data : ndarray
+            (nlay, ncpl) array, or (ncpl,) if layer is specified.
+        """
+        for i, totim in enumerate(self.times):
+            frame = self._frame(i)
+            yield totim, frame if layer is None else frame[layer]
+
+    def get_ts(self, idx):
+        """Get time series for one or more cells, reading only
+        those cells from each time step.
+
+        Parameters
+        ----------
+        idx : tuple or list of tuples
+            Zero-based (layer, cell) or (layer, row, column) location(s).
+
+        Returns
+        -------
+        ts : ndarray
+            Array of shape (ntimes, 1 + n cells), with the
+            times in the first column, as in flopy.
+        """
+        if isinstance(idx, tuple):
+            idx = [idx]
+        ts = np.empty((len(self.frames), len(idx) + 1))
+        ts[:, 0] = self.times
+        array = self.array
+        for j, cellid in enumerate(idx):
+            layer, cell = cellid[0], cellid[-1]
+            if len(cellid) == 3:
+                cell = cellid[1] * self.ncol + cellid[2]
+            if isinstance(array, np.ndarray):
+                ts[:, j + 1] = array[:, layer, cell]
+            else:
+                for i in range(len(self.frames)):
+                    ts[i, j + 1] = array[i][layer, cell]
+        return ts
+
+
+class LazyFrames:
+    """(ntimes, nlay, ncpl) array-like over a :class:`BinaryGridFile`,
+    for files with unevenly spaced records (for example, with only
+    some layers saved at some times). Frames are read and cached
+    as they are indexed."""
+    def __init__(self, binary_file):
+        self.binary_file = binary_file
+        self.shape = binary_file.shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        times = range(self.shape[0])[key[0]]
+        if isinstance(times, int):
+            return self.binary_file._frame(times)[key[1:]]
+        return np.stack([self.binary_file._frame(i)[key[1:]] for i in times])
+
+
+# MODFLOW 6 cell-by-cell budget file headers
+budget_header_dtype = np.dtype([('kstp', '<i4'), ('kper', '<i4'),
+                                ('text', 'S16'), ('ndim1', '<i4'),
+                                ('ndim2', '<i4'), ('ndim3', '<i4')])
+budget_header2_dtype = np.dtype([('imeth', '<i4'), ('delt', '<f8'),
+                                 ('pertim', '<f8'), ('totim', '<f8')])
+budget_index_dtype = np.dtype([('kstp', '<i4'), ('kper', '<i4'),
+                               ('text', 'S16'), ('ndim1', '<i4'),
+                               ('ndim2', '<i4'), ('ndim3', '<i4'),
+                               ('imeth', '<i4'), ('delt', '<f8'),
+                               ('pertim', '<f8'), ('totim', '<f8'),
+                               ('modelnam', 'S16'), ('paknam', 'S16'),
+                               ('modelnam2', 'S16'), ('paknam2', 'S16'),
+                               ('ndat', '<i4'), ('auxtxt', 'S160'),
+                               ('nlist', '<i8'), ('offset', '<i8')])
+
+
+class BudgetFile:
+    """Indexed, random-access reader for MODFLOW 6 cell-by-cell
+    budget files (``.cbc``).
+
+    The file is scanned once to build an index of every record
+    (text, kstp, kper, imeth, shape and byte offset), which is saved
+    next to the file (as ``<filename>.idx.npz``) and reused as long as
+    the file doesn't change. Records are then returned as read-only
+    views into a memory map of the file, without reading the file
+    sequentially.
+
+    Parameters
+    ----------
+    filename : str or pathlike
+        Budget file.
+    save_index : bool
+        Option to save the record index next to the file.
+
+    Notes
+    -----
+    Only double precision files are supported, with records written
+    as full arrays (imeth 0 or 1, such as FLOW-JA-FACE) or as lists
+    (imeth 6, such as DATA-SPDIS or boundary condition flows),
+    which is how MODFLOW 6 writes them.
+    """
+    def __init__(self, filename, save_index=True):
+        self.filename = Path(filename)
+        index = _load_index(self.filename, '.idx.npz')
+        if index is None:
+            index = self._scan()
+            if save_index:
+                _save_index(self.filename, '.idx.npz', index)
+        self.index = index
+        self._mm = np.memmap(self.filename, dtype=np.uint8, mode='r')
+        self._text = np.char.strip(index['text'])
+        self._paknam2 = np.char.strip(index['paknam2'])
+
+    def _scan(self):
+        """Read each record header, skipping over the data,
+        to build an index of the record positions."""
+        records = []
+        size = os.path.getsize(self.filename)
+        with open(self.filename, 'rb') as src:
+            pos = 0
+            while pos < size:
+                h1 = np.frombuffer(src.read(budget_header_dtype.itemsize),
+                                   dtype=budget_header_dtype)[0]
+                ndim1, ndim2, ndim3 = int(h1['ndim1']), int(h1['ndim2']), int(h1['ndim3'])
+                names = [b''] * 4
+                ndat, auxtxt, nlist = 0, b'', 0
+                if ndim3 > 0:
+                    imeth, delt, pertim, totim = 0, 0., -1., -1.
+                else:
+                    h2 = np.frombuffer(src.read(budget_header2_dtype.itemsize),
+                                       dtype=budget_header2_dtype)[0]
+                    imeth, delt, pertim, totim = h2.tolist()
+                if imeth in (0, 1):
+                    nlist = ndim1 * ndim2 * abs(ndim3)
+                    nbytes = nlist * 8
+                elif imeth == 6:
+                    names = [src.read(16) for _ in range(4)]
+                    ndat = int(np.frombuffer(src.read(4), dtype='<i4')[0])
+                    auxtxt = src.read(16 * (ndat - 1))
+                    nlist = int(np.frombuffer(src.read(4), dtype='<i4')[0])
+                    nbytes = nlist * (8 + 8 * ndat)
+                else:
+                    raise NotImplementedError(
+                        f"imeth={imeth} records are not supported "
+                        f"({h1['text'].decode().strip()} in {self.filename})")
+                offset = src.tell()
+                records.append((h1['kstp'], h1['kper'], h1['text'],
+                                ndim1, ndim2, ndim3, imeth, delt, pertim, totim,
+                                *names, ndat, auxtxt, nlist, offset))
+                pos = offset + nbytes
+                src.seek(pos)
+        return np.array(records, dtype=budget_index_dtype)
+
+    def list_unique_records(self):
+        """Get the unique record names and imeth values.
+
+        Returns
+        -------
+        records : list of tuples
+            (text, imeth) for each unique record, in file order.
+        """
+        seen = {}
+        for text, imeth in zip(self._text, self.index['imeth']):
+            seen.setdefault(text.decode(), int(imeth))
+        return list(seen.items())
+
+    @property
+    def times(self):
+        """Unique simulation times in the file."""
+        return np.unique(self.index['totim']).tolist()
+
+    @property
+    def kstpkper(self):
+        """Unique zero-based (kstp, kper) in the file, as in flopy."""
+        pairs = np.unique(self.index[['kper', 'kstp']])
+        return [(int(kstp) - 1, int(kper) - 1) for kper, kstp in pairs]
+
+    def _dtype(self, record):
+        """numpy dtype for the list (imeth 6) data in a record."""
+        ndat = int(self.index['ndat'][record])
+        auxtxt = self.index['auxtxt'][record]
+        aux = [auxtxt[i * 16:(i + 1) * 16].decode().strip().lower()
+               for i in range(ndat - 1)]
+        return np.dtype([('node', '<i4'), ('node2', '<i4'), ('q', '<f8')] +
+                        [(name, '<f8') for name in aux])
+
+    def get_record(self, record):
+        """Get the data for one record, by its position in the index.
+
+        Returns
+        -------
+        data : ndarray or numpy.recarray
+            A read-only view into the memory-mapped file. Full-array
+            records have shape (abs(ndim3), ndim2, ndim1), as in flopy;
+            list records are record arrays with node, node2, q and any
+            auxiliary fields.
+        """
+        header = self.index[record]
+        offset = int(header['offset'])
+        if header['imeth'] in (0, 1):
+            shape = (abs(int(header['ndim3'])), int(header['ndim2']),
+                     int(header['ndim1']))
+            return np.ndarray(shape, dtype='<f8', buffer=self._mm, offset=offset)
+        dtype = self._dtype(record)
+        return np.ndarray((int(header['nlist']),), dtype=dtype, buffer=self._mm,
+                          offset=offset).view(np.recarray)
+
+    def find(self, text=None, kstpkper=None, totim=None, paknam=None):
+        """Get the index positions of the records matching text
+        and (optionally) a time and package name.
+
+        Parameters
+        ----------
+        text : str, optional
+            Record name (e.g. 'DATA-SPDIS', 'CHD'). Case-insensitive.
+        kstpkper : tuple of ints, optional
+            Zero-based (time step, stress period).
+        totim : float, optional
+            Simulation time.
+        paknam : str, optional
+            Package name (e.g. 'CHD_0'), to select among packages
+            that write records with the same text.
+
+        Returns
+        -------
+        records : 1D integer array
+        """
+        match = np.ones(len(self.index), dtype=bool)
+        if text is not None:
+            match &= self._text == text.upper().encode()
+        if kstpkper is not None:
+            match &= (self.index['kstp'] == kstpkper[0] + 1) & \
+                (self.index['kper'] == kstpkper[1] + 1)
+        if totim is not None:
+            match &= np.isclose(self.index['totim'], totim)
+        if paknam is not None:
+            match &= self._paknam2 == paknam.upper().encode()
+        return np.flatnonzero(match)
+
+    def get_data(self, text=None, kstpkper=None, totim=None, paknam=None,
+                 idx=None):
+        """Get the data for matching records, with arguments and results
+        like :meth:`flopy.utils.CellBudgetFile.get_data`.
+
+        Returns
+        -------
+        data : list
+            Read-only views of the data for each matching record.
+        """
+        if idx is not None:
+            return [self.get_record(i) for i in np.atleast_1d(idx)]
+        return [self.get_record(i) for i in
+                self.find(text, kstpkper=kstpkper, totim=totim, paknam=paknam)]
+
+    def get_stack(self, text, field='q', paknam=None):
+        """Get the same record at all times, as one stacked array,
+        for flow budget time series.
+
+        Parameters
+        ----------
+        text : str
+            Record name (e.g. 'CHD', 'FLOW-JA-FACE').
+        field : str
+            Field to get from list (imeth 6) records,
+            by default 'q' (the flow rate).
+        paknam : str, optional
+            Package name, if more than one package
+            writes records with text.
+
+        Returns
+        -------
+        totim : 1D array
+            Simulation time of each record.
+        stack : ndarray
+            (ntimes, n) array, where n is the array size or
+            number of list entries. If the records are evenly spaced
+            in the file, this is a strided view into the memory map;
+            otherwise the records are copied into a new array.
+        """
+        records = self.find(text, paknam=paknam)
+        if len(records) == 0:
+            raise ValueError(f"no {text} records in {self.filename}")
+        nlist = self.index['nlist'][records]
+        if not np.all(nlist == nlist[0]):
+            raise ValueError(f"{text} records have different lengths at "
+                             "different times; use get_data() instead")
+        totim = self.index['totim'][records]
+        first = self.get_record(records[0])
+        offsets = self.index['offset'][records]
+        steps = np.diff(offsets)
+        if first.dtype.names is None:
+            first = first.ravel()
+            if len(records) == 1 or np.all(steps == steps[0]):
+                stride = int(steps[0]) if len(steps) else 0
+                return totim, np.ndarray((len(records), len(first)), dtype='<f8',
+                                         buffer=self._mm, offset=int(offsets[0]),
+                                         strides=(stride, 8))
+            return totim, np.stack([self.get_record(i).ravel() for i in records])
+        if len(records) == 1 or np.all(steps == steps[0]):
+            stride = int(steps[0]) if len(steps) else 0
+            field_offset = first.dtype.fields[field][1]
+            return totim, np.ndarray((len(records), len(first)), dtype='<f8',
+                                     buffer=self._mm,
+                                     offset=int(offsets[0]) + field_offset,
+                                     strides=(stride, first.dtype.itemsize))
+        return totim, np.stack([self.get_record(i)[field] for i in records])
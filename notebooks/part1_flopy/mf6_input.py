@@ -0,0 +1,876 @@
+"""Utilities for working with MODFLOW 6 input files directly,
+without loading the simulation with flopy.
+
+The PRT notebook adds an ``iflowface`` auxiliary variable to the SFR
+package by parsing the package file line by line; the alternative is
+loading the whole simulation (and copying the model) just to change
+one column. :class:`PackagePatcher` makes these kinds of edits in one
+pass through the package file (and any external files that are
+edited), one line at a time, so that the same edits can be scripted
+across many model versions:
+
+* setting, changing or removing OPTIONS entries
+* adding auxiliary variables (with the columns in the PACKAGEDATA
+  or PERIOD blocks), or adding or replacing other list columns
+* rewriting the paths of OPEN/CLOSE external files
+
+Loading packages with large stress period lists (or many stress
+periods) through flopy is dominated by parsing the text input.
+:func:`read_lists` and :func:`read_arrays` read the list and array
+input of a package (inline, or in OPEN/CLOSE external files) with
+C parsers (pandas and numpy) directly into numpy (record) arrays,
+keyed by stress period. With a ``cache_dir``, each external file is
+converted to a ``.npy`` file on the first read (listed in a JSON
+sidecar, with the size and modification time of the source file),
+and later reads memory-map the ``.npy`` file instead of parsing
+the text again.
+
+Examples
+--------
+>>> patcher = PackagePatcher('data/pleasant-lake/pleasant.sfr')
+>>> patcher.add_auxiliary('iflowface', -1)
+>>> patcher.set_option('print_stage')
+>>> patcher.write('temp/pleasant/pleasant.sfr')
+>>> chd = read_lists('data/pleasant-lake/pleasant.chd', cache_dir='cache')
+>>> chd[0][['k', 'i', 'j', 'head']]
+>>> npf = read_arrays('data/pleasant-lake/pleasant.npf', cache_dir='cache')
+>>> npf['k'].shape  # (nlay, nrow, ncol)
+"""
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+
+
+# packages with auxiliary variables in the PACKAGEDATA block
+# (for the others, they are in the PERIOD block lists)
+packagedata_aux_packages = {'sfr', 'lak', 'maw', 'uzf', 'sft', 'lkt',
+                            'mwt', 'uzt', 'sfe', 'lke', 'mwe', 'uze'}
+
+# columns before and after the cellid in the list input
+# of the standard boundary packages and some advanced package blocks
+list_columns = {
+    ('chd', 'period'): ([], ['head']),
+    ('wel', 'period'): ([], ['q']),
+    ('drn', 'period'): ([], ['elev', 'cond']),
+    ('ghb', 'period'): ([], ['bhead', 'cond']),
+    ('riv', 'period'): ([], ['stage', 'cond', 'rbot']),
+    ('rch', 'period'): ([], ['recharge']),
+    ('evt', 'period'): ([], ['surface', 'rate', 'depth']),
+    ('cnc', 'period'): ([], ['conc']),
+    ('src', 'period'): ([], ['smassrate']),
+    ('sfr', 'packagedata'): (['ifno'], ['rlen', 'rwid', 'rgrd', 'rtp', 'rbth',
+                                        'rhk', 'man', 'ncon', 'ustrf',
+                                        'ndv']),
+    ('lak', 'packagedata'): (['ifno'], ['strt', 'nlakeconn']),
+    ('lak', 'connectiondata'): (['ifno', 'iconn'],
+                                ['claktype', 'bedleak', 'belev', 'telev',
+                                 'connlen', 'connwidth']),
+}
+
+# names of the cellid columns, by the number of cellid columns
+cellid_columns = {3: ['k', 'i', 'j'], 2: ['k', 'cell2d'], 1: ['node'],
+                  0: []}
+_cellid_names = {'k', 'i', 'j', 'cell2d', 'node'}
+_none = re.compile(r'(?i)\bnone\b')
+
+# tokens, with quoted strings (e.g. boundnames with spaces) kept whole
+_token = re.compile(r"'[^']*'|\"[^\"]*\"|\S+")
+
+# comments in array input, and Fortran double precision exponents
+_comment = re.compile(r'(#|!|//).*')
+_fortran_exponent = re.compile(r'(?<=[0-9.])[dD](?=[+-]?[0-9])')
+
+
+def split_line(line):
+    """Split a line of MODFLOW 6 input into tokens,
+    keeping quoted strings together."""
+    return _token.findall(line)
+
+
+def _split_comment(line):
+    """Split a line of MODFLOW 6 input into its tokens and any
+    trailing comment (from a token starting with #, ! or //,
+    with the whitespace before it)."""
+    tokens = []
+    for match in _token.finditer(line):
+        if _is_comment(match.group()):
+            end = match.start()
+            while end > 0 and line[end - 1] in ' \t':
+                end -= 1
+            return tokens, line[end:].rstrip('\r\n')
+        tokens.append(match.group())
+    return tokens, ''
+
+
+def _column_values(values):
+    """Make a function that returns the value for a row,
+    from a scalar, a sequence (in row order within each block)
+    or a function of the row tokens."""
+    if callable(values):
+        return lambda tokens, i: values(tokens)
+    if isinstance(values, (str, int, float)):
+        return lambda tokens, i: values
+    return lambda tokens, i: values[i]
+
+
+class PackagePatcher:
+    """Edit a MODFLOW 6 package file in one pass, without loading it.
+
+    Edits are specified with the methods below, and then applied
+    with :meth:`write`.
+
+    Parameters
+    ----------
+    filename : str or pathlike
+        Package file.
+    sim_ws : str or pathlike, optional
+        Simulation workspace that the OPEN/CLOSE paths are relative
+        to. By default, the folder containing the package file.
+    """
+    def __init__(self, filename, sim_ws=None):
+        self.filename = Path(filename)
+        self.sim_ws = Path(sim_ws) if sim_ws is not None \
+            else self.filename.parent
+        self.package = self.filename.suffix.lstrip('.').lower()
+        self.options = {}
+        self.auxiliary = {}
+        self.columns = []
+        self.external = None
+
+    def set_option(self, name, value=True):
+        """Set an OPTIONS block entry, replacing any existing entry
+        with the same name (first word).
+
+        Parameters
+        ----------
+        name : str
+            Option name, e.g. 'save_flows' or 'unit_conversion'.
+        value : True, scalar or sequence
+            True for a keyword option, otherwise the value(s) written
+            after the name, e.g. ``('fileout', 'model.sfr.cbc')``.
+        """
+        self.options[name.lower()] = value
+
+    def remove_option(self, name):
+        """Remove an OPTIONS block entry, if present."""
+        self.options[name.lower()] = None
+
+    def add_auxiliary(self, name, values, blocks=None):
+        """Add an auxiliary variable, to the OPTIONS block
+        and as a column (before any boundnames) in the list blocks.
+        If the package already has the auxiliary variable,
+        its values are replaced.
+
+        Parameters
+        ----------
+        name : str
+            Auxiliary variable name, e.g. 'iflowface'.
+        values : scalar, sequence or callable
+            Values for the rows. A scalar for all rows, a sequence
+            with one value per row (in the order of the rows in each
+            block), or a function that takes the row (as a list of
+            string tokens) and returns the value.
+        blocks : sequence of str, optional
+            Blocks with the auxiliary columns. By default, 'packagedata'
+            for the advanced packages (SFR, LAK, MAW, UZF, etc.),
+            and 'period' for the others.
+        """
+        if blocks is None:
+            blocks = ['packagedata'] if self.package in packagedata_aux_packages \
+                else ['period']
+        self.auxiliary[name.lower()] = ([b.lower() for b in blocks],
+                                        _column_values(values))
+
+    def set_column(self, block, column, values):
+        """Replace the values in a column of a list block.
+
+        Parameters
+        ----------
+        block : str
+            Block name, e.g. 'packagedata' or 'period' (all periods).
+        column : int or str
+            Zero-based position of the column in the rows (negative
+            positions count from the end), or the name of an
+            auxiliary variable.
+        values : scalar, sequence or callable
+            See :meth:`add_auxiliary`.
+        """
+        self.columns.append((block.lower(), column, _column_values(values)))
+
+    def rewrite_external(self, paths):
+        """Rewrite the OPEN/CLOSE file paths.
+
+        Parameters
+        ----------
+        paths : dict or callable
+            Mapping of the existing paths (as written in the file)
+            to new paths, or a function that takes an existing path
+            and returns the new path. Paths that aren't in the mapping
+            are left as is. External files with edited columns are
+            written to the new paths; otherwise the files are
+            only referenced there.
+        """
+        if callable(paths):
+            self.external = paths
+        else:
+            self.external = lambda path: paths.get(path, path)
+
+    def write(self, outfile=None):
+        """Apply the edits and write the package file.
+
+        Parameters
+        ----------
+        outfile : str or pathlike, optional
+            Output package file. External files with edited columns
+            are written relative to the same folder (other external
+            files aren't copied). By default, the package file
+            (and external files) are edited in place.
+        """
+        outfile = Path(outfile) if outfile is not None else self.filename
+        outfile.parent.mkdir(parents=True, exist_ok=True)
+        out_ws = outfile.parent if outfile != self.filename else self.sim_ws
+        with open(self.filename) as src, \
+                _AtomicWriter(outfile) as dest:
+            self._patch(src, dest, out_ws)
+
+    def _patch(self, src, dest, out_ws):
+        block = None
+        options_block = False
+        options_written = set()
+        # auxiliary variables and boundnames in the original file
+        aux_names = []
+        boundnames = False
+        edits = None
+        row = 0
+        for line in src:
+            tokens, comment = _split_comment(line)
+            keyword = tokens[0].lower() if tokens else ''
+            if keyword == 'begin':
+                block = tokens[1].lower()
+                if block == 'options':
+                    options_block = True
+                elif not options_block:
+                    # no OPTIONS block (which comes first); add one
+                    # for the new options
+                    new = list(self._new_options(options_written))
+                    if new:
+                        dest.write('BEGIN OPTIONS\n' + ''.join(new)
+                                   + 'END OPTIONS\n\n')
+                    options_block = True
+                edits = self._block_edits(block, aux_names, boundnames)
+                row = 0
+            elif keyword == 'end':
+                if block == 'options':
+                    for text in self._new_options(options_written):
+                        dest.write(text)
+                block = None
+                edits = None
+            elif block == 'options' and keyword:
+                if keyword == 'boundnames':
+                    boundnames = True
+                if keyword in ('auxiliary', 'aux'):
+                    aux_names += [t.lower() for t in tokens[1:]]
+                    new = [name for name in self.auxiliary
+                           if name not in aux_names]
+                    if new:
+                        indent = line[:len(line) - len(line.lstrip())]
+                        line = (f"{indent}{'  '.join(tokens + new)}"
+                                f"{comment}\n")
+                    options_written.add('auxiliary')
+                elif keyword in self.options:
+                    options_written.add(keyword)
+                    line = self._option_line(keyword)
+                    if line is None:
+                        continue
+            elif keyword == 'open/close':
+                line = self._open_close(tokens, edits, out_ws, line)
+            elif edits is not None and keyword:
+                line = f"  {' '.join(edits(tokens, row))}{comment}\n"
+                row += 1
+            dest.write(line)
+
+    def _new_options(self, options_written):
+        """Lines for the options that weren't already in the file."""
+        if self.auxiliary and 'auxiliary' not in options_written:
+            yield f"  AUXILIARY  {'  '.join(self.auxiliary)}\n"
+        for name in self.options:
+            if name not in options_written:
+                line = self._option_line(name)
+                if line is not None:
+                    yield line
+
+    def _option_line(self, name):
+        value = self.options[name]
+        if value is None or value is False:
+            return None
+        if value is True:
+            return f"  {name.upper()}\n"
+        if isinstance(value, (list, tuple)):
+            value = '  '.join(str(v) for v in value)
+        return f"  {name.upper()}  {value}\n"
+
+    def _block_edits(self, block, aux_names, boundnames):
+        """Make a function that edits the rows of a list block,
+        or return None if there are no edits to the block."""
+        replace = [(column, values) for b, column, values in self.columns
+                   if b == block]
+        for name, (blocks, values) in self.auxiliary.items():
+            if block in blocks and name in aux_names:
+                replace.append((name, values))
+        insert = [values for name, (blocks, values) in self.auxiliary.items()
+                  if block in blocks and name not in aux_names]
+        if not replace and not insert:
+            return None
+        aux_existing = list(aux_names)
+        nend = 1 if boundnames else 0
+
+        def edit(tokens, row):
+            # first auxiliary column (after the standard columns)
+            aux_start = len(tokens) - nend - len(aux_existing)
+            tokens = list(tokens)
+            for column, values in replace:
+                if isinstance(column, str):
+                    column = aux_start + aux_existing.index(column.lower())
+                tokens[column] = str(values(tokens, row))
+            new = [str(values(tokens, row)) for values in insert]
+            position = len(tokens) - nend
+            return tokens[:position] + new + tokens[position:]
+        return edit
+
+    def _open_close(self, tokens, edits, out_ws, line):
+        """Rewrite an OPEN/CLOSE line, and the external file,
+        if it has edits."""
+        path = tokens[1].strip('\'"')
+        new_path = self.external(path) if self.external is not None else path
+        if edits is not None:
+            with open(self.sim_ws / path) as src, \
+                    _AtomicWriter(out_ws / new_path) as dest:
+                row = 0
+                for ext_line in src:
+                    ext_tokens, comment = _split_comment(ext_line)
+                    if not ext_tokens:
+                        dest.write(ext_line)
+                        continue
+                    dest.write(f"{' '.join(edits(ext_tokens, row))}"
+                               f"{comment}\n")
+                    row += 1
+        if new_path == path:
+            return line
+        quote = "'" if tokens[1][0] in '\'"' else ''
+        return line.replace(tokens[1], f"{quote}{new_path}{quote}", 1)
+
+
+class _AtomicWriter:
+    """Write a file through a temporary file in the same folder, which
+    replaces the file when it is complete (so that a file can be
+    rewritten while it is being read)."""
+    def __init__(self, filename):
+        self.filename = Path(filename)
+
+    def __enter__(self):
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        fd, self.tmpfile = tempfile.mkstemp(dir=self.filename.parent,
+                                            prefix=f'.{self.filename.name}')
+        self.file = os.fdopen(fd, 'w')
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is None:
+            if self.filename.exists():
+                shutil.copymode(self.filename, self.tmpfile)
+            os.replace(self.tmpfile, self.filename)
+        else:
+            os.remove(self.tmpfile)
+
+
+def _is_comment(token):
+    return token.startswith(('#', '!', '//'))
+
+
+def read_array(filename, dtype=float):
+    """Read a MODFLOW 6 external array file (whitespace-delimited
+    values, in any number of lines) into a 1D array, with numpy's
+    C parser.
+
+    Comments (whole lines, or at the end of lines), Fortran ``D``
+    exponents (e.g. ``1.0D-3``) and repeat counts (e.g. ``3*1.0``)
+    are handled; binary files (``OPEN/CLOSE ... (BINARY)``)
+    aren't supported.
+
+    Parameters
+    ----------
+    filename : str or pathlike
+    dtype : numpy dtype
+        By default, float.
+
+    Returns
+    -------
+    array : ndarray
+
+    Raises
+    ------
+    ValueError
+        If any of the values can't be parsed.
+    """
+    with open(filename) as src:
+        text = src.read()
+    return _parse_values(text, filename).astype(dtype, copy=False)
+
+
+def _parse_values(text, source):
+    """Parse whitespace-delimited array values."""
+    if '#' in text or '!' in text or '//' in text:
+        text = _comment.sub('', text)
+    if 'd' in text or 'D' in text:
+        text = _fortran_exponent.sub('e', text)
+    if '*' in text:
+        values = []
+        for token in text.split():
+            count, _, value = token.rpartition('*')
+            values += [value] * (int(count) if count else 1)
+        text = ' '.join(values)
+    # older versions of numpy stop at the first value they can't
+    # parse, with a DeprecationWarning (newer versions raise an error)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return np.fromstring(text, sep=' ')
+        except (DeprecationWarning, ValueError):
+            raise ValueError(f'could not parse the values in {source}') from None
+
+
+def read_list(filename, names, dtypes=None):
+    """Read a MODFLOW 6 list (e.g. an external stress period file)
+    into a record array, with the pandas C parser.
+
+    Parameters
+    ----------
+    filename : str, pathlike or file-like
+    names : list of str
+        Column names. Rows with fewer values than columns
+        (e.g. missing boundnames) are padded. ``NONE`` cellids
+        (e.g. for SFR reaches that aren't connected to the model)
+        are read as cellids of 0 in all of the cellid columns.
+    dtypes : dict, optional
+        {column name: dtype}. By default, the cellid columns
+        are integers, boundnames are strings, and the other
+        columns are floats (or strings, if they have time
+        series names).
+
+    Returns
+    -------
+    records : numpy.recarray
+        Values as written in the file (with one-based cellids).
+    """
+    dtypes = {**_default_dtypes(names), **(dtypes or {})}
+    kwargs = dict(sep=r'\s+', header=None, names=names, comment='#',
+                  quotechar="'", engine='c')
+    cellid = [i for i, name in enumerate(names) if name in _cellid_names]
+    if cellid:
+        if hasattr(filename, 'read'):
+            text = filename.read()
+        else:
+            with open(filename) as src:
+                text = src.read()
+        if _none.search(text):
+            text = _expand_none(text, cellid[0], len(cellid))
+        filename = io.StringIO(text)
+    if hasattr(filename, 'seek'):
+        start = filename.tell()
+    try:
+        df = pd.read_csv(filename, dtype={name: dtype if dtype is not str
+                                          else object
+                                          for name, dtype in dtypes.items()},
+                         **kwargs)
+    except (ValueError, TypeError):
+        # time series names, or missing values in numeric columns;
+        # read as strings, and convert the columns that are numbers
+        if hasattr(filename, 'seek'):
+            filename.seek(start)
+        df = pd.read_csv(filename, dtype=str, na_filter=False, **kwargs)
+    columns = {}
+    for name in names:
+        values = df[name]
+        dtype = np.dtype(dtypes[name])
+        if values.dtype == dtype:
+            columns[name] = values.to_numpy()
+            continue
+        if dtype.kind in 'iuf':
+            try:
+                columns[name] = values.to_numpy(dtype=float).astype(dtype)
+                continue
+            except (ValueError, TypeError):
+                pass
+        columns[name] = values.fillna('').to_numpy(dtype=str)
+    return np.rec.fromarrays(list(columns.values()), names=names)
+
+
+def _expand_none(text, start, ncellid):
+    """Replace NONE cellids (at token start in each line)
+    with a 0 for each of the cellid columns."""
+    lines = []
+    for line in text.splitlines():
+        tokens, comment = _split_comment(line)
+        if len(tokens) > start and tokens[start].lower() == 'none':
+            tokens[start:start + 1] = ['0'] * ncellid
+            line = ' '.join(tokens) + comment
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def _default_dtypes(names):
+    dtypes = {}
+    for name in names:
+        if name in ('k', 'i', 'j', 'cell2d', 'node', 'ifno', 'iconn', 'ncon',
+                    'ndv', 'nlakeconn', 'iflowface'):
+            dtypes[name] = np.int32
+        elif name == 'boundname':
+            dtypes[name] = str
+        else:
+            dtypes[name] = float
+    return dtypes
+
+
+def _cache_key(filename):
+    path = Path(filename).resolve()
+    digest = hashlib.sha1(str(path).encode()).hexdigest()[:10]
+    return f'{path.stem}-{digest}.npy'
+
+
+def _cached(filename, reader, cache_dir, **kwargs):
+    """Read an external file through a ``.npy`` cache.
+
+    The cache folder has a sidecar (``external_files.json``) that maps
+    each source file to its ``.npy`` file, along with the size and
+    modification time of the source, and the reader options (for
+    checking that the cached copy is current). Current copies
+    are memory-mapped.
+    """
+    if cache_dir is None:
+        return reader(filename, **kwargs)
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    sidecar = cache_dir / 'external_files.json'
+    mapping = {}
+    if sidecar.exists():
+        with open(sidecar) as src:
+            mapping = json.load(src)
+    source = str(Path(filename).resolve())
+    stat = os.stat(filename)
+    # how the file was read (e.g. the list column names)
+    options = json.dumps(kwargs, sort_keys=True, default=str)
+    entry = mapping.get(source)
+    if entry is not None and entry['size'] == stat.st_size and \
+            entry['mtime'] == stat.st_mtime and \
+            entry['options'] == options and \
+            (cache_dir / entry['file']).exists():
+        return np.load(cache_dir / entry['file'], mmap_mode='r')
+    array = reader(filename, **kwargs)
+    npy = _cache_key(filename)
+    np.save(cache_dir / npy, np.asarray(array), allow_pickle=False)
+    mapping[source] = {'file': npy, 'size': stat.st_size,
+                       'mtime': stat.st_mtime, 'options': options}
+    with open(sidecar, 'w') as dest:
+        json.dump(mapping, dest, indent=2)
+    return np.load(cache_dir / npy, mmap_mode='r')
+
+
+def _package_options(lines):
+    """Get the auxiliary variable names and boundnames option
+    from the OPTIONS block lines of a package."""
+    aux_names = []
+    boundnames = False
+    for tokens in lines:
+        keyword = tokens[0].lower()
+        if keyword in ('auxiliary', 'aux'):
+            aux_names += tokens[1:]
+        elif keyword == 'boundnames':
+            boundnames = True
+    return aux_names, boundnames
+
+
+def _iter_blocks(package_file):
+    """Iterate over the blocks in a package file, yielding the
+    block name, the block number (e.g. the stress period, or None)
+    and the tokens of the lines in the block (without comments)."""
+    with open(package_file) as src:
+        block = None
+        for line in src:
+            tokens, _ = _split_comment(line)
+            if not tokens:
+                continue
+            keyword = tokens[0].lower()
+            if keyword == 'begin':
+                block = tokens[1].lower()
+                number = int(tokens[2]) if len(tokens) > 2 and \
+                    tokens[2].isdigit() else None
+                lines = []
+            elif keyword == 'end':
+                yield block, number, lines
+                block = None
+            elif block is not None:
+                lines.append(tokens)
+
+
+def read_lists(package_file, block='period', names=None, dtypes=None,
+               sim_ws=None, cache_dir=None):
+    """Read the list input of a package (e.g. the stress period data
+    of a WEL or CHD package) into record arrays.
+
+    Parameters
+    ----------
+    package_file : str or pathlike
+    block : str
+        Block with the lists. By default, 'period'.
+    names : list of str, optional
+        Column names. By default, the cellid columns (k, i, j for
+        structured grids; k, cell2d for vertex grids; node for
+        unstructured grids), the value columns of the package
+        (for the standard boundary packages and some advanced package
+        blocks, see ``list_columns``; otherwise value0, value1, ...),
+        any auxiliary variables, and the boundname.
+    dtypes : dict, optional
+        See :func:`read_list`.
+    sim_ws : str or pathlike, optional
+        Simulation workspace that the OPEN/CLOSE paths are relative
+        to. By default, the folder containing the package file.
+    cache_dir : str or pathlike, optional
+        Folder for ``.npy`` copies of the external files, which are
+        memory-mapped on later reads. By default, no caching.
+
+    Returns
+    -------
+    lists : dict
+        {zero-based stress period: record array} for periods
+        blocks (or {None: record array} for other blocks).
+        As in flopy, periods without a block (which repeat the
+        previous period) aren't included.
+    """
+    package_file = Path(package_file)
+    sim_ws = Path(sim_ws) if sim_ws is not None else package_file.parent
+    package = package_file.suffix.lstrip('.').lower()
+    aux_names, boundnames = [], False
+    lists = {}
+    for name, number, lines in _iter_blocks(package_file):
+        if name == 'options':
+            aux_names, boundnames = _package_options(lines)
+        if name != block:
+            continue
+        key = number - 1 if number is not None else None
+        inline = [tokens for tokens in lines
+                  if tokens[0].lower() != 'open/close']
+        external = [tokens[1].strip('\'"') for tokens in lines
+                    if tokens[0].lower() == 'open/close']
+        if names is None:
+            # the layout of a row with a cellid (not NONE)
+            start = len(list_columns.get((package, block), ([], []))[0])
+            sample = _sample_row(inline, start)
+            for path in external:
+                if _has_cellid(sample, start):
+                    break
+                sample = _sample_row(_rows(sim_ws / path), start) or sample
+            if sample is None:
+                lists[key] = np.recarray(0, dtype=[])
+                continue
+            names = _list_names(package, block, len(sample), aux_names,
+                                boundnames)
+        arrays = []
+        if inline:
+            text = '\n'.join(' '.join(tokens) for tokens in inline)
+            arrays.append(read_list(io.StringIO(text), names, dtypes))
+        for path in external:
+            arrays.append(_cached(sim_ws / path, read_list, cache_dir,
+                                  names=names, dtypes=dtypes))
+        records = arrays[0] if len(arrays) == 1 else \
+            np.concatenate([np.asarray(a) for a in arrays])
+        lists[key] = records.view(np.recarray)
+    return lists
+
+
+def _rows(filename):
+    with open(filename) as src:
+        for line in src:
+            tokens, _ = _split_comment(line)
+            if tokens:
+                yield tokens
+
+
+def _has_cellid(tokens, start):
+    return tokens is not None and len(tokens) > start and \
+        tokens[start].lower() != 'none'
+
+
+def _sample_row(rows, start):
+    """Get the first row with a cellid (not NONE) at token start,
+    or else the first row (or None, if there are no rows)."""
+    first = None
+    for tokens in rows:
+        if _has_cellid(tokens, start):
+            return tokens
+        if first is None:
+            first = tokens
+    return first
+
+
+def _list_names(package, block, ncolumns, aux_names, boundnames):
+    """Default column names for the list input of a package."""
+    # auxiliary variables and boundnames are only in the main list block
+    main_block = 'packagedata' if package in packagedata_aux_packages \
+        else 'period'
+    if block != main_block:
+        aux_names, boundnames = [], False
+    nend = len(aux_names) + (1 if boundnames else 0)
+    if (package, block) in list_columns:
+        before, after = list_columns[package, block]
+        ncellid = ncolumns - len(before) - len(after) - nend
+    else:
+        # unknown package; assume a structured grid cellid
+        ncellid = min(3, ncolumns - nend - 1)
+        before = []
+        after = [f'value{i}' for i in range(ncolumns - nend - ncellid)]
+    names = before + cellid_columns[ncellid] + after + list(aux_names)
+    if boundnames:
+        names.append('boundname')
+    return names
+
+
+def read_arrays(package_file, block='griddata', shape=None, sim_ws=None,
+                cache_dir=None):
+    """Read the array input of a package (e.g. the GRIDDATA block
+    of the DIS or NPF package, or the PERIOD blocks of an array-based
+    recharge package) into arrays.
+
+    Parameters
+    ----------
+    package_file : str or pathlike
+    block : str
+        Block with the arrays. By default, 'griddata'.
+    shape : tuple, optional
+        Shape of a layer, e.g. (nrow, ncol), for reshaping the arrays
+        (arrays of other sizes, such as delr, aren't reshaped).
+        CONSTANT arrays are filled to this shape if it is given
+        (otherwise the constant value is returned).
+    sim_ws : str or pathlike, optional
+        Simulation workspace that the OPEN/CLOSE paths are relative
+        to. By default, the folder containing the package file.
+    cache_dir : str or pathlike, optional
+        Folder for ``.npy`` copies of the external files, which are
+        memory-mapped on later reads. By default, no caching.
+
+    Returns
+    -------
+    arrays : dict
+        {array name: array}, with LAYERED arrays stacked into 3D
+        arrays (nlay, ...). For period blocks, a dict of these
+        dicts, by zero-based stress period.
+    """
+    package_file = Path(package_file)
+    sim_ws = Path(sim_ws) if sim_ws is not None else package_file.parent
+    results = {}
+    for name, number, lines in _iter_blocks(package_file):
+        if name != block:
+            continue
+        arrays = {}
+        array_name = None
+        layers = []
+        i = 0
+        while i < len(lines):
+            tokens = lines[i]
+            keyword = tokens[0].lower()
+            i += 1
+            if keyword in ('constant', 'internal', 'open/close'):
+                factor = 1.
+                upper = [t.upper() for t in tokens]
+                if 'FACTOR' in upper:
+                    factor = float(tokens[upper.index('FACTOR') + 1])
+                if keyword == 'constant':
+                    value = float(tokens[1])
+                    array = np.full(shape, value) if shape is not None \
+                        else value
+                elif keyword == 'internal':
+                    values = []
+                    while i < len(lines) and _is_value(lines[i][0]):
+                        values += lines[i]
+                        i += 1
+                    array = _parse_values(' '.join(values),
+                                          f'{package_file} ({array_name})')
+                elif '(BINARY)' in upper:
+                    raise ValueError(f'binary array files are not supported '
+                                     f'({tokens[1]} in {package_file})')
+                else:
+                    array = _cached(sim_ws / tokens[1].strip('\'"'),
+                                    read_array, cache_dir)
+                if factor != 1.:
+                    array = array * factor
+                if shape is not None and np.size(array) > 1:
+                    array = _reshape(array, shape, array_name)
+                layers.append(array)
+            else:
+                _store_array(arrays, array_name, layers)
+                array_name = keyword
+                layers = []
+                # LAYERED arrays are stored as lists of layers
+                if len(tokens) > 1 and tokens[1].lower() == 'layered':
+                    layers = _Layered()
+        _store_array(arrays, array_name, layers)
+        if number is None:
+            results.update(arrays)
+        else:
+            results[number - 1] = arrays
+    return results
+
+
+def _reshape(array, shape, name=None):
+    """Reshape an array to the layer shape, or to (nlay, ...)
+    for arrays with multiple layers. Arrays along one dimension
+    of the grid (e.g. delr) are returned as is. Arrays of
+    other sizes raise a ValueError."""
+    size = int(np.prod(shape))
+    if array.size == size:
+        return array.reshape(shape)
+    elif array.size % size == 0:
+        return array.reshape((-1,) + tuple(shape))
+    elif array.size in shape:
+        return array
+    raise ValueError(f'{name} has {array.size} values; expected {size} '
+                     f'(one layer of {tuple(shape)}), a multiple of {size}, '
+                     f'or one of {tuple(shape)}')
+
+
+class _Layered(list):
+    """List of the layers in a LAYERED array."""
+
+
+def _store_array(arrays, name, layers):
+    if name is None or not layers:
+        return
+    if isinstance(layers, _Layered):
+        arrays[name] = np.stack(layers) if np.ndim(layers[0]) > 0 \
+            else np.array(layers)
+    else:
+        arrays[name] = layers[0]
+
+
+def _is_number(token):
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+
+def _is_value(token):
+    """Check whether a token is an array value (which may have
+    a Fortran D exponent, or a repeat count)."""
+    count, _, value = token.rpartition('*')
+    return (not count or count.isdigit()) and \
+        _is_number(_fortran_exponent.sub('e', value))
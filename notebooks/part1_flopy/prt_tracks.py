@@ -0,0 +1,354 @@
+"""Streaming reader for MODFLOW 6 PRT particle track output.
+
+The PRT notebook reads the whole track file (``project-prt.trk.csv``)
+into pandas, and then groups it by particle to get pathlines and
+endpoints. Particle releases over large grids can produce tens of
+millions of track records. :class:`TrackFile` instead reads the binary
+``.trk`` file (through a memory map, with the record dtype from the
+``.trk.hdr`` file written by MODFLOW 6) or the CSV output, in chunks,
+and computes the per-particle results in one pass, without holding
+all of the records in memory.
+
+Particles are identified by the combination of model (imdl),
+release package (iprp), release point (irpt) and release time
+(trelease), as in :func:`flopy.plot.plotutil.to_mp7_endpoints`.
+Records for each particle are assumed to be in time order within the
+file, as MODFLOW 6 writes them.
+
+Examples
+--------
+>>> trk = TrackFile('temp/ex10a/prt/project-prt.trk')
+>>> sfr_cells = ...  # icell numbers of the SFR cells
+>>> endpoints = trk.endpoints(capture_cells=sfr_cells)
+>>> endpoints.groupby('end_izone')['travel_time'].describe()
+>>> pathlines = trk.pathlines(dt=365.25)  # at most one point per year
+>>> mm.plot_pathline(pathlines, layer='all')
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+# default MODFLOW 6 PRT track record, in case there is no .hdr file
+track_dtype = np.dtype([('kper', '<i4'), ('kstp', '<i4'), ('imdl', '<i4'),
+                        ('iprp', '<i4'), ('irpt', '<i4'), ('ilay', '<i4'),
+                        ('icell', '<i4'), ('izone', '<i4'),
+                        ('istatus', '<i4'), ('ireason', '<i4'),
+                        ('trelease', '<f8'), ('t', '<f8'), ('x', '<f8'),
+                        ('y', '<f8'), ('z', '<f8'), ('name', 'S40')])
+
+particle_key = ['imdl', 'iprp', 'irpt', 'trelease']
+particle_key_dtype = np.dtype([('imdl', '<i4'), ('iprp', '<i4'),
+                               ('irpt', '<i4'), ('trelease', '<f8')])
+
+# record columns kept for the start and end of each particle
+endpoint_columns = ['t', 'x', 'y', 'z', 'ilay', 'icell', 'izone',
+                    'istatus', 'ireason']
+
+# ireason code for a termination event
+TERMINATION = 3
+
+
+def read_header(header_file):
+    """Read the record dtype from a MODFLOW 6 track header
+    (``.trk.hdr``) file, which has a line of comma-separated
+    field names, followed by a line of numpy dtype strings."""
+    with open(header_file) as src:
+        names = src.readline().strip().split(',')
+        formats = src.readline().strip().split(',')
+    return np.dtype(list(zip(names, formats)))
+
+
+class _Particles:
+    """Running per-particle state, with arrays that grow as new
+    particles are encountered in the track records."""
+    def __init__(self):
+        self.ids = {}
+        self.size = 0
+        self.arrays = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_ids(self, records):
+        """Get integer particle ids for the records, adding any
+        new particles."""
+        # factorize the combination of key columns (with hashing,
+        # one column at a time, so that the codes stay small)
+        codes = np.zeros(len(records), dtype=np.int64)
+        for c in particle_key:
+            column_codes, column_uniques = pd.factorize(records[c])
+            codes, _ = pd.factorize(codes * len(column_uniques) + column_codes)
+        nunique = codes.max() + 1
+        # first record of each unique particle
+        first = np.empty(nunique, dtype=np.int64)
+        first[codes[::-1]] = np.arange(len(codes))[::-1]
+        uniques = list(zip(*(records[c].to_numpy()[first].tolist()
+                             for c in particle_key)))
+        unique_ids = np.empty(len(uniques), dtype=int)
+        for i, key in enumerate(uniques):
+            pid = self.ids.get(key)
+            if pid is None:
+                pid = self.ids[key] = len(self.ids)
+            unique_ids[i] = pid
+        self._grow(len(self.ids))
+        return unique_ids[codes]
+
+    def sorted_ids(self):
+        """Get the particle ids, renumbered in the order of the
+        particle keys (as for the flopy MODPATH 7 sequence numbers)."""
+        keys = np.array(list(self.ids), dtype=particle_key_dtype)
+        ranks = np.empty(len(keys), dtype=int)
+        ranks[np.array(list(self.ids.values()))[np.argsort(keys)]] = \
+            np.arange(len(keys))
+        return ranks
+
+    def array(self, name, dtype):
+        if name not in self.arrays:
+            self.arrays[name] = np.zeros(self.size, dtype=dtype)
+        return self.arrays[name]
+
+    def _grow(self, n):
+        if n <= self.size:
+            return
+        size = max(n, 2 * self.size, 1024)
+        for name, values in self.arrays.items():
+            grown = np.empty(size, dtype=values.dtype)
+            grown[:self.size] = values
+            grown[self.size:] = 0
+            self.arrays[name] = grown
+        self.size = size
+
+
+class TrackFile:
+    """Streaming reader for MODFLOW 6 PRT particle track output.
+
+    Parameters
+    ----------
+    filename : str or pathlike
+        Binary track file (``.trk``), or CSV track file (``.trk.csv``).
+    chunksize : int
+        Number of track records to process at a time. By default,
+        one million (about 120 MB for binary files).
+    """
+    def __init__(self, filename, chunksize=1_000_000):
+        self.filename = Path(filename)
+        self.chunksize = int(chunksize)
+        self.is_csv = self.filename.suffix.lower() == '.csv'
+        if self.is_csv:
+            self.dtype = None
+        else:
+            header_file = Path(f'{self.filename}.hdr')
+            if header_file.exists():
+                self.dtype = read_header(header_file)
+            else:
+                self.dtype = track_dtype
+
+    def __len__(self):
+        """Number of track records."""
+        if self.is_csv:
+            return sum(len(chunk) for chunk in self.iter_chunks(['t']))
+        return self.filename.stat().st_size // self.dtype.itemsize
+
+    def iter_chunks(self, columns=None):
+        """Iterate over the track records, in chunks of
+        ``chunksize`` records.
+
+        Parameters
+        ----------
+        columns : list of str, optional
+            Fields to read. By default, all fields.
+
+        Yields
+        ------
+        chunk : pandas.DataFrame
+        """
+        if self.is_csv:
+            yield from pd.read_csv(self.filename, usecols=columns,
+                                   chunksize=self.chunksize)
+            return
+        if len(self) == 0:
+            # (an empty file can't be memory-mapped)
+            return
+        records = np.memmap(self.filename, dtype=self.dtype, mode='r',
+                            shape=(len(self),))
+        if columns is None:
+            columns = [c for c in self.dtype.names if c != 'name']
+        for start in range(0, len(records), self.chunksize):
+            chunk = records[start:start + self.chunksize]
+            yield pd.DataFrame({c: np.array(chunk[c]) for c in columns})
+        del records
+
+    def endpoints(self, capture_cells=None):
+        """Compute the start and end of each particle, in one pass
+        through the track records.
+
+        Parameters
+        ----------
+        capture_cells : sequence of ints, optional
+            Cells (as icell numbers in the track output) that capture
+            particles. For example, the SFR cells, where the SFR flows
+            are assigned to the top cell face with the ``iflowface``
+            auxiliary variable, so that particles terminate there.
+
+        Returns
+        -------
+        endpoints : pandas.DataFrame
+            One row per particle, with the particle key columns
+            (imdl, iprp, irpt, trelease), the start and end time,
+            location, layer, cell, zone, status and reason (prefixed
+            with ``start_`` and ``end_``), the travel time (end time
+            minus the release time), the path length (summed over the
+            track records), the number of records, whether the particle
+            terminated, and (if capture_cells are specified)
+            whether the particle was captured.
+        """
+        particles = _Particles()
+        columns = particle_key + endpoint_columns
+        for chunk in self.iter_chunks(columns):
+            if len(chunk) == 0:
+                continue
+            pid = particles.get_ids(chunk)
+            x, y, z = (chunk[c].to_numpy(dtype=float) for c in 'xyz')
+            # end locations so far (from previous chunks)
+            last_xyz = [particles.array(f'end_{c}', float) for c in 'xyz']
+            seen = particles.array('nrecords', np.int64)
+
+            # path length: segments between consecutive records
+            # of the same particle within the chunk
+            order = np.argsort(pid, kind='stable')
+            spid = pid[order]
+            same = spid[1:] == spid[:-1]
+            seg = np.sqrt(np.diff(x[order]) ** 2 + np.diff(y[order]) ** 2 +
+                          np.diff(z[order]) ** 2)
+            length = particles.array('path_length', float)
+            np.add.at(length, spid[1:][same], seg[same])
+            # first record of each particle in the chunk
+            first = order[np.r_[True, ~same]]
+            last = order[np.r_[~same, True]]
+            # plus the segment from the last record in a previous chunk
+            cont = seen[pid[first]] > 0
+            f = first[cont]
+            p = pid[f]
+            length[p] += np.sqrt((x[f] - last_xyz[0][p]) ** 2 +
+                                 (y[f] - last_xyz[1][p]) ** 2 +
+                                 (z[f] - last_xyz[2][p]) ** 2)
+            np.add.at(seen, pid, 1)
+
+            # start (for new particles) and end (updated with each chunk)
+            new_first = first[~cont]
+            for c in endpoint_columns:
+                values = chunk[c].to_numpy()
+                dtype = float if values.dtype.kind == 'f' else np.int64
+                start = particles.array(f'start_{c}', dtype)
+                start[pid[new_first]] = values[new_first]
+                end = particles.array(f'end_{c}', dtype)
+                end[pid[last]] = values[last]
+            for c in particle_key:
+                values = chunk[c].to_numpy()
+                dtype = float if values.dtype.kind == 'f' else np.int64
+                key = particles.array(c, dtype)
+                key[pid[new_first]] = values[new_first]
+
+        n = len(particles)
+        if n == 0:
+            return pd.DataFrame(columns=particle_key)
+        data = {c: particles.arrays[c][:n] for c in particle_key}
+        for c in endpoint_columns:
+            data[f'start_{c}'] = particles.arrays[f'start_{c}'][:n]
+        for c in endpoint_columns:
+            data[f'end_{c}'] = particles.arrays[f'end_{c}'][:n]
+        endpoints = pd.DataFrame(data)
+        endpoints['travel_time'] = endpoints['end_t'] - endpoints['trelease']
+        endpoints['path_length'] = particles.arrays['path_length'][:n]
+        endpoints['nrecords'] = particles.arrays['nrecords'][:n]
+        endpoints['terminated'] = endpoints['end_ireason'] == TERMINATION
+        if capture_cells is not None:
+            endpoints['captured'] = endpoints['terminated'] & \
+                endpoints['end_icell'].isin(np.asarray(capture_cells))
+        endpoints.index = particles.sorted_ids()
+        endpoints.index.name = 'particle'
+        endpoints.sort_index(inplace=True)
+        return endpoints
+
+    def pathlines(self, every=1, dt=None, columns=None):
+        """Read decimated pathlines, for plotting, in one pass through
+        the track records. The first and last record of each particle
+        are always kept.
+
+        Parameters
+        ----------
+        every : int
+            Keep every nth record of each particle. By default, 1.
+        dt : float, optional
+            Keep at most one record of each particle per time
+            interval of this length (e.g. 365.25 for one point per year).
+        columns : list of str, optional
+            Fields to include. By default, all fields except the name.
+
+        Returns
+        -------
+        pathlines : pandas.DataFrame
+            Decimated track records, with a ``particle`` column
+            (matching the index of :meth:`endpoints`), sorted by
+            particle and time. Can be passed to
+            :meth:`flopy.plot.PlotMapView.plot_pathline`.
+        """
+        if columns is None:
+            columns = [c for c in (self.dtype.names if self.dtype is not None
+                                   else track_dtype.names) if c != 'name']
+        read_columns = list(dict.fromkeys(columns + particle_key + ['t']))
+        particles = _Particles()
+        kept = []
+        # the last record of each particle, if it hasn't been kept
+        pending = None
+        for chunk in self.iter_chunks(read_columns):
+            if len(chunk) == 0:
+                continue
+            pid = particles.get_ids(chunk)
+            count = particles.array('count', np.int64)
+            # time interval of the last record of each particle
+            last_bin = particles.array('last_bin', np.int64)
+            order = np.argsort(pid, kind='stable')
+            spid = pid[order]
+            starts = np.r_[True, spid[1:] != spid[:-1]]
+            ends = np.r_[starts[1:], True]
+            # running record number of each particle
+            run = np.arange(len(spid))
+            run -= np.maximum.accumulate(np.where(starts, run, 0))
+            n = count[spid] + run
+            keep = (n % every) == 0
+            if dt is not None:
+                tbin = np.floor(chunk['t'].to_numpy()[order] / dt).astype(np.int64)
+                prev = np.r_[-1, tbin[:-1]]
+                prev[starts] = last_bin[spid[starts]]
+                keep &= tbin != prev
+                last_bin[spid[ends]] = tbin[ends]
+            keep |= n == 0
+            np.add.at(count, pid, 1)
+
+            rows = chunk.iloc[order][columns]
+            rows.index = spid
+            rows.index.name = 'particle'
+            kept.append(rows.loc[keep])
+            # hold on to the last record of each particle, in case
+            # it isn't kept and it turns out to be the final one
+            held = rows.loc[ends & ~keep]
+            if pending is not None:
+                held = pd.concat([pending.drop(spid[ends], errors='ignore'),
+                                  held])
+            pending = held
+        if pending is None:
+            return pd.DataFrame(columns=['particle'] + columns)
+        kept.append(pending)
+        pathlines = pd.concat(kept).rename_axis('particle').reset_index()
+        pathlines['particle'] = particles.sorted_ids()[pathlines['particle']]
+        # the held records are last, so they stay last within
+        # each particle and time in the (stable) sort
+        pathlines = pathlines.sort_values(['particle', 't'], kind='stable')
+        return pathlines.reset_index(drop=True)
+
+    def read(self, columns=None):
+        """Read all of the track records into a DataFrame
+        (for small files)."""
+        return pd.concat(self.iter_chunks(columns), ignore_index=True)
@@ -0,0 +1,775 @@
+"""Stage cache for building models with modflow-setup.
+
+The modflow-setup notebooks (08 and 08b) build the Pleasant Lake
+inset and LGR models from ``pleasant.yml`` and
+``pleasant_lgr_parent.yml`` (with ``pleasant_lgr_inset.yml``). Each
+build loads the parent model in ``pleasant-lake/`` and regrids its
+arrays and stress periods (with ``default_source_data: True`` and
+``copy_stress_periods: 'all'``), even if only one block of the
+configuration file changed. :func:`setup_from_yaml` goes through the
+same steps as :meth:`mfsetup.MF6model.setup_from_yaml`, but with each
+step as a stage in a cache:
+
+* the model grid (and the LGR inset grids)
+* each package in the configuration (the property arrays regridded
+  from the parent model, the SFR and lake intersections, the
+  boundary heads interpolated from the parent model, etc.)
+
+The parent model (a MODFLOW 6 model) is loaded with the same packages
+as modflow-setup would load, from a snapshot of the previous load if
+its input files haven't changed (see :func:`sim_cache.load_simulation`),
+and passed to the model.
+
+Each stage has a key: a hash of the configuration blocks it reads
+(see ``stage_inputs``), the source files those blocks reference (and
+the parent model input files), the keys of the stages it depends on,
+and the versions of the main packages. The results of a stage are
+what it adds to the model: the package input files (and the external
+files it writes), the other files it writes in the simulation folder
+(e.g. the intermediate arrays in ``original-arrays/``, which the later
+stages read), and the model attributes it sets. For a stage with a key
+that is in the cache, the files are copied into the simulation folder
+and the packages are loaded from them, instead of running the stage. So editing e.g. the ``wel:``
+block only reruns the WEL package setup.
+
+The time discretization and solver stages (and the LGR exchanges)
+aren't cached (they are quick, and make simulation-level packages),
+and neither is the grid stage of a model with LGR insets (which makes
+the inset models, and the parent model DIS package). The LGR insets
+share the time discretization of the simulation.
+
+The stages run one at a time, as a task graph (see ``task_graph.py``):
+after the parent model, grid, time discretization and solver, the
+packages of each model are set up in a chain of their own (each inset
+package after the same parent package, which it may get data from),
+joining at the GWF-GWF exchanges. The time of each stage, and the
+critical path (the chain of stages that determined the total time),
+are in ``m.setup_tasks``.
+
+Examples
+--------
+>>> m = setup_from_yaml('data/pleasant.yml', cache_dir='data/setup_cache')
+>>> m.write_input()
+"""
+import functools
+import hashlib
+import importlib.metadata
+import io
+import json
+import os
+from pathlib import Path
+import pickle
+import shutil
+import time
+import flopy
+import yaml
+from sim_cache import file_hash, input_files, load_simulation
+from task_graph import TaskGraph
+
+# configuration blocks that each setup stage reads, and the stages
+# whose results it uses (stages that aren't listed here read all
+# of the blocks, and use the results of all of the previous stages)
+stage_inputs = {
+    'parent': (['parent'], []),
+    'grid': (['model', 'setup_grid', 'dis'], ['parent']),
+    'tdis': (['tdis', 'parent'], []),
+    'ims': (['ims'], []),
+    # the lake bathymetry is subtracted from the model top
+    'dis': (['model', 'dis', 'lak'], ['parent', 'grid', 'tdis']),
+    'ic': (['ic'], ['parent', 'dis']),
+    'npf': (['npf'], ['parent', 'dis']),
+    'sto': (['sto'], ['parent', 'dis', 'tdis']),
+    'rch': (['rch', 'recharge'], ['parent', 'dis', 'tdis']),
+    'wel': (['wel'], ['parent', 'dis', 'tdis']),
+    'sfr': (['sfr'], ['parent', 'dis', 'tdis']),
+    'lak': (['lak'], ['dis', 'tdis']),
+    'chd': (['chd'], ['parent', 'dis', 'tdis']),
+    'obs': (['obs'], ['dis', 'sfr', 'lak']),
+    'oc': (['oc'], ['tdis']),
+}
+
+# stages that are always run
+uncached_stages = {'tdis', 'ims'}
+
+# packages whose versions are part of the stage keys
+packages = ['modflow-setup', 'flopy', 'sfrmaker', 'gis-utils', 'numpy',
+            'pandas', 'scipy', 'rasterio', 'shapely', 'pyproj', 'geopandas']
+
+# flopy model attributes that hold the package registry
+# (packages are restored by loading them from their files)
+flopy_attributes = {'_package_container', '_package_paths', '_ftype_num_dict',
+                    'name_file', 'simulation', 'simulation_data',
+                    'dimensions', 'structure'}
+
+
+def environment():
+    """Versions of the main packages."""
+    versions = {}
+    for name in packages:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    return versions
+
+
+def load_yaml(filename):
+    with open(filename) as src:
+        return yaml.load(src, Loader=yaml.Loader) or {}
+
+
+def _strings(obj):
+    """Strings in a (nested) configuration block."""
+    if isinstance(obj, str):
+        yield obj
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from _strings(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            yield from _strings(value)
+
+
+def source_files(block, cfg_dir, exclude=()):
+    """Files referenced in a configuration block, relative to the
+    folder of the configuration file. Folders are expanded to the files
+    in them, and files to the files with the same name and other
+    extensions (e.g. the .dbf and .prj files of a shapefile).
+    Other configuration files aren't included, and neither are the
+    files in the folders in exclude (e.g. the simulation folder,
+    which has the same name as the simulation)."""
+    cfg_dir = Path(cfg_dir)
+    exclude = [Path(folder).resolve() for folder in exclude]
+    files = set()
+    for value in _strings(block):
+        if len(value) > 260 or '\n' in value:
+            continue
+        path = cfg_dir / value
+        if path.suffix in {'.yml', '.yaml'}:
+            continue
+        resolved = path.resolve()
+        if any(resolved == folder or folder in resolved.parents
+               for folder in exclude):
+            continue
+        if path.is_dir():
+            files.update(f for f in path.rglob('*') if f.is_file())
+        elif path.is_file():
+            files.update(f for f in path.parent.glob(f'{path.stem}.*')
+                         if f.is_file())
+    return sorted(files)
+
+
+def parent_files(parent_block, cfg_dir):
+    """Input files of the parent model."""
+    model_ws = Path(cfg_dir) / parent_block.get('model_ws', '.')
+    namefile = 'mfsim.nam' if (model_ws / 'mfsim.nam').exists() \
+        else parent_block.get('namefile')
+    if namefile is None or not (model_ws / namefile).exists():
+        return []
+    return [model_ws / f for f in input_files(model_ws, namefile)]
+
+
+class StageCache:
+    """Cache for the results of the model setup stages.
+
+    Parameters
+    ----------
+    cache_dir : str or pathlike
+        Folder for the stage results (a subfolder for each stage key).
+    force : bool
+        Option to run all of the stages (and replace their results
+        in the cache). By default, False.
+    """
+    def __init__(self, cache_dir, force=False):
+        self.cache_dir = Path(cache_dir).resolve()
+        self.force = force
+        self._hashes = {}
+        self._environment = json.dumps(environment(), sort_keys=True)
+
+    def file_hash(self, path):
+        """Hash of a file (hashes are kept for files with the same
+        size and modification time)."""
+        path = Path(path).resolve()
+        stat = path.stat()
+        signature = (str(path), stat.st_size, stat.st_mtime_ns)
+        if signature not in self._hashes:
+            self._hashes[signature] = file_hash(path)
+        return self._hashes[signature]
+
+    def stage_key(self, name, blocks, dependencies=()):
+        """Key for a stage.
+
+        Parameters
+        ----------
+        name : str
+            Stage name (with the model name).
+        blocks : list of tuples
+            (block name, block, folder of the configuration file,
+            source files) tuples. The source files are found from the
+            block if they are None.
+        dependencies : sequence of str
+            Keys of the stages that the stage depends on.
+        """
+        sha = hashlib.sha256()
+        sha.update(name.encode())
+        sha.update(self._environment.encode())
+        for block_name, block, cfg_dir, files in blocks:
+            sha.update(json.dumps([block_name, block], sort_keys=True,
+                                  default=str).encode())
+            if files is None:
+                files = source_files(block, cfg_dir)
+            for f in files:
+                sha.update(os.path.relpath(f, cfg_dir).encode())
+                sha.update(self.file_hash(f).encode())
+        for key in dependencies:
+            sha.update(key.encode())
+        return sha.hexdigest()
+
+    def path(self, key):
+        return self.cache_dir / key[:32]
+
+    def get(self, key):
+        """Folder with the results of a stage, or None."""
+        path = self.path(key)
+        if self.force or not (path / 'state.pkl').exists():
+            return None
+        return path
+
+
+def _models(model):
+    """The model and its LGR insets."""
+    models = [model]
+    for inset in (getattr(model, 'inset', None) or {}).values():
+        if getattr(inset, '_is_lgr', False):
+            models.append(inset)
+    return models
+
+
+def _live_objects(models, with_packages=True):
+    """Flopy objects that are in place before (or after) a stage,
+    which are pickled by reference rather than by value.
+
+    Returns
+    -------
+    objects : dict
+        {key: object}
+    """
+    objects = {}
+    for model in models:
+        objects[('model', model.name)] = model
+        objects[('simulation', model.name)] = model.simulation
+        for attr, value in list(vars(model).items()):
+            if attr in flopy_attributes:
+                continue
+            if isinstance(value, (flopy.mf6.MFModel, flopy.mbase.BaseModel)):
+                objects[('attribute', model.name, attr)] = value
+                if getattr(value, 'simulation', None) is not None:
+                    objects[('attribute simulation', model.name, attr)] = \
+                        value.simulation
+        if with_packages:
+            for package in model.packagelist:
+                objects[('package', model.name, package.package_name)] = package
+    return objects
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file, objects):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._ids = {id(obj): key for key, obj in objects.items()}
+
+    def persistent_id(self, obj):
+        return self._ids.get(id(obj))
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, objects):
+        super().__init__(file)
+        self._objects = objects
+
+    def persistent_load(self, key):
+        return self._objects[key]
+
+
+def _dumps(obj, objects):
+    buffer = io.BytesIO()
+    _Pickler(buffer, objects).dump(obj)
+    return buffer.getvalue()
+
+
+def _loads(data, objects):
+    return _Unpickler(io.BytesIO(data), objects).load()
+
+
+def _cfg_state(model, objects):
+    """Pickled configuration blocks of a model."""
+    cfg = getattr(model, 'cfg', None) or {}
+    return {k: _dumps(v, objects) for k, v in list(cfg.items())}
+
+
+def _sim_path(model):
+    return Path(model.simulation.simulation_data.mfpath.get_sim_path())
+
+
+def _content_hash(filename):
+    """Hash of a file, without the header line with the time
+    that flopy writes at the top of each input file."""
+    with open(filename, 'rb') as src:
+        data = src.read()
+    if data.startswith(b'# File generated by Flopy'):
+        data = data.split(b'\n', 1)[-1]
+    return hashlib.sha256(data).hexdigest()
+
+
+def _auto_maxbound(model):
+    """Packages of a model without a maximum number of boundaries,
+    which flopy sets when the package is written (and keeps, even if
+    boundaries are removed before the model is written again)."""
+    packages = []
+    for package in model.packagelist:
+        maxbound = getattr(package, 'maxbound', None)
+        if maxbound is not None and maxbound.get_data() is None:
+            packages.append(package)
+    return packages
+
+
+def _model_files(sim_path, model):
+    """Input files of a model (the package files and the external
+    files they reference, but not the name file), relative to the
+    simulation folder."""
+    namefile = os.path.relpath(Path(model.model_ws) / model.model_nam_file,
+                               sim_path)
+    if not (Path(sim_path) / namefile).exists():
+        return []
+    return [str(f) for f in input_files(sim_path, namefile)[1:]]
+
+
+class _Stage:
+    """Run a setup stage, or restore its results from the cache."""
+
+    def __init__(self, cache, models):
+        self.cache = cache
+        self.models = models
+        self.sim_path = _sim_path(models[0])
+        # size, modification time and hash of the input files
+        # of each model, as of its last stage
+        self._files = {}
+        # size and modification time of the other files in the
+        # simulation folder (e.g. the intermediate arrays in
+        # original-arrays/, which the later stages read)
+        self._others = self._signatures()
+
+    def run(self, model, name, key, setup, cached=True):
+        """Run a stage (or restore it from the cache).
+
+        Returns
+        -------
+        status : str
+            'run' or 'cached'
+        """
+        if not cached or name in uncached_stages:
+            setup()
+            return 'run'
+        path = self.cache.get(key)
+        if path is not None:
+            try:
+                self.restore(model, path)
+                return 'cached'
+            except Exception as e:
+                print(f'could not restore the {model.name} {name} stage '
+                      f'from the cache:\n{e}\nrunning it...')
+        before = {k: id(v) for k, v in list(vars(model).items())}
+        objects = _live_objects(self.models, with_packages=False)
+        cfg_before = _cfg_state(model, objects)
+        setup()
+        try:
+            self.save(model, key, before, cfg_before, objects)
+        except Exception as e:
+            print(f'could not cache the {model.name} {name} stage:\n{e}')
+        return 'run'
+
+    def _changed_files(self, model, files=None):
+        """Input files of a model that were added or changed (by their
+        contents) since its last stage."""
+        if files is None:
+            files = _model_files(self.sim_path, model)
+        previous = self._files.setdefault(model.name, {})
+        changed = []
+        for rel in files:
+            stat = os.stat(self.sim_path / rel)
+            signature = (stat.st_size, stat.st_mtime_ns)
+            prev = previous.get(rel)
+            if prev is not None and prev[:2] == signature:
+                continue
+            new_hash = _content_hash(self.sim_path / rel)
+            if prev is None or prev[2] != new_hash:
+                changed.append(rel)
+            previous[rel] = (*signature, new_hash)
+        return changed
+
+    def _signatures(self, files=None):
+        """Size and modification time of files in the simulation
+        folder (by default, all of them)."""
+        if files is None:
+            files = [os.path.relpath(f, self.sim_path)
+                     for f in self.sim_path.rglob('*') if f.is_file()]
+        signatures = {}
+        for rel in files:
+            stat = os.stat(self.sim_path / rel)
+            signatures[rel] = (stat.st_size, stat.st_mtime_ns)
+        return signatures
+
+    def _written_files(self, model):
+        """Files in the simulation folder, other than the model input
+        files, that were added or modified since the last stage (except
+        for the files named after the other models)."""
+        inputs = {rel for m in self.models
+                  for rel in _model_files(self.sim_path, m)}
+        others = tuple(m.name for m in self.models if m is not model)
+        written = {rel: signature for rel, signature
+                   in self._signatures().items()
+                   if rel not in inputs and self._others.get(rel) != signature
+                   and not (others and Path(rel).name.startswith(others))}
+        self._others.update(written)
+        return list(written)
+
+    def save(self, model, key, before, cfg_before, objects):
+        # write the model packages, so that their input files are
+        # among the files that the stage added or changed
+        auto_maxbound = _auto_maxbound(model)
+        model.write()
+        for package in auto_maxbound:
+            package.maxbound.set_data(None)
+        changed = set(self._changed_files(model))
+        changed.update(self._written_files(model))
+        model_ws = Path(model.model_ws)
+        # file types in the name file (e.g. RCH6 for an RCHA package)
+        records = model.name_file.packages.get_data()
+        nam_ftypes = {record[2]: record[0] for record in
+                      (records if records is not None else [])}
+        package_files = []
+        for package in model.packagelist:
+            if package.parent_file is not None:
+                continue
+            rel = os.path.relpath(model_ws / package.filename, self.sim_path)
+            if rel in changed:
+                nam_ftype = nam_ftypes.get(package.package_name,
+                                           f'{package.package_type.upper()}6')
+                package_files.append((package.package_type, package.filename,
+                                      package.package_name, nam_ftype))
+        attributes = {}
+        objects.update({k: v for k, v in
+                        _live_objects(self.models).items()
+                        if k[0] == 'package'})
+        for attr, value in list(vars(model).items()):
+            if attr in flopy_attributes or attr == 'cfg':
+                continue
+            if before.get(attr) != id(value):
+                attributes[attr] = _dumps(value, objects)
+
+        path = self.cache.path(key)
+        tmp = path.with_name(path.name + '.tmp')
+        shutil.rmtree(tmp, ignore_errors=True)
+        for rel in changed:
+            dest = tmp / 'files' / rel
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(self.sim_path / rel, dest)
+        tmp.mkdir(parents=True, exist_ok=True)
+        # configuration blocks that the stage changed (e.g. with the
+        # names of the external files it wrote)
+        cfg = {k: v for k, v in _cfg_state(model, objects).items()
+               if cfg_before.get(k) != v}
+        state = {'packages': package_files, 'attributes': attributes,
+                 'cfg': cfg,
+                 'auto_maxbound': [p.package_name for p in auto_maxbound]}
+        with open(tmp / 'state.pkl', 'wb') as dest:
+            pickle.dump(state, dest, protocol=pickle.HIGHEST_PROTOCOL)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+
+    def restore(self, model, path):
+        with open(path / 'state.pkl', 'rb') as src:
+            state = pickle.load(src)
+        objects = _live_objects(self.models, with_packages=False)
+        files = path / 'files'
+        restored = []
+        if files.exists():
+            for src in files.rglob('*'):
+                if src.is_file():
+                    rel = src.relative_to(files)
+                    dest = self.sim_path / rel
+                    dest.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copy2(src, dest)
+                    restored.append(str(rel))
+        for ftype, filename, pname, nam_ftype in state['packages']:
+            if model.get_package(pname) is not None:
+                model.remove_package(pname)
+            # the discretization package has to be in the name file
+            # for the other packages to be loaded
+            data = model.name_file.packages.get_data()
+            record = (nam_ftype, filename, pname)
+            if data is None or record not in {tuple(r)[:3] for r in data}:
+                model.name_file.packages.append_list_as_record(list(record))
+            model.load_package(ftype, filename, pname, strict=False,
+                               ref_path=None)
+            if pname in state['auto_maxbound']:
+                model.get_package(pname).maxbound.set_data(None)
+        objects.update({k: v for k, v in _live_objects(self.models).items()
+                        if k[0] == 'package'})
+        for attr, data in state['attributes'].items():
+            setattr(model, attr, _loads(data, objects))
+        for block_name, data in state['cfg'].items():
+            model.cfg[block_name] = _loads(data, objects)
+        self._changed_files(model, restored)
+        self._others.update(self._signatures(restored))
+
+
+def _stage_blocks(name, raw_cfg, cfg_dir, exclude=()):
+    """Configuration blocks for a stage key, with their source files
+    (other than the files in the folders in exclude)."""
+    block_names = stage_inputs.get(name, (sorted(raw_cfg), []))[0]
+    blocks = []
+    for block_name in block_names:
+        block = raw_cfg.get(block_name)
+        if block is None:
+            continue
+        if block_name == 'parent':
+            files = parent_files(block, cfg_dir)
+        else:
+            files = source_files(block, cfg_dir, exclude)
+        blocks.append((block_name, block, cfg_dir, files))
+    return blocks
+
+
+def load_parent(cfg, snapshot_dir):
+    """Load the MODFLOW 6 parent model in a configuration, with the
+    packages that ``MFsetupMixin._set_parent`` would load, from a
+    snapshot of the previous load if the parent model input files
+    haven't changed.
+
+    Parameters
+    ----------
+    cfg : dict
+        Configuration, as returned by ``MF6model.load_cfg``.
+    snapshot_dir : str or pathlike
+        Folder for the snapshots (see :func:`sim_cache.load_simulation`).
+
+    Returns
+    -------
+    parent : flopy.mf6.ModflowGwf
+        The parent model, or None if there is no parent model,
+        or it isn't a MODFLOW 6 model (modflow-setup loads those).
+    """
+    from mfsetup.mf5to6 import get_package_name
+    from mfsetup.utils import get_input_arguments, get_packages
+
+    kwargs = dict(cfg.get('parent') or {})
+    if kwargs.get('version') != 'mf6' or 'namefile' not in kwargs:
+        return None
+    namefile = os.path.join(kwargs['model_ws'], kwargs['namefile'])
+    # the packages that the model is set up with (and at least the
+    # discretization and storage packages), that the parent model has
+    specified_packages = set(cfg['model'].get('packages', set()))
+    specified_packages.update({'dis', 'tdis'})
+    parent_packages = {p for package in specified_packages
+                       for p in get_package_name(package, 'mf6')}
+    parent_packages.add('sto')
+    load_only = sorted(set(get_packages(namefile)).intersection(parent_packages))
+    kwargs.setdefault('load_only', load_only)
+    if 'skip_load' in kwargs:
+        skip_load = [s.lower() for s in kwargs['skip_load']]
+        kwargs['load_only'] = [p for p in kwargs['load_only']
+                               if p not in skip_load]
+    kwargs.setdefault('sim_ws', kwargs['model_ws'])
+    kwargs = get_input_arguments(kwargs, flopy.mf6.MFSimulation.load,
+                                 warn=False)
+    # the simulation name isn't used for the parent model
+    kwargs.pop('sim_name', None)
+    sim = load_simulation(kwargs.pop('sim_ws'),
+                          packages=kwargs.pop('load_only'),
+                          cache_dir=snapshot_dir, **kwargs)
+    modelname, _ = os.path.splitext(cfg['parent']['namefile'])
+    return sim.get_model(modelname)
+
+
+def _setup_package(model, package):
+    """Set up a package as ``MFsetupMixin.setup_packages`` does, with
+    the keyword arguments in its configuration block (and in the
+    ``mfsetup_options`` of the block), unless the model already has it.
+    """
+    from mfsetup.mfmodel import MFsetupMixin
+
+    package_setup = getattr(model, f'setup_{package}', None)
+    if package_setup is None:
+        print(f'{package.upper()} package not supported '
+              f'for MODFLOW version={model.version}')
+        return
+    if not callable(package_setup):
+        package_setup = functools.partial(
+            getattr(MFsetupMixin, f"setup_{package.strip('6')}"), model)
+    # only one instance of each package, except for observations
+    if model.version != 'mf6' or package == 'obs' or \
+            not hasattr(model, package):
+        package_setup(**model.cfg[package],
+                      **model.cfg[package]['mfsetup_options'])
+
+
+def setup_from_yaml(cfg_file, cache_dir='setup_cache', force=False,
+                    verbose=True):
+    """Set up a MODFLOW 6 model (and any LGR insets) with modflow-setup,
+    using the cached results of setup stages that haven't changed.
+
+    The stages are run as a graph of tasks (see task_graph.py).
+    The parent model, grid, time discretization and solver are set up
+    first. Then the packages of the model and of each LGR inset are
+    set up, with the packages of each model in order (the setup
+    methods of a model share its state), and each inset package after
+    the same package of the LGR parent model. The GWF-GWF exchanges
+    are set up last, once all of the models are.
+
+    Parameters
+    ----------
+    cfg_file : str or pathlike
+        modflow-setup configuration file.
+    cache_dir : str or pathlike
+        Folder for the stage results. By default, 'setup_cache'
+        (in the current folder).
+    force : bool
+        Option to run all of the stages. By default, False.
+    verbose : bool
+        Option to print the stages that were run or restored from
+        the cache, with their timings and the critical path.
+        By default, True.
+
+    Returns
+    -------
+    model : mfsetup.MF6model
+        The model, as returned by ``MF6model.setup_from_yaml``
+        (before ``write_input``). The stage timings are in
+        ``model.setup_tasks`` (a :class:`task_graph.TaskGraph`).
+    """
+    from mfsetup import MF6model
+
+    cfg_file = Path(cfg_file).resolve()
+    cfg_dir = cfg_file.parent
+    cache = StageCache(cache_dir, force=force)
+    raw_cfg = load_yaml(cfg_file)
+    # configuration of the LGR insets, by model name
+    insets = {}
+    for lgr in (raw_cfg.get('setup_grid', {}).get('lgr') or {}).values():
+        inset_file = cfg_dir / lgr['filename']
+        inset_cfg = load_yaml(inset_file)
+        insets[inset_cfg['model']['modelname']] = (inset_cfg, inset_file.parent)
+
+    graph = TaskGraph()
+    cfg = MF6model.load_cfg(str(cfg_file))
+    modelname = cfg['model']['modelname']
+    # the parent model is loaded before the model is made
+    # (which would load it otherwise)
+    parent = {}
+
+    def get_parent():
+        snapshot_dir = cache.cache_dir / 'parent'
+        t0 = time.time()
+        parent['model'] = load_parent(cfg, snapshot_dir)
+        # the snapshot is rewritten if the parent model was loaded
+        loaded = any(f.stat().st_mtime >= t0
+                     for f in snapshot_dir.glob('*.pkl'))
+        return 'run' if loaded else 'cached'
+
+    if 'parent' in raw_cfg:
+        graph.add(f'{modelname}/parent', get_parent)
+        graph.run(max_workers=1)
+    model = MF6model(cfg=cfg, parent=parent.get('model'), **cfg['model'])
+    stage = _Stage(cache, [model])
+    keys = {}
+    # the files that the stages write aren't source files
+    outputs = [stage.sim_path]
+
+    def add(m, name, setup, raw, m_dir, after=(), dependencies=(),
+            extra_blocks=(), cached=True):
+        """Add a stage to the graph, after the stages in after,
+        with a key from the stages in dependencies (and in
+        stage_inputs)."""
+        if name in stage_inputs:
+            deps = [keys.get((m.name, d), keys.get((model.name, d)))
+                    for d in stage_inputs[name][1]]
+        else:
+            # all of the previous stages of the model (and its parent)
+            deps = [key for (owner, _), key in keys.items()
+                    if owner in (m.name, model.name)]
+        deps = [d for d in deps + list(dependencies) if d is not None]
+        blocks = _stage_blocks(name, raw, m_dir, outputs) + list(extra_blocks)
+        key = cache.stage_key(f'{m.name}/{name}', blocks, deps)
+        keys[(m.name, name)] = key
+        task = f'{m.name}/{name}'
+        graph.add(task, lambda: stage.run(m, name, key, setup, cached=cached),
+                  [t for t in after if t in graph.tasks])
+        return task
+
+    # the parent model, grid, time discretization and solver
+    previous = list(graph.tasks)
+    if 'parent' in raw_cfg:
+        keys[(model.name, 'parent')] = cache.stage_key(
+            f'{model.name}/parent',
+            _stage_blocks('parent', raw_cfg, cfg_dir, outputs))
+    if 'grid' not in model.cfg:
+        # the LGR inset models are made with the parent model grid
+        # (this stage isn't cached if there are insets, because
+        # the inset models have to be made in the simulation)
+        inset_blocks = [(f'{name}/{block_name}', inset_cfg.get(block_name),
+                         inset_dir, source_files(inset_cfg.get(block_name),
+                                                 inset_dir, outputs))
+                        for name, (inset_cfg, inset_dir) in insets.items()
+                        for block_name in ('setup_grid', 'dis')]
+        previous = [add(model, 'grid', model.setup_grid, raw_cfg, cfg_dir,
+                        after=previous, extra_blocks=inset_blocks,
+                        cached=not insets)]
+    previous = [add(model, 'tdis', model.setup_tdis, raw_cfg, cfg_dir,
+                    after=previous)]
+    previous = [add(model, 'ims', model.setup_solver, raw_cfg, cfg_dir,
+                    after=previous)]
+    graph.run(max_workers=1)
+
+    # the packages of the model and the LGR insets, as with
+    # setup_packages(reset_existing=False) for the model (skipping
+    # the packages that it already has, e.g. the LGR parent model
+    # DIS package, which is made with the inset grids), and
+    # setup_packages() for the insets
+    stage.models = _models(model)
+    start = previous
+    existing = model.get_package_list()
+    for package in model.package_list:
+        name = package.strip('6')
+        if name in ('tdis', 'ims') or package.upper() in existing:
+            continue
+        previous = [add(model, name,
+                        functools.partial(_setup_package, model, package),
+                        raw_cfg, cfg_dir, after=previous)]
+    for inset in stage.models[1:]:
+        inset_cfg, inset_dir = insets.get(inset.name, (inset.cfg, cfg_dir))
+        previous = start
+        for package in inset.package_list:
+            name = package.strip('6')
+            if name in ('tdis', 'ims'):
+                continue
+            # packages may be inherited from the LGR parent model
+            parent_task = f'{model.name}/{name}'
+            previous = [add(inset, name,
+                            functools.partial(_setup_package, inset, package),
+                            inset_cfg, inset_dir,
+                            after=previous + [parent_task],
+                            dependencies=[keys.get((model.name, 'grid')),
+                                          keys.get((model.name, name))])]
+    graph.run(max_workers=1)
+
+    if len(stage.models) > 1:
+        ends = [task for task in graph.tasks
+                if not any(task in t.dependencies
+                           for t in graph.tasks.values())]
+        graph.add('lgr exchanges', model.setup_lgr_exchanges, ends)
+        graph.run(max_workers=1)
+
+    model.setup_tasks = graph
+    if verbose:
+        print(graph.format_timings())
+    return model
@@ -0,0 +1,211 @@
+"""Fast repeated loading of MODFLOW 6 simulations with flopy.
+
+Most of the part 1 notebooks load a simulation with
+:meth:`flopy.mf6.MFSimulation.load` (wrapped in ``%%capture`` to hide
+the output), and the stream capture notebook loads the same simulation
+again for each scenario. :func:`load_simulation` loads only the
+requested packages (with ``load_only``), optionally defers reading
+external array and list data until it is used (with ``lazy_io``),
+and keeps a snapshot of the loaded simulation (a pickle) in a cache
+folder. The snapshot is used for later loads as long as the input
+files haven't changed, as determined from the SHA-256 hashes of the
+name files, package files and the external files they reference.
+Each load from the snapshot returns a new simulation object, so edits
+to one (e.g. for a scenario) don't affect the others.
+
+Examples
+--------
+>>> sim = load_simulation('data/pleasant-lake', packages=['dis', 'sfr', 'wel'],
+...                       cache_dir='temp/sim_cache')
+>>> gwf = sim.get_model()
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+import pickle
+import flopy
+from mf6_input import split_line
+
+
+def _is_number(token):
+    try:
+        float(token.replace('d', 'e').replace('D', 'e'))
+        return True
+    except ValueError:
+        return False
+
+
+def input_files(sim_ws, sim_name='mfsim.nam'):
+    """List the input files of a simulation.
+
+    Starting with the simulation name file, the files referenced in
+    each input file are found, except for output files (after FILEOUT).
+    Files referenced with OPEN/CLOSE (external arrays and lists) are
+    included, but not searched for more references.
+
+    Parameters
+    ----------
+    sim_ws : str or pathlike
+        Simulation workspace.
+    sim_name : str
+        Simulation name file. By default, 'mfsim.nam'.
+
+    Returns
+    -------
+    files : list of Paths
+        Paths relative to the simulation workspace.
+    """
+    sim_ws = str(sim_ws)
+    files = {sim_name: None}
+    to_search = [sim_name]
+    while to_search:
+        with open(os.path.join(sim_ws, to_search.pop())) as src:
+            for line in src:
+                tokens = split_line(line)
+                if not tokens or tokens[0].startswith(('#', '!', '//')):
+                    continue
+                keywords = [t.lower() for t in tokens]
+                if 'fileout' in keywords:
+                    continue
+                is_external = keywords[0] == 'open/close'
+                for token in tokens[1:] if is_external else tokens:
+                    path = token.strip('\'"')
+                    if path not in files and not _is_number(path) and \
+                            os.path.isfile(os.path.join(sim_ws, path)):
+                        files[path] = None
+                        if not is_external:
+                            to_search.append(path)
+                    if is_external:
+                        break
+    return [Path(path) for path in files]
+
+
+def file_hash(filename, blocksize=2**20):
+    """SHA-256 hash of a file."""
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as src:
+        for block in iter(lambda: src.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _signatures(sim_ws, files, previous=None):
+    """Get the size, modification time and hash of the input files.
+    Hashes in the previous signatures are reused for files with the
+    same size and modification time."""
+    previous = previous or {}
+    signatures = {}
+    for path in files:
+        stat = os.stat(Path(sim_ws) / path)
+        key = str(path)
+        prev = previous.get(key)
+        if prev is not None and prev[:2] == [stat.st_size, stat.st_mtime]:
+            signatures[key] = prev
+        else:
+            signatures[key] = [stat.st_size, stat.st_mtime,
+                               file_hash(Path(sim_ws) / path)]
+    return signatures
+
+
+def _unchanged(sim_ws, signatures):
+    """Check whether the files have the same size and modification
+    time as in the signatures."""
+    for path, (size, mtime, _) in signatures.items():
+        try:
+            stat = os.stat(os.path.join(sim_ws, path))
+        except FileNotFoundError:
+            return False
+        if stat.st_size != size or stat.st_mtime != mtime:
+            return False
+    return True
+
+
+def _same_inputs(signatures, previous):
+    """Check that the input files are the same (by their hashes)."""
+    if previous is None or set(signatures) != set(previous):
+        return False
+    return all(signatures[key][2] == previous[key][2] for key in signatures)
+
+
+def load_simulation(sim_ws, packages=None, lazy=False, cache_dir=None,
+                    sim_name='mfsim.nam', verbosity_level=0, **kwargs):
+    """Load a MODFLOW 6 simulation with flopy, optionally loading
+    only some of the packages, deferring external data, and using
+    a snapshot of the previous load if the input hasn't changed.
+
+    Parameters
+    ----------
+    sim_ws : str or pathlike
+        Simulation workspace.
+    packages : list of str, optional
+        Packages to load (e.g. ``['dis', 'sfr', 'wel']``), passed to
+        ``MFSimulation.load(load_only=...)``. The discretization,
+        solution and time discretization packages (and subpackages,
+        like observations) are always loaded. By default, all packages.
+    lazy : bool
+        Option to defer reading external array and list data until it is
+        used (``MFSimulation.load(lazy_io=True)``). By default, False.
+    cache_dir : str or pathlike, optional
+        Folder for snapshots of loaded simulations. By default,
+        no snapshots.
+    sim_name : str
+        Simulation name file. By default, 'mfsim.nam'.
+    verbosity_level : int
+        Flopy verbosity level. By default, 0 (no output).
+    **kwargs
+        Other keyword arguments to :meth:`flopy.mf6.MFSimulation.load`.
+
+    Returns
+    -------
+    sim : flopy.mf6.MFSimulation
+    """
+    sim_ws = Path(sim_ws)
+    load_kwargs = dict(sim_ws=str(sim_ws), verbosity_level=verbosity_level,
+                       load_only=packages, lazy_io=lazy, **kwargs)
+    if cache_dir is None:
+        return flopy.mf6.MFSimulation.load(**load_kwargs)
+
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # flopy stores the absolute simulation path
+    options = json.dumps({**load_kwargs, 'sim_ws': str(sim_ws.resolve()),
+                          'sim_name': sim_name, 'flopy': flopy.__version__},
+                         sort_keys=True, default=str)
+    key = hashlib.sha1(options.encode()).hexdigest()[:16]
+    snapshot = cache_dir / f'{sim_ws.resolve().name}-{key}.pkl'
+    sidecar = Path(f'{snapshot}.json')
+
+    previous = None
+    if snapshot.exists() and sidecar.exists():
+        with open(sidecar) as src:
+            previous = json.load(src)['files']
+    if previous is not None and _unchanged(sim_ws, previous):
+        # none of the files with references to other files
+        # have changed, so the list of input files is the same
+        files = previous
+    else:
+        files = input_files(sim_ws, sim_name)
+    signatures = _signatures(sim_ws, files, previous)
+    if _same_inputs(signatures, previous):
+        try:
+            with open(snapshot, 'rb') as src:
+                sim = pickle.load(src)
+            if signatures != previous:
+                # only the modification times changed
+                _write_sidecar(sidecar, options, signatures)
+            return sim
+        except Exception as e:
+            print(f'could not load snapshot {snapshot}:\n{e}\nreloading...')
+
+    sim = flopy.mf6.MFSimulation.load(**load_kwargs)
+    with open(snapshot, 'wb') as dest:
+        pickle.dump(sim, dest, protocol=pickle.HIGHEST_PROTOCOL)
+    _write_sidecar(sidecar, options, signatures)
+    return sim
+
+
+def _write_sidecar(sidecar, options, signatures):
+    with open(sidecar, 'w') as dest:
+        json.dump({'options': json.loads(options), 'files': signatures},
+                  dest, indent=2)
@@ -0,0 +1,180 @@
+"""Run tasks with dependencies on a pool of threads, with timings.
+
+Each task starts as soon as the tasks it depends on are finished
+(tasks that are ready at the same time start in the order they were
+added; with one worker, the tasks run in the order they were added,
+which has to be an order in which dependencies come first). The start
+and end time of each task are recorded, and the critical path (the
+chain of tasks that determined the total time) is found from them.
+
+Examples
+--------
+>>> graph = TaskGraph()
+>>> graph.add('grid', setup_grid)
+>>> graph.add('parent/dis', setup_parent_dis, ['grid'])
+>>> graph.add('inset/dis', setup_inset_dis, ['grid'])
+>>> graph.add('exchange', setup_exchange, ['parent/dis', 'inset/dis'])
+>>> graph.run(max_workers=2)
+>>> print(graph.format_timings())
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import time
+
+
+class Task:
+    """A task, with its start and end times once it has run."""
+    def __init__(self, name, func, dependencies=()):
+        self.name = name
+        self.func = func
+        self.dependencies = list(dependencies)
+        self.start = None
+        self.end = None
+        self.status = None
+
+    @property
+    def elapsed(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class TaskGraph:
+    """Tasks with dependencies, run on a pool of threads.
+
+    Tasks can be added after the graph is run (e.g. tasks that depend
+    on the results of the first tasks); :meth:`run` only runs the
+    tasks that haven't been run yet.
+    """
+    def __init__(self):
+        self.tasks = {}
+        self._t0 = None
+
+    def add(self, name, func, dependencies=()):
+        """Add a task.
+
+        Parameters
+        ----------
+        name : str
+            Unique task name.
+        func : callable
+            Function to run (without arguments). If it returns a
+            string, it is recorded as the task status (by default, 'ok').
+        dependencies : sequence of str
+            Names of the tasks that have to be finished first.
+        """
+        if name in self.tasks:
+            raise ValueError(f'duplicate task: {name}')
+        unknown = [d for d in dependencies if d not in self.tasks]
+        if unknown:
+            raise ValueError(f'{name} depends on unknown tasks: {unknown}')
+        self.tasks[name] = Task(name, func, dependencies)
+
+    def _run_task(self, task):
+        task.start = time.perf_counter() - self._t0
+        try:
+            status = task.func()
+            task.status = status if isinstance(status, str) else 'ok'
+        except BaseException:
+            task.status = 'failed'
+            raise
+        finally:
+            task.end = time.perf_counter() - self._t0
+
+    def run(self, max_workers=None):
+        """Run the tasks that haven't been run yet.
+
+        Parameters
+        ----------
+        max_workers : int, optional
+            Number of tasks to run at once. By default, the number
+            of cores.
+
+        If a task fails, no more tasks are started, and the error
+        is raised once the running tasks are finished.
+        """
+        if self._t0 is None:
+            self._t0 = time.perf_counter()
+        pending = [task for task in self.tasks.values() if task.status is None]
+        waiting = {task.name: {d for d in task.dependencies
+                               if self.tasks[d].status is None}
+                   for task in pending}
+        if max_workers == 1:
+            for task in pending:
+                self._run_task(task)
+            return
+        error = None
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = {}
+
+            def submit_ready():
+                for task in pending:
+                    if task.name in waiting and not waiting[task.name]:
+                        del waiting[task.name]
+                        running[executor.submit(self._run_task, task)] = task
+
+            submit_ready()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                        continue
+                    for remaining in waiting.values():
+                        remaining.discard(task.name)
+                if error is None:
+                    submit_ready()
+        if error is not None:
+            raise error
+
+    def critical_path(self):
+        """The chain of tasks that determined the total time: from the
+        last task to finish, back through the dependencies that
+        finished last.
+
+        Returns
+        -------
+        names : list of str
+            Task names, in the order they ran.
+        """
+        finished = [task for task in self.tasks.values()
+                    if task.end is not None]
+        if not finished:
+            return []
+        task = max(finished, key=lambda t: t.end)
+        path = [task.name]
+        while task.dependencies:
+            task = max((self.tasks[d] for d in task.dependencies),
+                       key=lambda t: t.end or 0)
+            path.append(task.name)
+        return path[::-1]
+
+    def timings(self):
+        """Start, end and elapsed times of the tasks, in seconds
+        (from the start of the first run), as a list of dicts."""
+        critical = set(self.critical_path())
+        return [{'task': task.name, 'status': task.status,
+                 'start': task.start, 'end': task.end,
+                 'time': task.elapsed, 'critical': task.name in critical}
+                for task in self.tasks.values()]
+
+    def format_timings(self):
+        """Format the task timings as a text table
+        (with the tasks on the critical path marked with a *)."""
+        rows = self.timings()
+        width = max([len(row['task']) for row in rows] + [4])
+        lines = [f"{'task':<{width}} {'status':<7} {'start':>8} {'end':>8} "
+                 f"{'time (s)':>9}"]
+        for row in rows:
+            if row['start'] is None:
+                lines.append(f"{row['task']:<{width}} not run")
+                continue
+            lines.append(f"{row['task']:<{width}} {row['status']:<7} "
+                         f"{row['start']:8.2f} {row['end']:8.2f} "
+                         f"{row['time']:9.2f}" + (' *' if row['critical'] else ''))
+        total = max((row['end'] for row in rows if row['end'] is not None),
+                    default=0.)
+        busy = sum(row['time'] for row in rows if row['time'] is not None)
+        lines.append(f'\n{total:.2f} s in total ({busy:.2f} s of task time; '
+                     '* critical path)')
+        return '\n'.join(lines)
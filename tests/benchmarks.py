@@ -0,0 +1,428 @@
+"""Benchmarks for the reusable functions in the notebooks.
+
+Each benchmark runs a function over a range of problem sizes (grid
+sizes from 10^2 to 10^7 points, polylines from 10 to 10^5 vertices, and
+1 to 1,000 wells), and records the time per call and the peak memory
+allocated during a call (with tracemalloc, in a separate call, so
+that the tracing doesn't affect the timing). Sizes that are predicted
+to take longer than a time limit per call (from how the time grew
+between the previous sizes) are skipped.
+
+Each run is appended to a history file (JSON lines), with the git
+commit, the machine and the package versions, so that runs for
+different commits can be compared::
+
+    python tests/benchmarks.py run
+    python tests/benchmarks.py run -k densify --max-time 30
+    python tests/benchmarks.py compare            # last two runs
+    python tests/benchmarks.py compare --base 1f39cb4 --threshold 0.2
+"""
+import argparse
+from dataclasses import dataclass
+import datetime
+import fnmatch
+import importlib.metadata
+import importlib.util
+import json
+import math
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+
+
+repo_root = Path(__file__).parent.parent.resolve()
+default_history = Path(__file__).parent / 'benchmark_history.jsonl'
+
+grid_sizes = [10**2, 10**3, 10**4, 10**5, 10**6, 10**7]
+vertex_counts = [10, 10**2, 10**3, 10**4, 10**5]
+well_counts = [1, 10, 100, 1000]
+
+packages = ['numpy', 'scipy', 'shapely', 'flopy']
+
+
+def _load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, repo_root / path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def modules():
+    """The modules with the benchmarked functions."""
+    return {
+        'theis': _load_module(
+            'theis_exercise',
+            'notebooks/part0_python_intro/bonus_examples/solutions/'
+            'Theis-exercise-solution.py'),
+        'theis_uncertainty': _load_module(
+            'theis_uncertainty',
+            'notebooks/part0_python_intro/bonus_examples/solutions/'
+            'theis_uncertainty.py'),
+        'basin': _load_module('basin', 'notebooks/part1_flopy/basin.py'),
+        'project_grid_functions': _load_module(
+            'project_grid_functions',
+            'notebooks/part1_flopy/solutions/project_grid_functions.py'),
+    }
+
+
+def _grid(n):
+    """x, y coordinates of a square grid of about n points."""
+    side = max(1, int(round(math.sqrt(n))))
+    return np.meshgrid(np.arange(side, dtype=float),
+                       np.arange(side, dtype=float))
+
+
+def _polyline(n, seed=0):
+    """Random walk with n vertices and segments about 10 units long
+    (so that densifying with a step of 1 gives about 10 points
+    per segment)."""
+    rng = np.random.default_rng(seed)
+    angles = rng.uniform(0, 2 * np.pi, n - 1)
+    steps = np.column_stack([np.cos(angles), np.sin(angles)]) * 10
+    xy = np.vstack([[0., 0.], np.cumsum(steps, axis=0)])
+    return [tuple(p) for p in xy]
+
+
+def _wells(n, side, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0, side, (n, 2))
+
+
+@dataclass
+class Benchmark:
+    """A function to benchmark over a range of sizes.
+
+    Parameters
+    ----------
+    name : str
+    sizes : list of int
+    setup : callable
+        Function of the modules and a size that returns a function
+        (with no arguments) to time.
+    unit : str
+        What the size counts.
+    """
+    name: str
+    sizes: list
+    setup: object
+    unit: str = 'points'
+
+
+# setup functions, which return a function (with no arguments) to time
+def _theis(m, n):
+    r = np.linspace(1., 1e4, n)
+    return lambda: m['theis'].theis(r, 10, Q=4088, T=1000, S=3e-4)
+
+
+def _get_distance(m, n):
+    x, y = _grid(n)
+    return lambda: m['theis'].get_distance(x, y, 500., 500.)
+
+
+def _theis_xy(m, n):
+    x, y = _grid(n)
+    return lambda: m['theis'].theis_xy(x, y, (500., 500.), 10,
+                                       Q=4088, T=1000, S=3e-4)
+
+
+def _theis_xy_wells(m, n):
+    """Superposition of the drawdown from n wells on a 100 x 100 grid."""
+    x, y = _grid(10**4)
+    wells = _wells(n, 100)
+
+    def superpose():
+        s = np.zeros_like(x)
+        for well_xy in wells:
+            s += m['theis'].theis_xy(x, y, well_xy, 10,
+                                     Q=4088, T=1000, S=3e-4)[0]
+        return s
+    return superpose
+
+
+def _theis_quantiles(m, n):
+    """P5/P50/P95 drawdown from 256 realizations (in this process,
+    so that the memory is traced)."""
+    from scipy import stats
+    x, y = _grid(n)
+    T = stats.lognorm(s=0.5, scale=1000)
+    S = stats.loguniform(1e-4, 1e-3)
+    return lambda: m['theis_uncertainty'].theis_quantiles(
+        x, y, (500.5, 500.5), 10, T=T, S=S, Q=4088, n_realizations=256,
+        max_workers=1)
+
+
+def _densify_geometry(m, n):
+    line = _polyline(n)
+    return lambda: m['basin'].densify_geometry(line, 1.)
+
+
+def _densify_polyline(m, n):
+    import shapely
+    line = shapely.LineString(_polyline(n))
+    return lambda: m['project_grid_functions'].densify_polyline(line, 1.)
+
+
+def _string2geom(m, n):
+    text = '\n'.join(f'{x:.18e} {y:.18e}' for x, y in _polyline(n))
+    return lambda: m['basin'].string2geom(text, conversion=0.3048)
+
+
+def _circle_function(m, n):
+    return lambda: m['basin'].circle_function(center=(0, 0), radius=100.,
+                                              dtheta=360. / n)
+
+
+benchmarks = [
+    Benchmark('theis', grid_sizes, _theis),
+    Benchmark('get_distance', grid_sizes, _get_distance),
+    Benchmark('theis_xy', grid_sizes, _theis_xy),
+    Benchmark('theis_xy_wells', well_counts, _theis_xy_wells, unit='wells'),
+    Benchmark('theis_quantiles', grid_sizes, _theis_quantiles),
+    Benchmark('densify_geometry', vertex_counts, _densify_geometry,
+              unit='vertices'),
+    Benchmark('densify_polyline', vertex_counts, _densify_polyline,
+              unit='vertices'),
+    Benchmark('string2geom', vertex_counts, _string2geom, unit='vertices'),
+    Benchmark('circle_function', vertex_counts, _circle_function,
+              unit='vertices'),
+]
+
+
+def time_call(func, min_time=0.2, repeat=3):
+    """Time a function, calling it enough times to take at least
+    min_time per repeat (with fewer repeats for slow functions).
+
+    Returns
+    -------
+    best, median : float
+        Time per call, in seconds.
+    """
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    if elapsed > 1:
+        return elapsed, elapsed
+    number = max(1, int(min_time / max(elapsed, 1e-9)))
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return min(times), statistics.median(times)
+
+
+def peak_memory(func):
+    """Peak memory allocated during a call, in MB."""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def run(names=None, max_time=10., quick=False, verbose=True):
+    """Run the benchmarks.
+
+    Parameters
+    ----------
+    names : list of str, optional
+        Benchmarks to run (glob patterns). By default, all.
+    max_time : float
+        Sizes for which a call is predicted to take longer than this,
+        in seconds, are skipped.
+    quick : bool
+        Option to only run the smallest size of each benchmark,
+        once (e.g. to check that the benchmarks work).
+    verbose : bool
+        Option to print the results as they are run.
+
+    Returns
+    -------
+    results : list of dicts
+        With benchmark, size, unit, time (best time per call, in
+        seconds), median_time and peak_mb items.
+    """
+    loaded = modules()
+    results = []
+    for benchmark in benchmarks:
+        if names and not any(fnmatch.fnmatch(benchmark.name, pattern)
+                             for pattern in names):
+            continue
+        sizes = benchmark.sizes[:1] if quick else benchmark.sizes
+        previous = []
+        for size in sizes:
+            if len(previous) == 2:
+                # predict the time from the growth between the last two sizes
+                (n0, t0), (n1, t1) = previous
+                exponent = max(1., math.log(t1 / t0) / math.log(n1 / n0)) \
+                    if t0 > 0 and t1 > 0 else 1.
+                if t1 * (size / n1) ** exponent > max_time:
+                    if verbose:
+                        print(f'{benchmark.name:>20} {size:>10} {benchmark.unit:<8} '
+                              'skipped (predicted to exceed --max-time)')
+                    continue
+            func = benchmark.setup(loaded, size)
+            if quick:
+                start = time.perf_counter()
+                func()
+                best = median = time.perf_counter() - start
+            else:
+                best, median = time_call(func)
+            peak = peak_memory(func)
+            results.append({'benchmark': benchmark.name, 'size': size,
+                            'unit': benchmark.unit, 'time': best,
+                            'median_time': median, 'peak_mb': peak})
+            previous = (previous + [(size, best)])[-2:]
+            if verbose:
+                print(f'{benchmark.name:>20} {size:>10} {benchmark.unit:<8} '
+                      f'{_format_time(best):>10} {peak:10.1f} MB')
+    return results
+
+
+def _format_time(seconds):
+    for unit, factor in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= factor:
+            return f'{seconds / factor:.3g} {unit}'
+    return f'{seconds / 1e-9:.3g} ns'
+
+
+def git_commit():
+    """The current git commit (with '+' added if there are
+    uncommitted changes), or None."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=repo_root, capture_output=True,
+                                check=True, text=True).stdout.strip()
+        changes = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                 cwd=repo_root, capture_output=True,
+                                 check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if changes else '')
+
+
+def record(results):
+    """A history record for a run."""
+    versions = {}
+    for name in packages:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    return {'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'machine': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'packages': versions,
+            'results': results}
+
+
+def append_history(run_record, history=default_history):
+    with open(history, 'a') as dest:
+        dest.write(json.dumps(run_record) + '\n')
+
+
+def read_history(history=default_history):
+    """Read the history of runs (oldest first)."""
+    with open(history) as src:
+        return [json.loads(line) for line in src if line.strip()]
+
+
+def compare(base, new, threshold=0.2):
+    """Compare the results of two runs.
+
+    Returns
+    -------
+    rows : list of dicts
+        One per benchmark and size in both runs, with the ratio of
+        the new to the base time and peak memory, and a flag for
+        regressions (ratios above 1 + threshold).
+    """
+    base_results = {(r['benchmark'], r['size']): r for r in base['results']}
+    rows = []
+    for result in new['results']:
+        prev = base_results.get((result['benchmark'], result['size']))
+        if prev is None:
+            continue
+        time_ratio = result['time'] / prev['time'] if prev['time'] else math.inf
+        memory_ratio = result['peak_mb'] / prev['peak_mb'] \
+            if prev['peak_mb'] > 0.01 else 1.
+        rows.append({'benchmark': result['benchmark'], 'size': result['size'],
+                     'base_time': prev['time'], 'time': result['time'],
+                     'time_ratio': time_ratio, 'base_peak_mb': prev['peak_mb'],
+                     'peak_mb': result['peak_mb'], 'memory_ratio': memory_ratio,
+                     'regression': time_ratio > 1 + threshold or
+                     memory_ratio > 1 + threshold})
+    return rows
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--history', default=default_history,
+                        help='history file (JSON lines)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('-k', dest='names', action='append',
+                            help='benchmarks to run (glob pattern; '
+                                 'can be repeated)')
+    run_parser.add_argument('--max-time', type=float, default=10.,
+                            help='skip sizes predicted to take longer '
+                                 'than this per call, in seconds')
+    run_parser.add_argument('--quick', action='store_true',
+                            help='only run the smallest sizes, once')
+    run_parser.add_argument('--no-save', action='store_true',
+                            help="don't add the run to the history")
+    comp = subparsers.add_parser('compare', help='compare two runs')
+    comp.add_argument('--base', help='commit of the base run (by default, '
+                                     'the run before the last one)')
+    comp.add_argument('--new', help='commit of the run to compare (by '
+                                    'default, the last one)')
+    comp.add_argument('--threshold', type=float, default=0.2,
+                      help='relative increase in time or memory that '
+                           'counts as a regression (default 0.2)')
+    args = parser.parse_args(args)
+
+    if args.command == 'run':
+        results = run(args.names, max_time=args.max_time, quick=args.quick)
+        if not args.no_save:
+            append_history(record(results), args.history)
+            print(f'\nadded to {args.history}')
+        return 0
+
+    history = read_history(args.history)
+
+    def find(commit, default):
+        if commit is None:
+            return history[default] if len(history) >= -default else None
+        matches = [r for r in history
+                   if r['commit'] and r['commit'].startswith(commit)]
+        return matches[-1] if matches else None
+    new = find(args.new, -1)
+    base = find(args.base, -2)
+    if new is None or base is None:
+        print(f'need two runs in {args.history} to compare')
+        return 2
+    print(f"base: {base['commit']} ({base['date']}), "
+          f"new: {new['commit']} ({new['date']})\n")
+    rows = compare(base, new, threshold=args.threshold)
+    print(f"{'benchmark':>20} {'size':>10} {'base':>10} {'new':>10} "
+          f"{'ratio':>6} {'base MB':>8} {'new MB':>8}")
+    for row in rows:
+        flag = '  <-- regression' if row['regression'] else ''
+        print(f"{row['benchmark']:>20} {row['size']:>10} "
+              f"{_format_time(row['base_time']):>10} "
+              f"{_format_time(row['time']):>10} {row['time_ratio']:6.2f} "
+              f"{row['base_peak_mb']:8.1f} {row['peak_mb']:8.1f}{flag}")
+    return 1 if any(row['regression'] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,28 @@
+import json
+from pathlib import Path
+from notebook_timings import read_timings
+
+
+def pytest_addoption(parser):
+    parser.addoption('--force', action='store_true', default=False,
+                     help='execute all of the notebooks, including '
+                          'those with a cached result for their '
+                          'current content')
+    parser.addoption('--timings', default=None, metavar='PATH',
+                     help='write the wall time and peak memory use of '
+                          'each notebook cell to a JSON file')
+
+
+def pytest_sessionfinish(session):
+    # merge the timing files from the pytest-xdist workers
+    timings = session.config.getoption('timings')
+    if timings is None or hasattr(session.config, 'workerinput'):
+        return
+    timings = Path(timings)
+    parts = sorted(timings.parent.glob(f'{timings.name}.*.part'))
+    if parts:
+        merged = read_timings(*parts)
+        with open(timings, 'w') as dest:
+            json.dump(merged, dest, indent=2)
+        for part in parts:
+            part.unlink()
@@ -0,0 +1,329 @@
+"""Content-addressed cache of notebook test results.
+
+A notebook only needs to be executed again if something it depends on
+has changed. The cache key for a notebook
+(:meth:`ExecutionCache.notebook_key`) is a hash of:
+
+* the source of its code cells (so that edits to markdown cells, or
+  cleared or updated outputs, don't count as changes);
+* the files it reads in the data folders (``notebooks/*/data*``), as
+  found from the paths and file names in the code cells;
+* the local modules it imports (e.g. ``basin.py`` or
+  ``project_grid_functions.py``), and the local modules they import;
+* the versions of the installed packages that it (or the local modules)
+  imports, the Python version and the platform, and the MODFLOW
+  executables on the path.
+
+The result of executing the notebook is saved under the key, so that
+the next run with the same key can report it without executing the
+notebook. Only passes are saved, and the failures of notebooks that
+are expected to fail (a failure may be transient, e.g. a failed
+download; see :class:`notebook_runner.NotebookExecutor`).
+"""
+from functools import lru_cache
+import glob
+import hashlib
+import importlib.metadata
+import json
+import os
+from pathlib import Path
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import nbformat
+
+
+repo_root = Path(__file__).parent.parent.resolve()
+notebooks_root = repo_root / 'notebooks'
+
+# executables that notebooks run
+executables = ['mf6', 'mp7', 'gridgen', 'triangle']
+
+# files that list other files to read (e.g. Modflow-setup configuration
+# files); the whole folder containing them is included
+config_suffixes = {'.yml', '.yaml', '.nam'}
+
+string_literal = re.compile(r"""(?:'([^'\n]*)'|"([^"\n]*)")""")
+import_statement = re.compile(r'^\s*(?:from|import)\s+(\w+)', re.MULTILINE)
+
+
+def _hash_file(filename, blocksize=2**20):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as src:
+        for block in iter(lambda: src.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+@lru_cache()
+def _platform_signature():
+    """The Python version, the platform and the MODFLOW executables
+    (by their size and modification time), as a string."""
+    lines = [sys.version, platform.platform()]
+    for exe in executables:
+        path = shutil.which(exe)
+        if path is not None:
+            stat = os.stat(path)
+            lines.append(f'{exe} {stat.st_size} {stat.st_mtime}')
+    return '\n'.join(lines)
+
+
+@lru_cache()
+def _module_distributions():
+    """Installed distributions, by the top-level modules they provide."""
+    return importlib.metadata.packages_distributions()
+
+
+@lru_cache()
+def _distribution_version(name):
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def environment_signature(modules=()):
+    """Versions of the installed packages that provide the modules
+    (e.g. the modules that a notebook imports), the Python version,
+    the platform and the MODFLOW executables, as a string.
+
+    Parameters
+    ----------
+    modules : sequence of str
+        Top-level module names (e.g. 'flopy', or 'matplotlib' for
+        ``import matplotlib.pyplot``). Modules that aren't from
+        installed packages (e.g. the standard library, or local
+        modules) are skipped.
+    """
+    distributions = sorted({name.lower() for module in modules
+                            for name in _module_distributions().get(module, [])})
+    lines = [_platform_signature()]
+    lines += [f'{name}=={_distribution_version(name)}'
+              for name in distributions]
+    return '\n'.join(lines)
+
+
+@lru_cache()
+def tracked_files():
+    """Files in the data folders that are tracked by git (so that
+    files that notebooks write to the data folders aren't counted as
+    inputs), or None if git isn't available."""
+    try:
+        proc = subprocess.run(['git', 'ls-files', '-z', 'notebooks'],
+                              cwd=repo_root, capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return frozenset((repo_root / path).resolve()
+                     for path in proc.stdout.decode().split('\0') if path)
+
+
+def _is_input(path):
+    tracked = tracked_files()
+    return path.is_file() and (tracked is None or path in tracked)
+
+
+@lru_cache()
+def data_folders():
+    """The data folders of the notebooks (``notebooks/*/data*``)."""
+    return tuple(sorted(p for p in notebooks_root.glob('*/data*')
+                        if p.is_dir()))
+
+
+@lru_cache()
+def _data_index():
+    """Relative paths of the files in the data folders (with forward
+    slashes), by data folder."""
+    index = {}
+    for folder in data_folders():
+        index[folder] = [path.relative_to(folder).as_posix()
+                         for path in sorted(folder.rglob('*'))
+                         if _is_input(path)]
+    return index
+
+
+def _data_folder(path):
+    for folder in data_folders():
+        if path == folder or folder in path.parents:
+            return folder
+
+
+def _expand(path):
+    """Files for a referenced data path: all files in a folder,
+    all files in the folder containing a configuration file, or the
+    files with the same name as a file (e.g. the .dbf, .shx and .prj
+    files of a shapefile)."""
+    if path.is_file() and path.suffix.lower() in config_suffixes:
+        path = path.parent
+    if path.is_dir():
+        return [p for p in path.rglob('*') if _is_input(p)]
+    return [p for p in path.parent.glob(f'{glob.escape(path.stem)}.*')
+            if _is_input(p)]
+
+
+def data_files(notebook, source=None):
+    """Find the files in the data folders that a notebook reads.
+
+    String literals in the code cells are taken as references to data
+    files if they are paths (relative to the notebook) to files or
+    folders in a data folder, or if they match the end of the path of a
+    file in a data folder (for example, a file name that is joined to
+    a data folder path). Paths formatted with variables, or with glob
+    patterns, are taken to reference the folder before the first
+    variable or pattern. Folders, and configuration files, which list
+    other files to read, stand for all of the files in the folder;
+    other files stand for all of the files with the same name
+    (e.g. the parts of a shapefile).
+
+    Parameters
+    ----------
+    notebook : pathlike
+    source : str, optional
+        Source of the code cells. By default, read from the notebook.
+
+    Returns
+    -------
+    files : list of Paths
+        Sorted absolute paths.
+    """
+    notebook = Path(notebook).resolve()
+    if source is None:
+        source = code_source(notebook)
+    files = set()
+    for match in string_literal.finditer(source):
+        literal = (match.group(1) or match.group(2) or '').strip()
+        literal = re.split(r'[{*?\[]', literal)[0]
+        if not literal or literal in ('.', '..', '/'):
+            continue
+        path = (notebook.parent / literal).resolve()
+        if path.exists() and _data_folder(path) is not None and \
+                path != notebook.parent:
+            files.update(_expand(path))
+            continue
+        name = literal.replace('\\', '/').strip('./')
+        if not name:
+            continue
+        for folder, relative_paths in _data_index().items():
+            for relative_path in relative_paths:
+                if relative_path == name or relative_path.endswith('/' + name):
+                    files.update(_expand(folder / relative_path))
+    return sorted(files)
+
+
+def local_modules(notebook, source=None):
+    """Find the local modules (in the notebook folder or its parent)
+    that a notebook imports, and the local modules that they import.
+
+    Returns
+    -------
+    modules : list of Paths
+        Sorted absolute paths.
+    """
+    notebook = Path(notebook).resolve()
+    if source is None:
+        source = code_source(notebook)
+    search = [notebook.parent, notebook.parent.parent]
+    modules = set()
+    to_search = [source]
+    while to_search:
+        for name in import_statement.findall(to_search.pop()):
+            for folder in search:
+                module = folder / f'{name}.py'
+                if module.is_file():
+                    if module not in modules:
+                        modules.add(module)
+                        to_search.append(module.read_text(errors='replace'))
+                    break
+    return sorted(modules)
+
+
+def code_source(notebook):
+    """Source of the code cells of a notebook."""
+    nb = nbformat.read(notebook, as_version=4)
+    return '\n'.join(cell.source for cell in nb.cells
+                     if cell.cell_type == 'code')
+
+
+class ExecutionCache:
+    """Results of executing notebooks, by :meth:`notebook_key`.
+
+    Parameters
+    ----------
+    cache_dir : pathlike
+        Folder for the results (one JSON file per key).
+    force : bool
+        Option to ignore the saved results (results are still saved).
+        By default, False.
+    """
+    def __init__(self, cache_dir, force=False):
+        self.cache_dir = Path(cache_dir)
+        self.force = force
+        self._hashes = {}
+
+    def file_hash(self, filename):
+        """SHA-256 hash of a file, reused for files with the same
+        size and modification time."""
+        stat = os.stat(filename)
+        key = (str(filename), stat.st_size, stat.st_mtime)
+        if key not in self._hashes:
+            self._hashes[key] = _hash_file(filename)
+        return self._hashes[key]
+
+    def notebook_key(self, notebook):
+        """Cache key for a notebook (a SHA-256 hash of its code cells,
+        data files, local modules, the versions of the packages they
+        import, and the platform).
+
+        Returns
+        -------
+        key : str
+        """
+        notebook = Path(notebook).resolve()
+        source = code_source(notebook)
+        sha = hashlib.sha256()
+        sha.update(notebook.relative_to(repo_root).as_posix().encode())
+        sha.update(source.encode())
+        modules = local_modules(notebook, source)
+        for path in modules + data_files(notebook, source):
+            sha.update(path.relative_to(repo_root).as_posix().encode())
+            sha.update(self.file_hash(path).encode())
+        imports = set(import_statement.findall(source))
+        for module in modules:
+            imports.update(import_statement.findall(
+                module.read_text(errors='replace')))
+        sha.update(environment_signature(sorted(imports)).encode())
+        return sha.hexdigest()
+
+    def get(self, notebook, key=None):
+        """Get the saved result for a notebook.
+
+        Returns
+        -------
+        entry : dict or None
+            With 'notebook', 'passed', 'error' and 'elapsed' items;
+            None if there is no saved result for the notebook as it is
+            (or if force=True).
+        """
+        if self.force:
+            return None
+        key = key or self.notebook_key(notebook)
+        try:
+            with open(self.cache_dir / f'{key}.json') as src:
+                return json.load(src)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, notebook, result, key=None):
+        """Save the result of executing a notebook
+        (a :class:`notebook_runner.NotebookResult`)."""
+        key = key or self.notebook_key(notebook)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry = {'notebook': Path(notebook).resolve().relative_to(repo_root).as_posix(),
+                 'passed': result.passed,
+                 'error': None if result.error is None else str(result.error),
+                 'elapsed': result.elapsed}
+        tmp = self.cache_dir / f'{key}.json.tmp'
+        with open(tmp, 'w') as dest:
+            json.dump(entry, dest, indent=2)
+        os.replace(tmp, self.cache_dir / f'{key}.json')
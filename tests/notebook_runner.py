@@ -0,0 +1,405 @@
+"""In-process execution of the notebooks for the test suite.
+
+Running each notebook with ``jupyter nbconvert --execute`` in a
+subprocess pays the Jupyter startup, the kernel startup and the imports
+of the heavy packages (flopy, geopandas, rasterio, ...) for every
+notebook, one notebook at a time. Here, notebooks are executed with
+nbclient, on kernels from a :class:`KernelPool` that are started ahead
+of time (with the heavy packages already imported), and several
+notebooks can be executed at once (in threads, or in pytest-xdist
+workers).
+
+So that notebooks running at the same time don't write over each
+other's output, each notebook is run in its own scratch copy of the
+repository (see :func:`make_scratch_dir`), in which the part of the
+course with the notebook (e.g. ``notebooks/part1_flopy``, with its
+``data/`` and ``figures/`` folders and the other notebook folders
+that the notebooks refer to) is copied, and everything else is linked
+to the repository. Files and folders that a notebook creates or
+changes (e.g. ``temp/`` model workspaces, or results written to
+``data/``) are written in the scratch folder.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+from pathlib import Path
+import queue
+import shutil
+import threading
+import time
+from jupyter_client import AsyncKernelManager
+from jupyter_core.utils import run_sync
+import nbformat
+from nbclient import NotebookClient
+from nbclient.exceptions import CellExecutionError
+from notebook_timings import CellRecorder
+
+
+repo_root = Path(__file__).parent.parent.resolve()
+
+# depth of the folder (from the repository root) that is copied for
+# each notebook: the part of the course (e.g. notebooks/part1_flopy)
+copy_depth = 2
+
+# packages imported in the kernels ahead of time
+warm_imports = ['numpy', 'pandas', 'matplotlib.pyplot', 'scipy', 'shapely',
+                'pyproj', 'rasterio', 'geopandas', 'xarray', 'flopy']
+
+
+class KernelPool:
+    """Pool of kernels that are started (and warmed up, by importing
+    the commonly used packages) in the background, before they are
+    needed. Each kernel is used for one notebook, and then shut down.
+
+    Parameters
+    ----------
+    size : int
+        Number of kernels to keep ready.
+    kernel_name : str
+        By default, 'python3'.
+    imports : list of str
+        Modules to import in each kernel before it is used.
+        Modules that aren't installed are skipped.
+    """
+    def __init__(self, size=1, kernel_name='python3', imports=None):
+        self.kernel_name = kernel_name
+        self.imports = warm_imports if imports is None else imports
+        self._ready = queue.Queue()
+        self._starter = ThreadPoolExecutor(max_workers=max(1, size))
+        self._closed = False
+        for i in range(size):
+            self._starter.submit(self._start)
+
+    def _start(self):
+        if self._closed:
+            return
+        km = AsyncKernelManager(kernel_name=self.kernel_name)
+        try:
+            run_sync(km.start_kernel)(cwd=str(repo_root))
+            kc = km.blocking_client()
+            kc.start_channels()
+            kc.wait_for_ready(timeout=120)
+            code = '\n'.join(f'try:\n    import {module}\nexcept ImportError:\n    pass'
+                             for module in self.imports)
+            kc.execute_interactive(code, silent=True, store_history=False,
+                                   timeout=300)
+            kc.stop_channels()
+        except Exception as e:
+            shutdown_kernel(km)
+            self._ready.put(e)
+            return
+        self._ready.put(km)
+
+    def get(self):
+        """Get a started kernel (an AsyncKernelManager), and start
+        another one to replace it."""
+        km = self._ready.get()
+        self._starter.submit(self._start)
+        if isinstance(km, Exception):
+            raise km
+        return km
+
+    def shutdown(self):
+        """Shut down the kernels that haven't been used."""
+        self._closed = True
+        self._starter.shutdown(wait=True)
+        while not self._ready.empty():
+            km = self._ready.get()
+            if not isinstance(km, Exception):
+                shutdown_kernel(km)
+
+
+def shutdown_kernel(km):
+    """Shut down a kernel (if it is still running)."""
+    if run_sync(km.is_alive)():
+        run_sync(km.shutdown_kernel)(now=True)
+
+
+def _link(src, dest):
+    """Link dest to src (a symbolic link, or on Windows without
+    symbolic link permissions, a junction for folders or a hard link
+    or copy for files)."""
+    try:
+        os.symlink(src, dest, target_is_directory=src.is_dir())
+    except OSError:
+        if src.is_dir():
+            import _winapi
+            _winapi.CreateJunction(str(src), str(dest))
+        else:
+            try:
+                os.link(src, dest)
+            except OSError:
+                shutil.copy2(src, dest)
+
+
+def make_scratch_dir(notebook, scratch_root):
+    """Make a scratch copy of the repository for running a notebook,
+    with a copy of the part of the course with the notebook (the
+    folder at copy_depth on the path to the notebook), real folders
+    on the path to it, and links to everything else.
+
+    Parameters
+    ----------
+    notebook : pathlike
+        Notebook, in the repository.
+    scratch_root : pathlike
+        Folder for the scratch copy.
+
+    Returns
+    -------
+    notebook_dir : Path
+        Folder for the notebook in the scratch copy
+        (to run the notebook in).
+    """
+    notebook = Path(notebook).resolve()
+    relative_dir = notebook.parent.relative_to(repo_root)
+    scratch_root = Path(scratch_root)
+    if scratch_root.exists():
+        remove_scratch_dir(scratch_root)
+    copied = relative_dir.parts[:copy_depth]
+    src, dest = repo_root, scratch_root
+    dest.mkdir(parents=True)
+    for i, part in enumerate(copied):
+        for entry in src.iterdir():
+            if entry.name == part or entry.name in ('.git', 'tests'):
+                continue
+            _link(entry, dest / entry.name)
+        src, dest = src / part, dest / part
+        if i < len(copied) - 1:
+            dest.mkdir()
+    if copied:
+        shutil.copytree(src, dest, symlinks=True,
+                        ignore=shutil.ignore_patterns('.ipynb_checkpoints',
+                                                      '__pycache__'))
+    else:
+        for entry in src.iterdir():
+            if entry.name not in ('.git', 'tests'):
+                _link(entry, dest / entry.name)
+    return scratch_root / relative_dir
+
+
+def _is_link(path):
+    return os.path.islink(path) or \
+        (hasattr(os.path, 'isjunction') and os.path.isjunction(path))
+
+
+def remove_scratch_dir(path):
+    """Remove a scratch copy, removing the links (but not the
+    files and folders they link to)."""
+    for entry in os.scandir(path):
+        if _is_link(entry.path):
+            # rmdir removes junctions without following them
+            if entry.is_dir() and not os.path.islink(entry.path):
+                os.rmdir(entry.path)
+            else:
+                os.unlink(entry.path)
+        elif entry.is_dir():
+            remove_scratch_dir(entry.path)
+        else:
+            os.unlink(entry.path)
+    os.rmdir(path)
+
+
+class NotebookResult:
+    """Result of executing a notebook (or, if cached is True,
+    of a previous execution of the notebook). For executed notebooks,
+    cells is a list of records for the code cells with their wall time
+    and peak RSS (see notebook_timings.py)."""
+    def __init__(self, notebook, passed, error=None, elapsed=None,
+                 output=None, cached=False, cells=None, peak_rss_mb=None):
+        self.notebook = notebook
+        self.passed = passed
+        self.error = error
+        self.elapsed = elapsed
+        self.output = output
+        self.cached = cached
+        self.cells = cells
+        self.peak_rss_mb = peak_rss_mb
+
+
+def run_notebook(notebook, scratch_root, pool=None, timeout=600,
+                 kernel_name='python3'):
+    """Execute a notebook in a scratch copy of the repository.
+
+    Parameters
+    ----------
+    notebook : pathlike
+        Notebook to execute.
+    scratch_root : pathlike
+        Folder for the scratch copy. The executed notebook is saved
+        in the notebook folder of the scratch copy.
+    pool : KernelPool, optional
+        Pool to get a (warm) kernel from. By default, a new kernel
+        is started.
+    timeout : int
+        Time limit for each cell, in seconds.
+    kernel_name : str
+        By default, 'python3'.
+
+    Returns
+    -------
+    result : NotebookResult
+    """
+    notebook = Path(notebook)
+    start = time.perf_counter()
+    workdir = make_scratch_dir(notebook, scratch_root)
+    nb = nbformat.read(notebook, as_version=4)
+    km = pool.get() if pool is not None else None
+    client = NotebookClient(nb, km=km, timeout=timeout,
+                            kernel_name=kernel_name,
+                            resources={'metadata': {'path': str(workdir)}})
+    recorder = CellRecorder()
+    client.on_notebook_start = _start_hook(client, recorder, workdir,
+                                           chdir=km is not None)
+    client.on_cell_execute = recorder.cell_started
+    client.on_cell_executed = recorder.cell_executed
+    error = None
+    try:
+        client.execute(cwd=str(workdir))
+    except Exception as e:
+        error = e
+    finally:
+        recorder.stop()
+        if km is not None:
+            shutdown_kernel(km)
+    output = workdir / notebook.name
+    if _is_link(output):
+        # don't write over the notebook in the repository
+        os.unlink(output)
+    nbformat.write(nb, output)
+    peak_rss_mb = None if recorder.peak_rss is None \
+        else recorder.peak_rss / 2**20
+    return NotebookResult(notebook, error is None, error=error,
+                          elapsed=time.perf_counter() - start, output=output,
+                          cells=recorder.cells, peak_rss_mb=peak_rss_mb)
+
+
+def _start_hook(client, recorder, workdir, chdir=True):
+    """Make a hook that (optionally) changes the working directory of
+    the kernel to the notebook folder (warm kernels are started in the
+    repository root), and starts recording the memory use of the
+    kernel, before the first cell is run."""
+    async def start(notebook):
+        if chdir:
+            code = f'import os\nos.chdir({str(workdir)!r})\n'
+            await client.kc.execute_interactive(code, silent=True,
+                                                store_history=False)
+        provisioner = getattr(client.km, 'provisioner', None)
+        recorder.start(getattr(provisioner, 'pid', None))
+    return start
+
+
+class NotebookExecutor:
+    """Execute notebooks concurrently, each on a warm kernel from a
+    :class:`KernelPool`, in its own scratch folder.
+
+    Parameters
+    ----------
+    scratch_dir : pathlike
+        Folder for the scratch copies (one subfolder per notebook).
+    max_workers : int
+        Number of notebooks to execute at once.
+    timeout : int
+        Time limit for each cell, in seconds.
+    cache : notebook_cache.ExecutionCache, optional
+        Cache of results. Notebooks with a saved result for their
+        current content aren't executed; the saved result is
+        returned instead. Only passes are saved, except for the
+        notebooks in expected_failures.
+    expected_failures : collection of str, optional
+        File names of notebooks that are expected to fail (with an
+        error in a cell), for which failures are saved in the cache.
+        Failures of other notebooks may be transient (e.g. a failed
+        download), so they aren't saved.
+    """
+    def __init__(self, scratch_dir, max_workers=1, timeout=600,
+                 cache=None, expected_failures=()):
+        self.scratch_dir = Path(scratch_dir)
+        self.timeout = timeout
+        self.cache = cache
+        self.expected_failures = set(expected_failures)
+        self.max_workers = max_workers
+        # started with the first notebook that needs to be executed
+        self.pool = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def scratch_root(self, notebook):
+        """Scratch folder for a notebook."""
+        relative = Path(notebook).resolve().relative_to(repo_root)
+        return self.scratch_dir / '__'.join(relative.with_suffix('').parts)
+
+    def submit(self, notebook):
+        """Start executing a notebook (if it hasn't been already)."""
+        path = Path(notebook).resolve()
+        with self._lock:
+            if path not in self._futures:
+                self._futures[path] = self._submit(notebook)
+            return self._futures[path]
+
+    def _submit(self, notebook):
+        if self.cache is None:
+            self._start_pool()
+            return self._executor.submit(
+                run_notebook, notebook, self.scratch_root(notebook),
+                pool=self.pool, timeout=self.timeout)
+        key = self.cache.notebook_key(notebook)
+        entry = self.cache.get(notebook, key=key)
+        if entry is not None:
+            future = Future()
+            future.set_result(NotebookResult(
+                Path(notebook), entry['passed'], error=entry['error'],
+                elapsed=entry['elapsed'], cached=True))
+            return future
+        self._start_pool()
+        return self._executor.submit(self._run_and_cache, notebook, key)
+
+    def _start_pool(self):
+        if self.pool is None:
+            self.pool = KernelPool(size=self.max_workers)
+
+    def _run_and_cache(self, notebook, key):
+        result = run_notebook(notebook, self.scratch_root(notebook),
+                              pool=self.pool, timeout=self.timeout)
+        # failures other than errors in the notebook code
+        # (e.g. timeouts or dead kernels) aren't saved, and neither
+        # are errors in notebooks that are expected to pass
+        if result.passed or (type(result.error) is CellExecutionError and
+                             Path(notebook).name in self.expected_failures):
+            self.cache.put(notebook, result, key=key)
+        return result
+
+    def result(self, notebook):
+        """Get the result of executing a notebook (waiting for it,
+        and starting it, if needed)."""
+        return self.submit(notebook).result()
+
+    def results(self):
+        """Results of the notebooks that have been executed (or
+        found in the cache), in the order they were submitted."""
+        return [future.result() for future in self._futures.values()
+                if future.done() and not future.cancelled()
+                and future.exception() is None]
+
+    def cleanup(self, notebook):
+        """Remove the scratch folder for a notebook."""
+        scratch_root = self.scratch_root(notebook)
+        if scratch_root.exists():
+            remove_scratch_dir(scratch_root)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def default_workers():
+    """Number of notebooks to execute at once: from the
+    NOTEBOOK_WORKERS environment variable, or else the number of
+    cores (or 1, in a pytest-xdist worker, where the notebooks
+    are spread across the workers instead)."""
+    if 'NOTEBOOK_WORKERS' in os.environ:
+        return int(os.environ['NOTEBOOK_WORKERS'])
+    if 'PYTEST_XDIST_WORKER' in os.environ:
+        return 1
+    return os.cpu_count() or 1
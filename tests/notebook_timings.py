@@ -0,0 +1,323 @@
+"""Per-cell timing and memory use of the test notebooks.
+
+While a notebook is executed by :func:`notebook_runner.run_notebook`, a
+:class:`CellRecorder` records the wall time of each code cell, and the
+peak resident set size (RSS) of the kernel process during the cell
+(by polling the kernel process; the memory use of programs that a cell
+runs in subprocesses, like MODFLOW, isn't included). The test suite
+writes the records for all of the executed notebooks to a JSON file
+(``pytest tests/test_notebooks.py --timings=timings.json``), with the
+versions of the main packages.
+
+Two such files can be compared from the command line, to flag cells
+that got slower (or use more memory) beyond a threshold::
+
+    python tests/notebook_timings.py compare old.json new.json --threshold 0.25
+
+and the slowest cells in a file (or across several files) can be
+listed with::
+
+    python tests/notebook_timings.py report timings.json --top 20
+
+Notebooks with a cached result (see notebook_cache.py) aren't executed,
+so they aren't timed; run with ``--force`` to time all of the notebooks.
+"""
+import argparse
+import hashlib
+import importlib.metadata
+import json
+import os
+from pathlib import Path
+import platform
+import sys
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# packages to list in the timing files
+packages = ['flopy', 'modflow-devtools', 'modflow-setup', 'numpy', 'pandas',
+            'scipy', 'matplotlib', 'shapely', 'pyproj', 'geopandas',
+            'rasterio', 'xarray', 'gis-utils', 'sfrmaker']
+
+
+def rss(pid):
+    """Resident set size of a process, in bytes (None if it
+    can't be determined, e.g. on Windows or macOS without psutil)."""
+    try:
+        if psutil is not None:
+            return psutil.Process(pid).memory_info().rss
+        with open(f'/proc/{pid}/statm') as src:
+            return int(src.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return None
+
+
+class CellRecorder:
+    """Record the wall time and peak RSS of each code cell as
+    a notebook is executed, through the nbclient hooks.
+
+    Parameters
+    ----------
+    interval : float
+        Time between RSS samples, in seconds.
+
+    Examples
+    --------
+    >>> recorder = CellRecorder()
+    >>> client.on_cell_execute = recorder.cell_started
+    >>> client.on_cell_executed = recorder.cell_executed
+    >>> recorder.start(pid)  # once the kernel is started
+    >>> client.execute()
+    >>> recorder.stop()
+    >>> recorder.cells
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.cells = []
+        self.pid = None
+        self.peak_rss = None
+        self._cell = None
+        self._cell_peak = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self, pid):
+        """Start polling the RSS of the kernel process."""
+        self.pid = pid
+        if pid is None or rss(pid) is None:
+            return
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            value = rss(self.pid)
+            if value is not None:
+                with self._lock:
+                    self.peak_rss = max(self.peak_rss or 0, value)
+                    if self._cell is not None:
+                        self._cell_peak = max(self._cell_peak or 0, value)
+            self._stop.wait(self.interval)
+
+    def cell_started(self, cell, cell_index):
+        with self._lock:
+            self._cell = {
+                'index': cell_index,
+                'source_hash': hashlib.sha1(cell.source.encode()).hexdigest()[:12],
+                'first_line': cell.source.strip().split('\n')[0][:80],
+                'start': time.perf_counter()}
+            self._cell_peak = rss(self.pid) if self.pid is not None else None
+
+    def cell_executed(self, cell, cell_index, execute_reply=None):
+        self._finish_cell(status=(execute_reply or {}).get(
+            'content', {}).get('status', 'ok'))
+
+    def _finish_cell(self, status):
+        with self._lock:
+            if self._cell is None:
+                return
+            record = self._cell
+            record['wall_time'] = time.perf_counter() - record.pop('start')
+            record['peak_rss_mb'] = None if self._cell_peak is None \
+                else self._cell_peak / 2**20
+            record['status'] = status
+            self.cells.append(record)
+            self._cell = None
+
+    def stop(self):
+        """Stop polling (a cell that didn't finish, e.g. because of
+        a timeout, is recorded with the status 'unfinished')."""
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self._finish_cell(status='unfinished')
+
+
+def environment():
+    """Python version, platform and versions of the main packages."""
+    versions = {}
+    for name in packages:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'packages': versions}
+
+
+def write_timings(results, outfile):
+    """Write the timing records of executed notebooks to a JSON file.
+
+    Parameters
+    ----------
+    results : list of notebook_runner.NotebookResult
+    outfile : pathlike
+    """
+    notebooks = {}
+    for result in results:
+        if result.cached or result.cells is None:
+            continue
+        notebooks[Path(result.notebook).as_posix()] = {
+            'passed': result.passed,
+            'elapsed': result.elapsed,
+            'peak_rss_mb': result.peak_rss_mb,
+            'cells': result.cells}
+    with open(outfile, 'w') as dest:
+        json.dump({'environment': environment(), 'notebooks': notebooks},
+                  dest, indent=2)
+
+
+def read_timings(*files):
+    """Read timing files, merging the notebooks from several files
+    (e.g. from pytest-xdist workers) into one.
+
+    Returns
+    -------
+    timings : dict
+        With 'environment' (from the first file) and 'notebooks' items.
+    """
+    timings = {'environment': None, 'notebooks': {}}
+    for filename in files:
+        with open(filename) as src:
+            data = json.load(src)
+        if timings['environment'] is None:
+            timings['environment'] = data.get('environment')
+        timings['notebooks'].update(data['notebooks'])
+    return timings
+
+
+def cells_table(timings):
+    """Table of the cell records, as a list of dicts with a notebook
+    item, sorted by wall time, slowest first."""
+    rows = []
+    for notebook, record in timings['notebooks'].items():
+        for cell in record['cells']:
+            rows.append({'notebook': notebook, **cell})
+    return sorted(rows, key=lambda row: row['wall_time'], reverse=True)
+
+
+def compare(old, new, threshold=0.25, min_seconds=1., min_mb=50.):
+    """Find the cells that got slower, or used more memory, in new
+    timings than in old timings.
+
+    Cells are matched by notebook and cell number, and only compared
+    if their source is the same.
+
+    Parameters
+    ----------
+    old, new : dict
+        Timings, from :func:`read_timings`.
+    threshold : float
+        Relative increase (e.g. 0.25 for 25%) above which a cell
+        is flagged.
+    min_seconds : float
+        Minimum increase in wall time for a cell to be flagged (so
+        that timing noise in fast cells isn't flagged).
+    min_mb : float
+        Minimum increase in peak RSS, in MB, for a cell to be flagged.
+
+    Returns
+    -------
+    regressions : list of dicts
+        Sorted by the increase in wall time.
+    """
+    old_cells = {(row['notebook'], row['index']): row
+                 for row in cells_table(old)}
+    regressions = []
+    for row in cells_table(new):
+        prev = old_cells.get((row['notebook'], row['index']))
+        if prev is None or prev['source_hash'] != row['source_hash']:
+            continue
+        flags = []
+        change = row['wall_time'] - prev['wall_time']
+        if change > min_seconds and change > threshold * prev['wall_time']:
+            flags.append('time')
+        if row['peak_rss_mb'] is not None and prev['peak_rss_mb'] is not None:
+            mb_change = row['peak_rss_mb'] - prev['peak_rss_mb']
+            if mb_change > min_mb and mb_change > threshold * prev['peak_rss_mb']:
+                flags.append('memory')
+        if flags:
+            regressions.append({**row, 'old_wall_time': prev['wall_time'],
+                                'old_peak_rss_mb': prev['peak_rss_mb'],
+                                'flags': flags})
+    return sorted(regressions,
+                  key=lambda row: row['wall_time'] - row['old_wall_time'],
+                  reverse=True)
+
+
+def _mb(value):
+    return '' if value is None else f'{value:.0f}'
+
+
+def format_cells(rows, old=False):
+    """Format cell records as a text table."""
+    header = f"{'wall time (s)':>13} {'peak RSS (MB)':>13}"
+    if old:
+        header = f"{'old time (s)':>12} {'old RSS (MB)':>12} " + header
+    lines = [f'{header}  notebook [cell]: first line']
+    for row in rows:
+        line = f"{row['wall_time']:13.2f} {_mb(row['peak_rss_mb']):>13}"
+        if old:
+            line = (f"{row['old_wall_time']:12.2f} "
+                    f"{_mb(row['old_peak_rss_mb']):>12} " + line)
+        lines.append(f"{line}  {row['notebook']} [{row['index']}]: "
+                     f"{row['first_line']}")
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    report = subparsers.add_parser(
+        'report', help='list the slowest cells')
+    report.add_argument('files', nargs='+', help='timing files')
+    report.add_argument('--top', type=int, default=20,
+                        help='number of cells to list')
+    comp = subparsers.add_parser(
+        'compare', help='flag cells that got slower or use more memory')
+    comp.add_argument('old', help='timing file for the baseline')
+    comp.add_argument('new', help='timing file to compare')
+    comp.add_argument('--threshold', type=float, default=0.25,
+                      help='relative increase to flag (default 0.25)')
+    comp.add_argument('--min-seconds', type=float, default=1.,
+                      help='minimum increase in wall time to flag '
+                           '(default 1 second)')
+    comp.add_argument('--min-mb', type=float, default=50.,
+                      help='minimum increase in peak RSS to flag '
+                           '(default 50 MB)')
+    args = parser.parse_args(args)
+
+    if args.command == 'report':
+        timings = read_timings(*args.files)
+        rows = cells_table(timings)
+        total = sum(row['wall_time'] for row in rows)
+        print(f'{len(rows)} cells in {len(timings["notebooks"])} notebooks, '
+              f'{total:.1f} s in total\n')
+        print(format_cells(rows[:args.top]))
+        return 0
+
+    old, new = read_timings(args.old), read_timings(args.new)
+    for name, versions in (('old', old), ('new', new)):
+        if versions['environment'] is not None:
+            packages = versions['environment']['packages']
+            print(f'{name}: ' + ', '.join(f'{k} {v}' for k, v in packages.items()))
+    regressions = compare(old, new, threshold=args.threshold,
+                          min_seconds=args.min_seconds, min_mb=args.min_mb)
+    if not regressions:
+        print('\nno regressions')
+        return 0
+    print(f'\n{len(regressions)} cells regressed by more than '
+          f'{args.threshold:.0%}:\n')
+    print(format_cells(regressions, old=True))
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
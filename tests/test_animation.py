@@ -0,0 +1,65 @@
+import sys
+sys.path.append('notebooks/part1_flopy')
+import subprocess
+import flopy
+import matplotlib
+import numpy as np
+import pytest
+import animation
+from animation import MapAnimation
+
+nrow, ncol, nframes = 6, 8, 5
+
+
+@pytest.fixture
+def ani():
+    modelgrid = flopy.discretization.StructuredGrid(
+        delr=np.full(ncol, 10.), delc=np.full(nrow, 10.),
+        top=np.full((nrow, ncol), 10.), botm=np.zeros((1, nrow, ncol)))
+    # a plume that spreads out over time
+    y, x = np.mgrid[0:nrow, 0:ncol]
+    conc = np.array([[100 * np.exp(-((x - 2) ** 2 + (y - 3) ** 2) / (t + 1))]
+                     for t in range(nframes)])
+    return MapAnimation(modelgrid, conc, times=np.arange(nframes) * 10.,
+                        head=np.tile(np.linspace(10, 5, ncol), (nrow, 1)),
+                        contour_levels=[6, 8],
+                        boundaries={'chd': ([0, nrow * ncol - 1], 'red')},
+                        mask_below=1e-3, figsize=(3, 2.5), vmin=0, vmax=100)
+
+
+def test_render_gif(ani, tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    backend = matplotlib.get_backend()
+    pngs = ani.render(tmp_path / 'frames', max_workers=2, dpi=50)
+    assert [png.name for png in pngs] == \
+        [f'frame_{i:05d}.png' for i in range(nframes)]
+    # the backend is only set in the worker processes
+    assert matplotlib.get_backend() == backend
+    with Image.open(pngs[0]) as png:
+        size = png.size
+    assert size == (150, 125)
+
+    gif = tmp_path / 'animation.gif'
+    ani.save(gif, pngs, fps=5)
+    with Image.open(gif) as image:
+        assert image.size == size
+        assert image.n_frames == nframes
+        assert image.info['duration'] == 200
+        frames = []
+        for i in range(nframes):
+            image.seek(i)
+            frames.append(np.array(image.convert('RGB')))
+    # each frame is different
+    assert all((a != b).any() for a, b in zip(frames[:-1], frames[1:]))
+
+
+def test_save_ffmpeg_error(ani, tmp_path, monkeypatch):
+    pngs = ani.render_range([0], tmp_path)
+    monkeypatch.setattr(animation.shutil, 'which', lambda cmd: cmd)
+
+    def run(cmd, **kwargs):
+        return subprocess.CompletedProcess(cmd, 1, '', 'Invalid data found')
+    monkeypatch.setattr(animation.subprocess, 'run', run)
+    with pytest.raises(RuntimeError, match='Invalid data found'):
+        ani.save(tmp_path / 'animation.mp4', pngs)
+    assert not list(tmp_path.glob('*.txt'))
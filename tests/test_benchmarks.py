@@ -0,0 +1,29 @@
+import pytest
+from benchmarks import benchmarks, compare, read_history, append_history, record, run
+
+
+@pytest.fixture(scope='module')
+def results():
+    return run(quick=True, verbose=False)
+
+
+def test_benchmarks_run(results):
+    # each benchmark runs at its smallest size
+    assert [r['benchmark'] for r in results] == [b.name for b in benchmarks]
+    for result in results:
+        assert result['time'] > 0
+        assert result['peak_mb'] >= 0
+
+
+def test_history(results, tmp_path):
+    history = tmp_path / 'history.jsonl'
+    base = record(results)
+    slower = record([{**r, 'time': r['time'] * 2} for r in results])
+    append_history(base, history)
+    append_history(slower, history)
+    runs = read_history(history)
+    assert len(runs) == 2
+    rows = compare(runs[0], runs[1], threshold=0.2)
+    assert len(rows) == len(results)
+    assert all(row['regression'] for row in rows)
+    assert not any(row['regression'] for row in compare(runs[0], runs[0]))
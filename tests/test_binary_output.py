@@ -0,0 +1,189 @@
+import sys
+sys.path.append('notebooks/part1_flopy')
+import os
+from pathlib import Path
+import shutil
+import flopy
+import numpy as np
+import pytest
+from binary_output import (BinaryGridFile, BudgetFile, LazyFrames,
+                           budget_header_dtype, budget_header2_dtype,
+                           grid_header_dtype)
+
+data = Path('notebooks/part1_flopy/data')
+
+
+@pytest.fixture
+def copy(tmp_path):
+    """Copy a file to tmp_path (so that the saved index
+    isn't written in the repository)."""
+    def copy(path):
+        return Path(shutil.copy(data / path, tmp_path))
+    return copy
+
+
+def write_heads(path, records, nrow=2, ncol=3):
+    """Write a head file with (kstp, kper, totim, ilay) records."""
+    with open(path, 'wb') as dest:
+        for kstp, kper, totim, ilay in records:
+            header = np.array([(kstp, kper, totim, totim, 'HEAD'.rjust(16),
+                                ncol, nrow, ilay)], dtype=grid_header_dtype)
+            dest.write(header.tobytes())
+            values = totim * 100 + ilay * 10 + np.arange(nrow * ncol)
+            dest.write(values.astype('<f8').tobytes())
+
+
+def write_budget(path, nper, nja=7, nlist=3):
+    """Write a budget file with a FLOW-JA-FACE (array) and a CHD
+    (list, with an auxiliary variable) record for each stress period."""
+    with open(path, 'wb') as dest:
+        for kper in range(1, nper + 1):
+            header = np.array([(1, kper, 'FLOW-JA-FACE'.rjust(16), nja, 1, -1)],
+                              dtype=budget_header_dtype)
+            header2 = np.array([(1, 1., 1., float(kper))],
+                               dtype=budget_header2_dtype)
+            dest.write(header.tobytes() + header2.tobytes())
+            dest.write((kper + np.arange(nja, dtype='<f8')).tobytes())
+
+            header = np.array([(1, kper, 'CHD'.rjust(16), 10, 1, -1)],
+                              dtype=budget_header_dtype)
+            header2 = np.array([(6, 1., 1., float(kper))],
+                               dtype=budget_header2_dtype)
+            dest.write(header.tobytes() + header2.tobytes())
+            for name in 'MODEL', 'MODEL', 'MODEL', 'CHD_0':
+                dest.write(name.ljust(16).encode())
+            dest.write(np.array([2], dtype='<i4').tobytes())
+            dest.write('IFACE'.ljust(16).encode())
+            dest.write(np.array([nlist], dtype='<i4').tobytes())
+            records = np.zeros(nlist, dtype=[('node', '<i4'), ('node2', '<i4'),
+                                             ('q', '<f8'), ('iface', '<f8')])
+            records['node'] = np.arange(1, nlist + 1)
+            records['node2'] = records['node']
+            records['q'] = -kper * np.arange(1., nlist + 1)
+            records['iface'] = 5
+            dest.write(records.tobytes())
+
+
+@pytest.mark.parametrize('filename', ['pleasant-lake/pleasant.hds',
+                                      'quadtree/project.hds'])
+def test_binary_grid_file(copy, filename):
+    path = copy(filename)
+    hds = BinaryGridFile(path)
+    expected = flopy.utils.HeadFile(path)
+    np.testing.assert_allclose(hds.times, expected.get_times())
+    assert hds.kstpkper == [tuple(int(i) for i in kk)
+                            for kk in expected.get_kstpkper()]
+    for i, (totim, kstpkper) in enumerate(zip(hds.times, hds.kstpkper)):
+        heads = expected.get_data(totim=totim)
+        np.testing.assert_array_equal(hds.get_data(idx=i), heads)
+        np.testing.assert_array_equal(hds.get_data(kstpkper=kstpkper), heads)
+        np.testing.assert_array_equal(hds.get_data(totim=totim), heads)
+        np.testing.assert_array_equal(hds.array[i],
+                                      heads.reshape(hds.nlay, -1))
+    # the last time step, by default
+    np.testing.assert_array_equal(hds.get_data(), expected.get_data())
+    cells = [(0, hds.nrow // 2, 2), (hds.nlay - 1, hds.nrow - 1, hds.ncol - 1)]
+    np.testing.assert_array_equal(hds.get_ts(cells), expected.get_ts(cells))
+    if hds.nrow == 1:
+        # (layer, cell) locations for unstructured grids
+        np.testing.assert_array_equal(
+            hds.get_ts([(layer, col) for layer, _, col in cells]),
+            expected.get_ts(cells))
+    for (totim, frame), expected_totim in zip(hds.iter_frames(layer=0),
+                                              expected.get_times()):
+        assert totim == expected_totim
+        np.testing.assert_array_equal(
+            frame, expected.get_data(totim=totim)[0].ravel())
+    with pytest.raises(ValueError):
+        hds.get_data(totim=-1.)
+
+
+def test_binary_grid_file_index(tmp_path):
+    path = tmp_path / 'model.hds'
+    write_heads(path, [(1, 1, 1., 1), (1, 1, 1., 2),
+                       (1, 2, 2., 1), (1, 2, 2., 2)])
+    hds = BinaryGridFile(path)
+    index_file = tmp_path / 'model.hds.idx.npz'
+    assert index_file.exists()
+    # the saved index is reused, unless the file changes
+    with np.load(index_file) as saved:
+        saved = dict(saved)
+    saved['index']['totim'] *= 10
+    np.savez(index_file, **saved)
+    assert BinaryGridFile(path).times == [10., 20.]
+    write_heads(path, [(1, 1, 1., 1), (1, 1, 1., 2)])
+    os.utime(path, (1, 1))
+    assert BinaryGridFile(path).times == [1.]
+
+
+def test_binary_grid_file_uneven_records(tmp_path):
+    # only the first layer at the second time
+    path = tmp_path / 'model.ucn'
+    write_heads(path, [(1, 1, 1., 1), (1, 1, 1., 2), (1, 2, 2., 1),
+                       (1, 3, 3., 1), (1, 3, 3., 2)])
+    ucn = BinaryGridFile(path, save_index=False)
+    assert not (tmp_path / 'model.ucn.idx.npz').exists()
+    assert ucn.shape == (3, 2, 6)
+    array = ucn.array
+    assert isinstance(array, LazyFrames)
+    np.testing.assert_array_equal(array[1, 0], 210 + np.arange(6))
+    assert np.isnan(array[1, 1]).all()
+    np.testing.assert_array_equal(array[:, 1, 0], [120, np.nan, 320])
+    np.testing.assert_array_equal(ucn.get_ts((1, 1, 2))[:, 1],
+                                  [125, np.nan, 325])
+
+
+@pytest.mark.parametrize('filename', ['quadtree/project.cbc',
+                                      'voronoi/project.cbc'])
+def test_budget_file(copy, filename):
+    path = copy(filename)
+    cbc = BudgetFile(path)
+    expected = flopy.utils.CellBudgetFile(path, precision='double')
+    assert [text for text, _ in cbc.list_unique_records()] == \
+        [text.decode().strip() for text in expected.get_unique_record_names()]
+    np.testing.assert_allclose(cbc.times, expected.get_times())
+    for text, imeth in cbc.list_unique_records():
+        records = cbc.get_data(text=text)
+        expected_records = expected.get_data(text=text)
+        assert len(records) == len(expected_records)
+        for record, expected_record in zip(records, expected_records):
+            if imeth == 6:
+                assert record.dtype.names == expected_record.dtype.names
+                for name in record.dtype.names:
+                    np.testing.assert_array_equal(record[name],
+                                                  expected_record[name])
+            else:
+                np.testing.assert_array_equal(record, expected_record)
+    totim, q = cbc.get_stack('CHD')
+    np.testing.assert_array_equal(q[0], expected.get_data(text='CHD')[0]['q'])
+    with pytest.raises(ValueError):
+        cbc.get_stack('EVT')
+
+
+def test_budget_file_times(tmp_path):
+    path = tmp_path / 'model.cbc'
+    write_budget(path, nper=3)
+    cbc = BudgetFile(path)
+    expected = flopy.utils.CellBudgetFile(path, precision='double')
+    assert cbc.list_unique_records() == [('FLOW-JA-FACE', 1), ('CHD', 6)]
+    assert cbc.kstpkper == [(0, 0), (0, 1), (0, 2)]
+    assert cbc.times == [1., 2., 3.]
+    chd = cbc.get_data(text='chd', kstpkper=(0, 1), paknam='chd_0')[0]
+    np.testing.assert_array_equal(chd['q'], [-2., -4., -6.])
+    np.testing.assert_array_equal(chd['iface'], 5)
+    np.testing.assert_array_equal(
+        chd['q'], expected.get_data(text='CHD', kstpkper=(0, 1))[0]['q'])
+    assert cbc.get_data(text='CHD', paknam='WEL_0') == []
+
+    # strided views across the stress periods
+    totim, flows = cbc.get_stack('FLOW-JA-FACE')
+    np.testing.assert_array_equal(totim, [1., 2., 3.])
+    np.testing.assert_array_equal(flows, np.arange(1, 4)[:, None] + np.arange(7))
+    totim, q = cbc.get_stack('CHD')
+    np.testing.assert_array_equal(q, -np.arange(1, 4)[:, None] * np.arange(1, 4))
+    _, iface = cbc.get_stack('CHD', field='iface')
+    assert (iface == 5).all()
+    for kper in range(3):
+        np.testing.assert_array_equal(
+            flows[kper], expected.get_data(text='FLOW-JA-FACE',
+                                           kstpkper=(0, kper))[0].ravel())
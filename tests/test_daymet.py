@@ -0,0 +1,265 @@
+import sys
+sys.path.append('notebooks/part0_python_intro')
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pytest
+import rioxarray  # noqa: F401 (registers the .rio accessor)
+import xarray as xr
+from pyproj import Transformer
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+import daymet
+from daymet import (Reprojector, SiteIndex, climatology, daymet_proj_string,
+                    extract_sites, polygon_means, polygon_weights, reproject)
+
+rainier = Path('notebooks/part0_python_intro/data/xarray/daymet_prcp_rainier_1980-2018.nc')
+
+
+@pytest.fixture(scope='module')
+def prcp():
+    ds = xr.load_dataset(rainier).isel(time=slice(0, 400))
+    ds.rio.write_crs(CRS.from_user_input(daymet_proj_string), inplace=True)
+    return ds['prcp']
+
+
+def synthetic(nrow=40, ncol=50, ntimes=3, cellsize=1000.):
+    """Random values on a Daymet-like grid, with a few NaNs (nodata)."""
+    rng = np.random.default_rng(0)
+    values = rng.gamma(1., 5., size=(ntimes, nrow, ncol))
+    values[:, 10:13, 20:24] = np.nan
+    da = xr.DataArray(values, dims=('time', 'y', 'x'),
+                      coords={'time': np.arange(ntimes),
+                              'y': 5e5 - cellsize * (np.arange(nrow) + 0.5),
+                              'x': -1.5e6 + cellsize * (np.arange(ncol) + 0.5)})
+    da = da.rio.write_crs(CRS.from_user_input(daymet_proj_string))
+    return da.rio.write_nodata(np.nan)
+
+
+@pytest.mark.parametrize('resampling', ['nearest', 'bilinear'])
+@pytest.mark.parametrize('resolution', [None, 0.03])
+def test_reprojector_matches_rio_slices(resampling, resolution):
+    """Each time slice matches rio.reproject of that slice, including
+    when downsampling (where GDAL widens the bilinear kernel),
+    to round-off for bilinear."""
+    da = synthetic()
+    reprojector = Reprojector(da, 4269, resampling=resampling,
+                              resolution=resolution)
+    reprojected = reprojector(da)
+    kwargs = {'resampling': Resampling[resampling]}
+    if resolution is not None:
+        kwargs['resolution'] = resolution
+    tolerance = 0 if resampling == 'nearest' else 1e-9
+    for t in range(da.sizes['time']):
+        expected = da.isel(time=t).rio.reproject(4269, **kwargs)
+        assert reprojected.shape[1:] == expected.shape
+        np.testing.assert_allclose(reprojected.x, expected.x)
+        np.testing.assert_allclose(reprojected.y, expected.y)
+        np.testing.assert_allclose(reprojected.isel(time=t).values,
+                                   expected.values, rtol=0, atol=tolerance)
+
+
+@pytest.mark.parametrize('resampling', ['nearest', 'bilinear'])
+def test_reproject_daymet(prcp, resampling):
+    reprojected = reproject(prcp, 4269, resampling=resampling)
+    # the same as rio.reproject of each slice (whose values are float32)
+    for t in (0, 150, 399):
+        expected = prcp.isel(time=t).rio.reproject(
+            4269, resampling=Resampling[resampling]).values
+        np.testing.assert_allclose(reprojected.isel(time=t).values, expected,
+                                   rtol=0, atol=1e-5)
+    # rio.reproject of the whole stack at once differs,
+    # by the amounts documented in Reprojector
+    expected = prcp.rio.reproject(4269, resampling=Resampling[resampling]).values
+    differs = np.abs(reprojected.values - expected) > 1e-3
+    assert (np.isnan(reprojected.values) == np.isnan(expected)).all()
+    assert np.nanmean(differs) < {'nearest': 0.01, 'bilinear': 0.4}[resampling]
+    assert np.nanmax(np.abs(reprojected.values - expected)) < 50
+    # the cached mapping is reused
+    assert reproject(prcp, 4269, resampling=resampling).identical(reprojected)
+
+
+@pytest.fixture
+def daily_file(tmp_path):
+    """Two years of daily values on a small grid, with a few NaNs."""
+    rng = np.random.default_rng(0)
+    times = pd.date_range('2000-01-01', '2001-12-31', freq='D')
+    values = rng.gamma(1., 5., size=(len(times), 4, 5))
+    values[:, 0, 0] = np.nan
+    ds = xr.Dataset({'prcp': (('time', 'y', 'x'), values, {'units': 'mm/day'})},
+                    coords={'time': times, 'y': np.arange(4.), 'x': np.arange(5.)})
+    path = tmp_path / 'daymet.nc'
+    ds.to_netcdf(path)
+    return path
+
+
+@pytest.mark.parametrize('reduction', list(daymet.reductions))
+def test_climatology_dask_and_streaming(daily_file, tmp_path, monkeypatch,
+                                        reduction):
+    pytest.importorskip('dask')
+    group, how = daymet.reductions[reduction]
+    with xr.open_dataset(daily_file) as ds:
+        expected = getattr(ds['prcp'].groupby(group), how)(dim='time').load()
+    reduced = climatology(daily_file, reduction, cache_dir=tmp_path / 'dask',
+                          time_chunk=100)
+    np.testing.assert_allclose(reduced.values, expected.values, rtol=1e-12)
+    # without dask, the file is read one year at a time
+    monkeypatch.setattr(daymet, 'dask', False)
+    streamed = climatology(daily_file, reduction, cache_dir=tmp_path / 'streamed')
+    np.testing.assert_allclose(streamed.values, reduced.values, rtol=1e-12)
+    assert streamed.dims == reduced.dims
+
+
+def test_climatology_cache(daily_file, tmp_path, monkeypatch):
+    cache_dir = tmp_path / 'cache'
+    reduced = climatology(daily_file, 'monthly_mean', cache_dir=cache_dir)
+    assert len(list(cache_dir.glob('*.nc'))) == 1
+
+    # a cache hit doesn't read the source file
+    def fail(path, blocksize=None):
+        raise AssertionError('source file was hashed')
+    monkeypatch.setattr(daymet, 'file_hash', fail)
+    cached = climatology(daily_file, 'monthly_mean', cache_dir=cache_dir)
+    assert cached.attrs['source_sha256'] == reduced.attrs['source_sha256']
+    # the cached values are stored as float32
+    np.testing.assert_allclose(cached.values, reduced.values, rtol=1e-6)
+    monkeypatch.undo()
+
+    # touching the source file rehashes it, but it is the same
+    os.utime(daily_file, (1, 1))
+    climatology(daily_file, 'monthly_mean', cache_dir=cache_dir)
+    assert len(list(cache_dir.glob('*.nc'))) == 1
+    # a change to the source file is a new computation
+    with xr.open_dataset(daily_file) as ds:
+        ds = ds.load()
+    (ds * 2).to_netcdf(daily_file)
+    doubled = climatology(daily_file, 'monthly_mean', cache_dir=cache_dir)
+    assert len(list(cache_dir.glob('*.nc'))) == 2
+    np.testing.assert_allclose(doubled.values, reduced.values * 2, rtol=1e-6)
+
+
+def test_extract_sites():
+    """The KD-tree lookup on the (curvilinear) lat/lon grid finds the
+    same cells as selecting the nearest x and y on the projected grid."""
+    da = synthetic(ntimes=4)
+    to_latlon = Transformer.from_crs(daymet_proj_string, 4269, always_xy=True)
+    lon, lat = to_latlon.transform(*np.meshgrid(da.x, da.y))
+    da = da.assign_coords(lat=(('y', 'x'), lat), lon=(('y', 'x'), lon))
+    # sites within 0.3 cells of a cell center (away from the cell edges,
+    # where the nearest cell on the sphere may differ)
+    rng = np.random.default_rng(1)
+    nsites = 30
+    i = rng.integers(0, da.sizes['y'], nsites)
+    j = rng.integers(0, da.sizes['x'], nsites)
+    x = da.x.values[j] + rng.uniform(-300, 300, nsites)
+    y = da.y.values[i] + rng.uniform(-300, 300, nsites)
+    sites = pd.DataFrame({'x': x, 'y': y},
+                         index=[f'site{n}' for n in range(nsites)])
+    extracted = extract_sites(da, sites, crs=daymet_proj_string)
+    assert extracted.dims == ('time', 'site')
+    np.testing.assert_array_equal(extracted.i, i)
+    np.testing.assert_array_equal(extracted.j, j)
+    expected = da.sel(x=xr.DataArray(x, dims='site'),
+                      y=xr.DataArray(y, dims='site'), method='nearest')
+    np.testing.assert_array_equal(extracted.values, expected.values)
+    assert list(extracted.site.values) == list(sites.index)
+
+    # the same sites in geographic coordinates, with a reused index
+    site_lon, site_lat = to_latlon.transform(x, y)
+    index = SiteIndex(da.lat, da.lon)
+    latlon = extract_sites(da, dict(zip(sites.index, zip(site_lat, site_lon))),
+                           index=index)
+    np.testing.assert_array_equal(latlon.values, extracted.values)
+    latlon = extract_sites(da, pd.DataFrame({'lat': site_lat, 'lon': site_lon},
+                                            index=sites.index), index=index)
+    np.testing.assert_array_equal(latlon.values, extracted.values)
+
+
+def rectangles():
+    """Rectangles (xmin, ymin, xmax, ymax) that cut across grid cells,
+    plus one that covers only the nodata cells."""
+    x0, y0 = -1.5e6, 5e5
+    return [(x0 + 2300, y0 - 17800, x0 + 9100, y0 - 3400),
+            (x0 + 15500, y0 - 31250, x0 + 41700, y0 - 8900),
+            (x0 + 100, y0 - 39900, x0 + 49900, y0 - 100),
+            (x0 + 20000, y0 - 13000, x0 + 24000, y0 - 10000)]
+
+
+def dense_fractions(da, bounds, cellsize=1000.):
+    """Fraction of each cell within a rectangle, from the overlap
+    of the cell and rectangle extents."""
+    xmin, ymin, xmax, ymax = bounds
+    x, y = da.x.values, da.y.values
+    dx = np.clip(np.minimum(x + cellsize/2, xmax) -
+                 np.maximum(x - cellsize/2, xmin), 0, None)
+    dy = np.clip(np.minimum(y + cellsize/2, ymax) -
+                 np.maximum(y - cellsize/2, ymin), 0, None)
+    return np.outer(dy, dx) / cellsize**2
+
+
+def test_polygon_weights_and_means(tmp_path):
+    gpd = pytest.importorskip('geopandas')
+    shapely = pytest.importorskip('shapely')
+    da = synthetic(ntimes=5)
+    bounds = rectangles()
+    triangle = shapely.Polygon([(-1.5e6 + 30100, 5e5 - 2300),
+                                (-1.5e6 + 47700, 5e5 - 5100),
+                                (-1.5e6 + 35300, 5e5 - 26900)])
+    polygons = gpd.GeoDataFrame(
+        geometry=[shapely.box(*b) for b in bounds] + [triangle],
+        crs=daymet_proj_string)
+    weights = polygon_weights(da, polygons, cache_dir=None)
+    assert weights.shape == (len(polygons), da.sizes['y'] * da.sizes['x'])
+    assert not list(tmp_path.iterdir())
+    for k, b in enumerate(bounds):
+        np.testing.assert_allclose(weights[[k]].toarray().reshape(da.shape[1:]),
+                                   dense_fractions(da, b), atol=1e-9)
+    # the weights add up to the area of the polygon (in cells)
+    assert weights[[len(bounds)]].sum() == pytest.approx(triangle.area / 1000.**2)
+
+    # the means match a dense area-weighted mean, excluding the nodata
+    means = polygon_means(da, weights, names=list('abcde'), time_chunk=2)
+    assert means.dims == ('time', 'polygon')
+    assert list(means.polygon.values) == list('abcde')
+    values = da.values
+    valid = np.isfinite(values)
+    for k, b in enumerate(bounds):
+        fraction = dense_fractions(da, b)
+        expected = np.nansum(values * fraction, axis=(1, 2)) / \
+            (valid * fraction).sum(axis=(1, 2))
+        if k == 3:
+            # only nodata cells
+            assert np.isnan(means.values[:, k]).all()
+        else:
+            np.testing.assert_allclose(means.values[:, k], expected, rtol=1e-9)
+    np.testing.assert_allclose(polygon_means(da, weights, time_chunk=365).values,
+                               means.values)
+
+
+def test_polygon_weights_cache(tmp_path, monkeypatch):
+    gpd = pytest.importorskip('geopandas')
+    shapely = pytest.importorskip('shapely')
+    da = synthetic()
+    polygons = gpd.GeoDataFrame(
+        geometry=[shapely.box(*b) for b in rectangles()],
+        crs=daymet_proj_string)
+    cache_dir = tmp_path / 'cache'
+    weights = polygon_weights(da, polygons, cache_dir=cache_dir)
+    assert len(list(cache_dir.glob('polygon_weights_*.npz'))) == 1
+
+    # the cached weights are loaded instead of intersecting the cells
+    def fail(*args, **kwargs):
+        raise AssertionError('weights were recomputed')
+    monkeypatch.setattr(daymet.shapely, 'STRtree', fail)
+    cached = polygon_weights(da, polygons, cache_dir=cache_dir)
+    assert type(cached) is type(weights)
+    assert (cached != weights).nnz == 0
+    with pytest.raises(AssertionError, match='recomputed'):
+        polygon_weights(da, polygons, cache_dir=cache_dir, overwrite=True)
+    monkeypatch.undo()
+
+    # different polygons (or a different grid) are cached separately
+    polygon_weights(da, polygons.iloc[:2], cache_dir=cache_dir)
+    polygon_weights(da.isel(x=slice(1, None)), polygons, cache_dir=cache_dir)
+    assert len(list(cache_dir.glob('polygon_weights_*.npz'))) == 3
@@ -0,0 +1,94 @@
+import sys
+sys.path.append('notebooks/part0_python_intro')
+import numpy as np
+import pytest
+import rasterio
+from matplotlib.colors import LightSource
+from rasterio.transform import from_origin
+from dem_stack import DEMStack
+
+nrow, ncol, cellsize = 50, 70, 30.
+
+
+def write_dem(path, elevation, nodata=-9999.):
+    meta = {'driver': 'GTiff', 'height': nrow, 'width': ncol, 'count': 1,
+            'dtype': 'float64', 'crs': 'EPSG:26910', 'nodata': nodata,
+            'transform': from_origin(5e5, 5.2e6, cellsize, cellsize)}
+    with rasterio.open(path, 'w', **meta) as dest:
+        dest.write(np.where(np.isnan(elevation), nodata, elevation), 1)
+    return path
+
+
+def surface():
+    """Smooth terrain, with slopes facing all directions."""
+    y, x = np.mgrid[0:nrow, 0:ncol] * cellsize
+    return 1000 + 50 * np.sin(x / 300) + 30 * np.cos(y / 200) + 0.05 * y
+
+
+@pytest.fixture
+def stack(tmp_path):
+    rng = np.random.default_rng(0)
+    elevation = surface()
+    later = elevation + rng.normal(-1, 2, size=elevation.shape)
+    later[5:8, 10:30] = np.nan
+    rasters = {1970: write_dem(tmp_path / '1970.tif', elevation),
+               2015: write_dem(tmp_path / '2015.tif', later)}
+    # blocks that don't divide the raster evenly
+    return DEMStack(rasters, block_shape=(16, 24)), elevation, later
+
+
+def blocks(stack, func, *args, **kwargs):
+    """Assemble the block results into a whole array."""
+    result = np.ma.masked_all(stack.shape[1:])
+    for window, values in stack.iter_blocks(func, *args, **kwargs):
+        rows, cols = window.toslices()
+        result[rows, cols] = values
+    return result
+
+
+def test_difference_and_rate(stack):
+    stack, elevation, later = stack
+    assert stack.shape == (2, nrow, ncol)
+    diffs = blocks(stack, stack.difference, 1970, 2015)
+    np.testing.assert_array_equal(diffs.mask, np.isnan(later))
+    np.testing.assert_allclose(diffs.compressed(),
+                               (later - elevation)[~np.isnan(later)])
+    rates = blocks(stack, stack.rate, 1970, 2015)
+    np.testing.assert_allclose(rates.compressed(), diffs.compressed() / 45)
+    np.testing.assert_allclose(stack[1, 3:9, 20], later[3:9, 20])
+
+
+def test_masked_sum(stack):
+    stack, elevation, later = stack
+    diffs = later - elevation
+    assert stack.masked_sum(1970, 2015) == pytest.approx(np.nansum(diffs))
+    mask = np.zeros((nrow, ncol), dtype=bool)
+    mask[20:40, 30:] = True
+    assert stack.masked_sum(1970, 2015, mask=mask) == \
+        pytest.approx(np.nansum(diffs[~mask]))
+    zones = np.zeros((nrow, ncol), dtype=int)
+    zones[:25, :35] = 1
+    zones[30:, 10:60] = 3
+    totals = stack.masked_sum(1970, 2015, mask=mask, zones=zones, volume=True)
+    assert set(totals) == {1, 3}
+    for zone in 1, 3:
+        expected = np.nansum(diffs[(zones == zone) & ~mask]) * cellsize**2
+        assert totals[zone] == pytest.approx(expected)
+
+
+def test_hillshade(stack):
+    stack, elevation, _ = stack
+    intensity = blocks(stack, stack.hillshade, 1970)
+    np.testing.assert_allclose(intensity, stack.hillshade(1970), atol=1e-12)
+    # LightSource.hillshade stretches the intensity to the range
+    # of the array (the slopes here are lit, so nothing is clipped)
+    expected = LightSource(azdeg=315, altdeg=45).hillshade(
+        elevation, dx=cellsize, dy=cellsize)
+    assert intensity.min() > 0
+    stretched = (intensity - intensity.min()) / (intensity.max() - intensity.min())
+    np.testing.assert_allclose(stretched, expected, atol=1e-9)
+    # slopes facing the light (from the northwest, so rising
+    # to the east and south) are brighter
+    sun_facing = (np.gradient(elevation, axis=1) > 0) & \
+        (np.gradient(elevation, axis=0) > 0)
+    assert intensity[sun_facing].mean() > intensity[~sun_facing].mean()
@@ -0,0 +1,233 @@
+import sys
+sys.path.append('notebooks/part0_python_intro')
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import gage_data
+from gage_data import WaterDataCache, load_gage_data, site_analytics
+
+
+class LocalWaterData:
+    """Stand-in for dataretrieval.waterdata that makes up
+    daily values, and records the requests that were made."""
+    def __init__(self, statistic_ids=('00003',)):
+        self.requests = []
+        self.statistic_ids = statistic_ids
+
+    def get_daily(self, monitoring_location_id, parameter_code, time,
+                  statistic_id=None):
+        self.requests.append((tuple(monitoring_location_id), time))
+        start, end = time.split('/')
+        dates = pd.date_range(start, end, freq='D')
+        statistic_ids = self.statistic_ids if statistic_id is None \
+            else [statistic_id]
+        dfs = []
+        for site in monitoring_location_id:
+            for stat in statistic_ids:
+                dfs.append(pd.DataFrame({
+                    'monitoring_location_id': site,
+                    'parameter_code': parameter_code,
+                    'statistic_id': stat,
+                    'time': dates.strftime('%Y-%m-%d'),
+                    'value': np.arange(len(dates), dtype=float)}))
+        return pd.concat(dfs, ignore_index=True), None
+
+    def get_monitoring_locations(self, **kwargs):
+        self.requests.append(kwargs)
+        return pd.DataFrame({'monitoring_location_id': ['USGS-1', 'USGS-2']}), None
+
+
+@pytest.fixture
+def client(tmp_path):
+    return WaterDataCache(tmp_path / 'cache', service=LocalWaterData(),
+                          batch_size=2)
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    """Daily values CSV, with the dates in two formats."""
+    dates = pd.date_range('2000-01-01', '2000-03-31', freq='D')
+    df = pd.DataFrame({'monitoring_location_id': 'USGS-1',
+                       'parameter_code': '00060',
+                       'time': dates.strftime('%Y-%m-%d'),
+                       'date': dates.strftime('%d/%m/%Y'),
+                       'value': np.arange(len(dates), dtype=float)})
+    csv_file = tmp_path / 'gage_data.csv'
+    df.to_csv(csv_file, index=False)
+    return csv_file
+
+
+@pytest.mark.parametrize('cache_format', ['parquet', 'feather'])
+def test_load_gage_data(csv_file, monkeypatch, cache_format):
+    pytest.importorskip('pyarrow')
+    df = load_gage_data(csv_file, cache_format=cache_format)
+    cache_file = csv_file.with_suffix(f'.{cache_format}')
+    assert cache_file.exists()
+    assert len(df) == 91
+    assert df.index[0] == pd.Timestamp('2000-01-01')
+    assert df['parameter_code'].iloc[0] == '00060'
+    assert df['value'].dtype == np.float32
+
+    reads, hashes = [], []
+    read_csv, file_signature = gage_data._read_csv, gage_data._file_signature
+
+    def counted_read_csv(*args, **kwargs):
+        reads.append(args)
+        return read_csv(*args, **kwargs)
+
+    def counted_file_signature(path, hash_contents=False):
+        hashes.append(hash_contents)
+        return file_signature(path, hash_contents)
+    monkeypatch.setattr(gage_data, '_read_csv', counted_read_csv)
+    monkeypatch.setattr(gage_data, '_file_signature', counted_file_signature)
+
+    # the second load is from the cache, without hashing the CSV
+    cached = load_gage_data(csv_file, cache_format=cache_format)
+    pd.testing.assert_frame_equal(cached, df)
+    assert not reads and not any(hashes)
+
+    # touching the CSV hashes it once, but it is the same
+    os.utime(csv_file, (1, 1))
+    pd.testing.assert_frame_equal(
+        load_gage_data(csv_file, cache_format=cache_format), df)
+    assert not reads and hashes.count(True) == 1
+    load_gage_data(csv_file, cache_format=cache_format)
+    assert hashes.count(True) == 1
+
+    # the dates parsed from another column aren't in the cache
+    other = load_gage_data(csv_file, cache_format=cache_format,
+                           datetime_column='date', datetime_format='%d/%m/%Y')
+    assert len(reads) == 1
+    np.testing.assert_array_equal(other.index, df.index)
+    assert 'time' in other.columns
+    load_gage_data(csv_file, cache_format=cache_format,
+                   datetime_column='date', datetime_format='%d/%m/%Y')
+    assert len(reads) == 1
+    load_gage_data(csv_file, cache_format=cache_format)
+    assert len(reads) == 2
+
+    # an edit to the CSV is reread
+    with open(csv_file, 'a') as dest:
+        dest.write('USGS-1,00060,2000-04-01,01/04/2000,91.0\n')
+    assert len(load_gage_data(csv_file, cache_format=cache_format)) == 92
+    assert len(reads) == 3
+
+
+def test_get_daily_only_fetches_missing_spans(client, tmp_path):
+    sites = ['USGS-1', 'USGS-2', 'USGS-3']
+    df = client.get_daily(sites, '00060', time='2000-01-01/2000-12-31')
+    assert len(df) == 3 * 366
+    # 3 sites in batches of 2
+    assert len(client.service.requests) == 2
+
+    # same request: nothing to download
+    client.service.requests.clear()
+    df2 = client.get_daily(sites, '00060', time='2000-01-01/2000-12-31')
+    assert not client.service.requests
+    pd.testing.assert_frame_equal(df, df2)
+
+    # extend the end; only the new days are requested
+    df3 = client.get_daily(sites[:2], '00060', time='2000-06-01/2001-01-10')
+    assert client.service.requests == [(('USGS-1', 'USGS-2'),
+                                        '2001-01-01/2001-01-10')]
+    assert len(df3) == 2 * (len(pd.date_range('2000-06-01', '2001-01-10')))
+
+    # the cached spans persist across instances
+    client2 = WaterDataCache(tmp_path / 'cache', service=LocalWaterData())
+    assert client2.missing_spans('USGS-1', '00060', '1999-12-01', '2001-01-10') == \
+        [(pd.Timestamp('1999-12-01'), pd.Timestamp('1999-12-31'))]
+
+
+def test_get_daily_statistics(tmp_path):
+    client = WaterDataCache(tmp_path / 'cache',
+                            service=LocalWaterData(('00001', '00003')))
+    df = client.get_daily('USGS-1', '00060', time='2000-01-01/2000-01-10')
+    assert len(df) == 20
+    # extending the span keeps both statistics for each day
+    df = client.get_daily('USGS-1', '00060', time='2000-01-05/2000-01-20')
+    assert len(df) == 32
+    assert (df.groupby('statistic_id').size() == 16).all()
+
+
+def test_get_daily_filtered_requests_are_cached_separately(tmp_path):
+    client = WaterDataCache(tmp_path / 'cache',
+                            service=LocalWaterData(('00001', '00003')))
+    span = '2000-01-01/2000-01-10'
+    filtered = client.get_daily('USGS-1', '00060', time=span,
+                                statistic_id='00003')
+    assert len(filtered) == 10
+    assert set(filtered['statistic_id']) == {'00003'}
+    # an unfiltered request isn't answered from the filtered data
+    df = client.get_daily('USGS-1', '00060', time=span)
+    assert len(df) == 20
+    assert len(client.service.requests) == 2
+    # but the same filtered request is
+    filtered2 = client.get_daily('USGS-1', '00060', time=span,
+                                 statistic_id='00003')
+    assert len(client.service.requests) == 2
+    pd.testing.assert_frame_equal(filtered, filtered2)
+
+
+def test_get_monitoring_locations(client):
+    info = client.get_monitoring_locations(bbox=[-123.1, 38.45, -122.9, 38.55])
+    info2 = client.get_monitoring_locations(bbox=[-123.1, 38.45, -122.9, 38.55])
+    assert len(client.service.requests) == 1
+    pd.testing.assert_frame_equal(info, info2)
+
+
+def test_site_analytics_from_get_daily(client, tmp_path):
+    df = client.get_daily(['USGS-1', 'USGS-2'], '00060',
+                          time='2000-01-01/2001-12-31')
+    pdf_file = tmp_path / 'sites.pdf'
+    results, summary = site_analytics(df, max_workers=2, pdf_file=pdf_file)
+    summary = summary.set_index('monitoring_location_id')
+    assert (summary['count'] == 24).all()
+    assert (summary['start'] == pd.Timestamp('2000-01-01')).all()
+    assert (summary['end'] == pd.Timestamp('2001-12-01')).all()
+    # the pages are vector graphics, not embedded images
+    pypdf = pytest.importorskip('pypdf')
+    reader = pypdf.PdfReader(pdf_file)
+    assert len(reader.pages) == 2
+    assert not any(page.images for page in reader.pages)
+    # the single-page files are removed
+    assert sorted(tmp_path.iterdir()) == [tmp_path / 'cache', pdf_file]
+
+    with pytest.raises(ValueError):
+        site_analytics(df.drop(columns='time'))
+
+
+def test_site_analytics_statistics(tmp_path):
+    client = WaterDataCache(tmp_path / 'cache',
+                            service=LocalWaterData(('00001', '00002', '00003')))
+    df = client.get_daily(['USGS-2', 'USGS-1'], '00060',
+                          time='2000-01-01/2000-12-31')
+    # daily maximum, minimum and mean
+    offsets = {'00001': 10., '00002': -10., '00003': 0.}
+    df['value'] += df['statistic_id'].map(offsets).astype(float)
+    pdf_file = tmp_path / 'sites.pdf'
+    results, summary = site_analytics(df, max_workers=3, pdf_file=pdf_file)
+    # one series for each site and statistic
+    assert len(summary) == 6
+    assert list(zip(summary['monitoring_location_id'], summary['statistic_id'])) == \
+        [(site, stat) for site in ('USGS-1', 'USGS-2')
+         for stat in ('00001', '00002', '00003')]
+    assert (summary['parameter_code'] == '00060').all()
+    assert (summary['count'] == 12).all()
+    monthly = df.loc[df['monitoring_location_id'] == 'USGS-1'].groupby(
+        ['statistic_id', pd.to_datetime(df['time']).dt.month])['value'].mean()
+    for stat in offsets:
+        values = results.loc[(results['monitoring_location_id'] == 'USGS-1') &
+                             (results['statistic_id'] == stat), 'value']
+        np.testing.assert_allclose(values, monthly[stat].values)
+
+    # one page for each series, in the same order
+    pypdf = pytest.importorskip('pypdf')
+    reader = pypdf.PdfReader(pdf_file)
+    assert len(reader.pages) == 6
+    titles = [' '.join(row) for row in
+              summary[['monitoring_location_id', 'parameter_code',
+                       'statistic_id']].values]
+    for page, title in zip(reader.pages, titles):
+        assert title in page.extract_text()
+        assert not page.images
@@ -0,0 +1,203 @@
+import sys
+sys.path.append('notebooks/part1_flopy')
+import json
+from pathlib import Path
+import shutil
+import numpy as np
+import pytest
+from mf6_input import (PackagePatcher, read_array, read_arrays, read_lists,
+                        split_line)
+
+pleasant = Path('notebooks/part1_flopy/data/pleasant-lake')
+
+chd_text = """\
+# a CHD package without an OPTIONS block
+BEGIN dimensions
+  MAXBOUND  3
+END dimensions
+
+BEGIN period  1
+  1 1 1  10.0  # upper left
+  1 1 2  11.0 ! next to it
+  # a comment line
+  1 2 1  12.0
+END period  1
+"""
+
+
+def data_lines(text, block):
+    """Token lists of the lines in a block, without comments."""
+    lines, inside = [], False
+    for line in text.splitlines():
+        tokens = split_line(line)
+        if not tokens:
+            continue
+        if tokens[0].upper() == 'BEGIN':
+            inside = tokens[1].lower() == block
+        elif tokens[0].upper() == 'END':
+            inside = False
+        elif inside and not tokens[0].startswith(('#', '!')):
+            lines.append(tokens)
+    return lines
+
+
+def test_patcher_adds_options_block(tmp_path):
+    chd = tmp_path / 'model.chd'
+    chd.write_text(chd_text)
+    patcher = PackagePatcher(chd)
+    patcher.add_auxiliary('iface', [1, 2, 3])
+    patcher.set_option('save_flows')
+    patcher.write()
+    text = chd.read_text()
+    # the OPTIONS block comes first
+    assert text.index('BEGIN OPTIONS') < text.index('BEGIN dimensions')
+    assert data_lines(text, 'options') == [['AUXILIARY', 'iface'],
+                                           ['SAVE_FLOWS']]
+    # the new column goes after the head, not into the comments
+    assert data_lines(text, 'period') == [['1', '1', '1', '10.0', '1',
+                                           '#', 'upper', 'left'],
+                                          ['1', '1', '2', '11.0', '2',
+                                           '!', 'next', 'to', 'it'],
+                                          ['1', '2', '1', '12.0', '3']]
+    records = read_lists(chd)[0]
+    assert records.dtype.names == ('k', 'i', 'j', 'head', 'iface')
+    np.testing.assert_array_equal(records['head'], [10., 11., 12.])
+    np.testing.assert_array_equal(records['iface'], [1, 2, 3])
+
+
+def test_patcher_with_comments_in_options(tmp_path):
+    chd = tmp_path / 'model.chd'
+    chd.write_text(chd_text.replace(
+        'BEGIN dimensions',
+        'BEGIN options\n  AUXILIARY  a  # the a variable\n  BOUNDNAMES\n'
+        'END options\n\nBEGIN dimensions').replace(
+        '10.0  # upper', '10.0 5.0 well1  # upper').replace(
+        '11.0 ! next', '11.0 6.0 well2 ! next').replace(
+        '12.0', '12.0 7.0 well3'))
+    patcher = PackagePatcher(chd)
+    patcher.add_auxiliary('b', 0)
+    patcher.set_column('period', 'a', lambda tokens: float(tokens[4]) * 2)
+    patcher.write()
+    text = chd.read_text()
+    assert data_lines(text, 'options')[0] == ['AUXILIARY', 'a', 'b',
+                                              '#', 'the', 'a', 'variable']
+    records = read_lists(chd)[0]
+    assert records.dtype.names == ('k', 'i', 'j', 'head', 'a', 'b',
+                                   'boundname')
+    np.testing.assert_array_equal(records['a'], [10., 12., 14.])
+    np.testing.assert_array_equal(records['b'], [0, 0, 0])
+    assert list(records['boundname']) == ['well1', 'well2', 'well3']
+
+
+def test_patcher_external_files(tmp_path):
+    sim_ws = tmp_path / 'pleasant'
+    (sim_ws / 'external').mkdir(parents=True)
+    shutil.copy(pleasant / 'pleasant.wel', sim_ws)
+    for f in (pleasant / 'external').glob('wel_*.dat'):
+        shutil.copy(f, sim_ws / 'external')
+    original = read_lists(sim_ws / 'pleasant.wel')
+
+    patcher = PackagePatcher(sim_ws / 'pleasant.wel')
+    patcher.add_auxiliary('iface', -1)
+    patcher.rewrite_external(lambda path: path.replace('external',
+                                                       'external2'))
+    patcher.write(tmp_path / 'patched/pleasant.wel')
+    patched = read_lists(tmp_path / 'patched/pleasant.wel')
+    assert patched.keys() == original.keys()
+    for per, records in original.items():
+        for name in records.dtype.names:
+            np.testing.assert_array_equal(patched[per][name], records[name])
+        assert (patched[per]['iface'] == -1).all()
+    assert (tmp_path / 'patched/external2/wel_000.dat').exists()
+    # the original files are unchanged
+    assert read_lists(sim_ws / 'pleasant.wel')[0].dtype == original[0].dtype
+
+
+def test_read_arrays_cache(tmp_path):
+    cache_dir = tmp_path / 'cache'
+    npf = read_arrays(pleasant / 'pleasant.npf', cache_dir=cache_dir)
+    k0 = np.loadtxt(pleasant / 'external/k_000.dat')
+    assert npf['k'].shape == (4, k0.size)
+    np.testing.assert_array_equal(npf['k'][0], k0.ravel())
+    assert npf['icelltype'] == 1.
+    sidecar = json.loads((cache_dir / 'external_files.json').read_text())
+    assert len(sidecar) == 8
+
+    # the second read uses the cached copies
+    npf2 = read_arrays(pleasant / 'pleasant.npf', cache_dir=cache_dir,
+                       shape=k0.shape)
+    assert npf2['k'].shape == (4,) + k0.shape
+    np.testing.assert_array_equal(npf2['k33'][3].ravel(), npf['k33'][3])
+
+
+def test_read_array_forms(tmp_path):
+    path = tmp_path / 'array.dat'
+    path.write_text('# header\n1.0 2.0D0 3*0.5  # trailing comment\n'
+                    '1.5d-1 ! other comment\n2*7\n')
+    np.testing.assert_array_equal(read_array(path),
+                                  [1., 2., .5, .5, .5, .15, 7., 7.])
+    path.write_text('1.0 2.0 three 4.0\n')
+    with pytest.raises(ValueError, match='could not parse'):
+        read_array(path)
+
+
+def test_read_arrays_sizes(tmp_path):
+    (tmp_path / 'top.dat').write_text('1. 2. 3. 4. 5.\n')
+    package = tmp_path / 'model.dis'
+    package.write_text("""\
+BEGIN griddata
+  delr
+    INTERNAL  FACTOR  1.0
+      2*10.0
+  top
+    OPEN/CLOSE  'top.dat'
+  botm  LAYERED
+    INTERNAL
+      1.0D0 2*0.5 1.
+    INTERNAL
+      0.5D0 0.25 2*0.
+END griddata
+""")
+    arrays = read_arrays(package)
+    np.testing.assert_array_equal(arrays['delr'], [10., 10.])
+    np.testing.assert_array_equal(arrays['botm'],
+                                  [[1., .5, .5, 1.], [.5, .25, 0., 0.]])
+    # 5 values aren't one (2, 2) layer
+    with pytest.raises(ValueError, match='top has 5 values'):
+        read_arrays(package, shape=(2, 2))
+    (tmp_path / 'top.dat').write_text('1. 2. 3. 4.\n')
+    arrays = read_arrays(package, shape=(2, 2))
+    assert arrays['top'].shape == (2, 2)
+    assert arrays['botm'].shape == (2, 2, 2)
+    package.write_text(package.read_text().replace(
+        "'top.dat'", "'top.bin'  (BINARY)"))
+    with pytest.raises(ValueError, match='binary'):
+        read_arrays(package)
+
+
+sfr_text = """\
+BEGIN options
+  BOUNDNAMES
+END options
+
+BEGIN packagedata
+  1  NONE     100. 5. 0.001 10. 1. 1. 0.03 1 1. 0  'unconnected reach'
+  2  1 2 3    100. 5. 0.001  9. 1. 1. 0.03 2 1. 0  'reach 2'
+  OPEN/CLOSE  'packagedata.dat'
+END packagedata
+"""
+
+
+def test_read_lists_none_cellids(tmp_path):
+    (tmp_path / 'packagedata.dat').write_text(
+        "3  none  100. 5. 0.001 8. 1. 1. 0.03 1 1. 0  'reach 3'\n"
+        "4  2 3 4  100. 5. 0.001 7. 1. 1. 0.03 1 1. 0  'reach 4'\n")
+    (tmp_path / 'model.sfr').write_text(sfr_text)
+    packagedata = read_lists(tmp_path / 'model.sfr', block='packagedata')[None]
+    np.testing.assert_array_equal(packagedata['ifno'], [1, 2, 3, 4])
+    np.testing.assert_array_equal(packagedata['k'], [0, 1, 0, 2])
+    np.testing.assert_array_equal(packagedata['j'], [0, 3, 0, 4])
+    np.testing.assert_array_equal(packagedata['rtp'], [10., 9., 8., 7.])
+    np.testing.assert_array_equal(packagedata['ncon'], [1, 2, 1, 1])
+    assert list(packagedata['boundname']) == ['unconnected reach', 'reach 2',
+                                              'reach 3', 'reach 4']
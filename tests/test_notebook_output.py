@@ -1,11 +1,10 @@
-import json
 import os
 from pathlib import Path
 import shutil
 import sys
 sys.path.append('notebooks')
 import pytest
-from clear_all_notebooks import skip_notebooks as leave_output_in
+from clear_all_notebooks import scan_notebook, skip_notebooks as leave_output_in
 
 
 def included_notebooks():
@@ -39,26 +38,13 @@ def testdir(request):
 
 def test_notebook_output(notebook):
     # run autotest on each notebook
+    has_outputs, _ = scan_notebook(notebook)
     if notebook.name not in leave_output_in:
-        with open(notebook) as src:
-            data = src.read()
-            data = json.loads(data)
-            for item in data['cells']:
-                for k, v in item.items():
-                    if item['cell_type'] == 'code':
-                        assert not any (item['outputs']),\
-                            (f"{notebook} has output "
-                                "but is not listed in notebooks/clean_all_notebooks.py "
-                                "as excepted!")
+        assert not has_outputs,\
+            (f"{notebook} has output "
+                "but is not listed in notebooks/clean_all_notebooks.py "
+                "as excepted!")
     else:
-        with open(notebook) as src:
-            data = src.read()
-            data = json.loads(data)
-            outputs = []
-            for item in data['cells']:
-                for k, v in item.items():
-                    if item['cell_type'] == 'code' and item['outputs']:
-                        outputs.append(item['outputs'])
-            assert outputs,\
-                (f"{notebook} is expected to have outputs but has none!\n"
-                 "Re-run this notebook and save with the outputs.")
\ No newline at end of file
+        assert has_outputs,\
+            (f"{notebook} is expected to have outputs but has none!\n"
+             "Re-run this notebook and save with the outputs.")
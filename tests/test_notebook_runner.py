@@ -0,0 +1,77 @@
+import os
+from nbclient.exceptions import CellExecutionError
+import notebook_cache
+from notebook_cache import ExecutionCache
+import notebook_runner
+from notebook_runner import (NotebookExecutor, NotebookResult,
+                             make_scratch_dir, remove_scratch_dir, repo_root)
+
+part = repo_root / 'notebooks/part1_flopy'
+notebook = part / 'solutions/04_Modelgrid_and_intersection_solution.ipynb'
+
+
+def test_scratch_dir_is_private(tmp_path):
+    scratch_root = tmp_path / 'scratch'
+    workdir = make_scratch_dir(notebook, scratch_root)
+    assert workdir == scratch_root / 'notebooks/part1_flopy/solutions'
+    assert (workdir / notebook.name).is_file()
+
+    # the part of the course is copied, so that changes to its
+    # data and figures folders stay in the scratch copy
+    data = workdir / '../data/modelgrid_intersection'
+    assert not os.path.islink(data) and not os.path.islink(data / 'pet.txt')
+    original = (part / 'data/modelgrid_intersection/pet.txt').read_bytes()
+    (data / 'pet.txt').write_text('changed')
+    (data / 'new_output.csv').write_text('new')
+    (workdir / '../figures/new_figure.png').write_bytes(b'')
+    assert (part / 'data/modelgrid_intersection/pet.txt').read_bytes() == original
+    assert not (part / 'data/modelgrid_intersection/new_output.csv').exists()
+    assert not (part / 'figures/new_figure.png').exists()
+
+    # everything else is linked
+    assert os.path.islink(scratch_root / 'notebooks/part0_python_intro')
+    assert not (scratch_root / 'tests').exists()
+
+    remove_scratch_dir(scratch_root)
+    assert not scratch_root.exists()
+    assert (repo_root / 'notebooks/part0_python_intro').is_dir()
+
+
+def test_cache_key_environment(tmp_path, monkeypatch):
+    cache = ExecutionCache(tmp_path / 'cache')
+    versions = {}
+    monkeypatch.setattr(notebook_cache, '_distribution_version',
+                        lambda name: versions.get(name, '1.0'))
+    key = cache.notebook_key(notebook)
+    # a package that the notebook doesn't import
+    versions['sphinx'] = '2.0'
+    assert cache.notebook_key(notebook) == key
+    # a package that it does
+    versions['flopy'] = '2.0'
+    assert cache.notebook_key(notebook) != key
+
+
+def test_only_passes_and_expected_failures_are_cached(tmp_path, monkeypatch):
+    results = {}
+
+    def run_notebook(notebook, scratch_root, pool=None, timeout=None):
+        return results[notebook.name]
+    monkeypatch.setattr(notebook_runner, 'run_notebook', run_notebook)
+    monkeypatch.setattr(NotebookExecutor, '_start_pool', lambda self: None)
+    solutions = part / 'solutions'
+    passes, fails, xfails = sorted(solutions.glob('*.ipynb'))[:3]
+    error = CellExecutionError('traceback', 'ConnectionError', 'no network')
+    results = {passes.name: NotebookResult(passes, True),
+               fails.name: NotebookResult(fails, False, error=error),
+               xfails.name: NotebookResult(xfails, False, error=error)}
+    cache = ExecutionCache(tmp_path / 'cache')
+    executor = NotebookExecutor(tmp_path / 'scratch', cache=cache,
+                                expected_failures=[xfails.name])
+    try:
+        for nb in passes, fails, xfails:
+            assert executor.result(nb).passed == results[nb.name].passed
+    finally:
+        executor.shutdown()
+    assert cache.get(passes)['passed']
+    assert cache.get(fails) is None
+    assert not cache.get(xfails)['passed']
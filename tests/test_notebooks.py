@@ -1,8 +1,15 @@
 import os
 from pathlib import Path
-import shutil
 import platform
 import pytest
+from notebook_cache import ExecutionCache
+from notebook_runner import (NotebookExecutor, default_workers,
+                             remove_scratch_dir)
+from notebook_timings import write_timings
+
+# results of previous runs, by notebook content
+# (see notebook_cache.py; run pytest with --force to ignore)
+cache_dir = Path('tests/.notebook_cache')
 
 # Notebooks that we don't expect to execute successfully
 # Notebook: reason
@@ -51,35 +58,58 @@ def included_notebooks():
     return files_with_xfails
 
 
-@pytest.fixture(params=included_notebooks(), scope='module')
+@pytest.fixture(params=included_notebooks(), ids=lambda f: f.as_posix(),
+                scope='module')
 def notebook(request):
     return request.param
 
 
-@pytest.fixture(scope='module')
-def testdir(request):
-    outdir = os.path.join('tests/temp')
-    if os.path.isdir(outdir):
-        shutil.rmtree(outdir)
-    os.mkdir(outdir)
+@pytest.fixture(scope='session')
+def executor(request):
+    """Executor for running the notebooks on warm kernels, several
+    at a time. Without pytest-xdist, all of the (non-skipped) notebooks
+    are submitted up front, so that they run concurrently; with xdist,
+    the notebooks are spread across the workers instead. Notebooks
+    with a cached result for their current content aren't executed,
+    unless pytest is run with --force (only passes, and the failures
+    of the xfail notebooks, are cached). With --timings, the wall time
+    and peak memory use of each cell of the executed notebooks are
+    written to a JSON file (see notebook_timings.py)."""
+    worker = os.environ.get('PYTEST_XDIST_WORKER', 'main')
+    outdir = Path('tests/temp') / worker
+    if outdir.is_dir():
+        remove_scratch_dir(outdir)
+    outdir.mkdir(parents=True)
+    cache = ExecutionCache(cache_dir,
+                           force=request.config.getoption('force'))
+    executor = NotebookExecutor(outdir, max_workers=default_workers(),
+                                cache=cache, expected_failures=xfail_notebooks)
+    if worker == 'main':
+        for item in request.session.items:
+            if item.get_closest_marker('skip') is not None:
+                continue
+            callspec = getattr(item, 'callspec', None)
+            if callspec is not None and 'notebook' in callspec.params:
+                executor.submit(callspec.params['notebook'])
 
     def teardown():
-        if os.path.isdir(outdir):
-            shutil.rmtree(outdir)
+        executor.shutdown()
+        timings = request.config.getoption('timings')
+        if timings is not None:
+            if worker != 'main':
+                # merged by the controller (see conftest.py)
+                timings = f'{timings}.{worker}.part'
+            write_timings(executor.results(), timings)
+        if outdir.is_dir():
+            remove_scratch_dir(outdir)
     request.addfinalizer(teardown)
-    return outdir
+    return executor
 
 
-def test_notebook(notebook, testdir):
+def test_notebook(notebook, executor):
     # run autotest on each notebook
-    path, fname = os.path.split(notebook)
-    
-    cmd = ('jupyter ' + 'nbconvert '
-           '--ExecutePreprocessor.timeout=600 '
-           '--ExecutePreprocessor.kernel_name=python3 '
-           '--to ' + 'notebook '
-           f'--execute {notebook} '
-           f'--output-dir {testdir} '
-           f'--output {fname}')
-    ival = os.system(cmd)
-    assert ival == 0, f'could not run {fname}'
+    result = executor.result(notebook)
+    if result.cached:
+        print(f'{notebook.name}: cached result (no changes since last run)')
+    assert result.passed, f'could not run {notebook.name}:\n{result.error}'
+    executor.cleanup(notebook)
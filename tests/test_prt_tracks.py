@@ -0,0 +1,129 @@
+import sys
+sys.path.append('notebooks/part1_flopy')
+import numpy as np
+import pandas as pd
+import pytest
+from prt_tracks import TrackFile, particle_key, track_dtype
+
+
+def make_tracks(nparticles=25, seed=0):
+    """Made-up track records for particles released from two
+    packages at two times, interleaved in time order (as MODFLOW 6
+    writes them), with the names of the fields in a different order
+    than the default dtype."""
+    rng = np.random.default_rng(seed)
+    dfs = []
+    for i in range(nparticles):
+        n = rng.integers(1, 30)
+        trelease = [0., 100.][i % 2]
+        t = trelease + np.cumsum(rng.uniform(1, 50, n)) - 1
+        dfs.append(pd.DataFrame({
+            'kper': 1, 'kstp': 1, 'imdl': 1, 'iprp': 1 + i % 3 // 2,
+            'irpt': i // 2 + 1, 'ilay': rng.integers(1, 4, n),
+            'icell': rng.integers(1, 500, n), 'izone': rng.integers(0, 3, n),
+            'istatus': 1, 'ireason': 1, 'trelease': trelease, 't': t,
+            'x': np.cumsum(rng.normal(0, 10, n)),
+            'y': np.cumsum(rng.normal(0, 10, n)),
+            'z': rng.uniform(0, 100, n)}))
+        dfs[-1].loc[0, 'ireason'] = 0
+        if i % 4:
+            dfs[-1].loc[n - 1, 'ireason'] = 3
+    df = pd.concat(dfs).sort_values('t', kind='stable')
+    return df[df.columns[::-1]].reset_index(drop=True)
+
+
+@pytest.fixture(params=['binary', 'csv'])
+def tracks(request, tmp_path):
+    df = make_tracks()
+    if request.param == 'csv':
+        filename = tmp_path / 'model.trk.csv'
+        df.assign(name='').to_csv(filename, index=False)
+    else:
+        filename = tmp_path / 'model.trk'
+        dtype = np.dtype([(c, track_dtype[c]) for c in df.columns])
+        records = np.empty(len(df), dtype=dtype)
+        for c in df.columns:
+            records[c] = df[c]
+        records.tofile(filename)
+        with open(f'{filename}.hdr', 'w') as dest:
+            dest.write(','.join(dtype.names) + '\n')
+            dest.write(','.join(dtype[c].str for c in dtype.names) + '\n')
+    return filename, df
+
+
+def groups(df):
+    """Records grouped by particle, numbered in key order."""
+    df = df.sort_values(particle_key + ['t'], kind='stable')
+    df['particle'] = df.groupby(particle_key, sort=True).ngroup()
+    df = df.reset_index(drop=True)
+    return df, df.groupby('particle')
+
+
+@pytest.mark.parametrize('chunksize', [1, 7, 1000])
+def test_endpoints(tracks, chunksize):
+    filename, df = tracks
+    trk = TrackFile(filename, chunksize=chunksize)
+    assert len(trk) == len(df)
+    endpoints = trk.endpoints(capture_cells=[10, 20])
+
+    df, grouped = groups(df)
+    first, last = grouped.first(), grouped.last()
+    assert len(endpoints) == len(first)
+    np.testing.assert_array_equal(endpoints.index, first.index)
+    for c in ['imdl', 'iprp', 'irpt', 'trelease']:
+        np.testing.assert_array_equal(endpoints[c], first[c])
+    for c in ['t', 'x', 'y', 'z', 'ilay', 'icell', 'izone', 'ireason']:
+        np.testing.assert_allclose(endpoints[f'start_{c}'], first[c])
+        np.testing.assert_allclose(endpoints[f'end_{c}'], last[c])
+    np.testing.assert_allclose(endpoints['travel_time'],
+                               last['t'] - first['trelease'])
+    np.testing.assert_array_equal(endpoints['nrecords'], grouped.size())
+    steps = grouped[['x', 'y', 'z']].diff()
+    path_length = np.sqrt((steps ** 2).sum(axis=1)).groupby(df['particle']).sum()
+    np.testing.assert_allclose(endpoints['path_length'], path_length)
+    np.testing.assert_array_equal(endpoints['terminated'], last['ireason'] == 3)
+    np.testing.assert_array_equal(endpoints['captured'], (last['ireason'] == 3) &
+                                  last['icell'].isin([10, 20]))
+
+
+@pytest.mark.parametrize('chunksize', [1, 7, 1000])
+@pytest.mark.parametrize('every, dt', [(1, None), (3, None), (1, 40.),
+                                       (2, 25.)])
+def test_pathlines(tracks, chunksize, every, dt):
+    filename, df = tracks
+    trk = TrackFile(filename, chunksize=chunksize)
+    columns = ['t', 'x', 'y', 'z', 'icell']
+    pathlines = trk.pathlines(every=every, dt=dt, columns=columns)
+
+    df, grouped = groups(df)
+    n = grouped.cumcount()
+    keep = (n % every) == 0
+    if dt is not None:
+        tbin = np.floor(df['t'] / dt)
+        keep &= tbin != tbin.groupby(df['particle']).shift()
+    keep |= (n == 0) | (n == grouped['t'].transform('size') - 1)
+    expected = df.loc[keep, ['particle'] + columns].reset_index(drop=True)
+    pd.testing.assert_frame_equal(pathlines, expected, check_dtype=False)
+    if every == 1 and dt is None:
+        assert len(pathlines) == len(df)
+    else:
+        assert len(pathlines) < len(df)
+    # the particle numbers match the endpoints
+    endpoints = trk.endpoints()
+    last = pathlines.groupby('particle').last()
+    np.testing.assert_allclose(endpoints['end_t'], last['t'])
+
+
+def test_read(tracks):
+    filename, df = tracks
+    records = TrackFile(filename, chunksize=10).read(list(df.columns))
+    pd.testing.assert_frame_equal(records, df, check_dtype=False)
+
+
+def test_empty_file(tmp_path):
+    empty = tmp_path / 'empty.trk'
+    empty.write_bytes(b'')
+    trk = TrackFile(empty)
+    assert len(trk) == 0
+    assert trk.endpoints().empty
+    assert trk.pathlines().empty
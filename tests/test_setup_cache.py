@@ -0,0 +1,202 @@
+import sys
+sys.path.append('notebooks/part1_flopy')
+import os
+from pathlib import Path
+import shutil
+import numpy as np
+import pytest
+from mf6_input import read_lists
+from setup_cache import StageCache, setup_from_yaml, source_files
+
+data = Path('notebooks/part1_flopy/data').resolve()
+
+
+def test_stage_key(tmp_path):
+    shapefile = tmp_path / 'wells.shp'
+    shapefile.write_text('shp')
+    (tmp_path / 'wells.dbf').write_text('dbf')
+    block = {'source_data': {'wells': 'wells.shp'}, 'options': ['save_flows']}
+    cache = StageCache(tmp_path / 'cache')
+    key = cache.stage_key('model/wel', [('wel', block, tmp_path, None)])
+    assert cache.stage_key('model/wel', [('wel', block, tmp_path, None)]) == key
+    # the configuration block, the stages it depends on,
+    # and the source files (and their sidecar files) are in the key
+    other_block = {**block, 'options': []}
+    assert cache.stage_key('model/wel',
+                           [('wel', other_block, tmp_path, None)]) != key
+    assert cache.stage_key('model/wel', [('wel', block, tmp_path, None)],
+                           dependencies=['dis key']) != key
+    (tmp_path / 'wells.dbf').write_text('dbf, edited')
+    assert cache.stage_key('model/wel', [('wel', block, tmp_path, None)]) != key
+    assert cache.get(key) is None
+
+
+def test_source_files(tmp_path):
+    for name in ('rasters/top.tif', 'rasters/botm.tif', 'lakes.shp',
+                 'lakes.prj', 'model/model.dis'):
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_text(name)
+    block = {'source_data': {'rasters': 'rasters', 'lakes': 'lakes.shp'},
+             'simulation': 'model', 'cfg': 'other.yml'}
+    expected = [tmp_path / name for name in
+                ('lakes.prj', 'lakes.shp', 'model/model.dis',
+                 'rasters/botm.tif', 'rasters/top.tif')]
+    assert source_files(block, tmp_path) == expected
+    # the simulation folder (with the same name as the simulation)
+    # isn't a source
+    assert source_files(block, tmp_path, exclude=[tmp_path / 'model']) == \
+        [f for f in expected if f.parent.name != 'model']
+
+
+def _input_lines(path):
+    """Lines of a model input file, without the headers with the time
+    that it was written."""
+    return [line for line in Path(path).read_text().splitlines()
+            if not line.startswith(('# File generated by Flopy',
+                                    '# via modflow-setup',
+                                    '# File created by modflow-setup'))]
+
+
+def _mfsetup_build(tmp_path, monkeypatch, cfg_files, sim_ws):
+    """Copy the Pleasant Lake configuration files to tmp_path,
+    and build the model with MF6model.setup_from_yaml (in
+    tmp_path/expected)."""
+    pytest.importorskip('mfsetup')
+    from mfsetup import MF6model
+
+    shutil.copytree(data / 'pleasant-lake', tmp_path / 'pleasant-lake')
+    for cfg_file in cfg_files:
+        shutil.copy(data / cfg_file, tmp_path)
+    # modflow-setup changes the working directory to the model folder
+    monkeypatch.chdir(tmp_path)
+    m = MF6model.setup_from_yaml(tmp_path / cfg_files[0])
+    m.write_input()
+    os.chdir(tmp_path)
+    os.rename(tmp_path / sim_ws, tmp_path / 'expected')
+    return tmp_path
+
+
+@pytest.fixture
+def pleasant(tmp_path, monkeypatch):
+    """Copy of the Pleasant Lake configuration, with the folder
+    for the model made with MF6model.setup_from_yaml."""
+    return _mfsetup_build(tmp_path, monkeypatch, ['pleasant.yml'],
+                          'pleasant-inset')
+
+
+@pytest.fixture
+def pleasant_lgr(tmp_path, monkeypatch):
+    """Copy of the Pleasant Lake LGR configuration, with the folder
+    for the model made with MF6model.setup_from_yaml."""
+    return _mfsetup_build(tmp_path, monkeypatch,
+                          ['pleasant_lgr_parent.yml', 'pleasant_lgr_inset.yml'],
+                          'pleasant-lgr')
+
+
+def _input_files(sim_ws):
+    return sorted(f.relative_to(sim_ws) for f in sim_ws.rglob('*')
+                  if f.is_file() and f.parts[-2] not in ('shps', 'postproc'))
+
+
+def _assert_same_input(sim_ws, expected):
+    files = _input_files(expected)
+    assert _input_files(sim_ws) == files
+    for f in files:
+        if f.suffix not in {'.shp', '.shx', '.dbf', '.chk'}:
+            assert _input_lines(sim_ws / f) == _input_lines(expected / f), f
+
+
+def test_setup_from_yaml(pleasant):
+    cfg_file = pleasant / 'pleasant.yml'
+    cache_dir = pleasant / 'setup_cache'
+    sim_ws = pleasant / 'pleasant-inset'
+    expected = pleasant / 'expected'
+
+    m = setup_from_yaml(cfg_file, cache_dir=cache_dir, verbose=False)
+    m.write_input()
+    os.chdir(pleasant)
+    assert {t.status for t in m.setup_tasks.tasks.values()} == {'run'}
+    # the same input files as MF6model.setup_from_yaml
+    _assert_same_input(sim_ws, expected)
+
+    # all of the stages are restored from the cache
+    shutil.rmtree(sim_ws)
+    m = setup_from_yaml(cfg_file, cache_dir=cache_dir, verbose=False)
+    m.write_input()
+    os.chdir(pleasant)
+    status = {name.split('/')[1]: t.status
+              for name, t in m.setup_tasks.tasks.items()}
+    assert status.pop('tdis') == status.pop('ims') == 'run'
+    assert set(status.values()) == {'cached'}
+    # the boundary heads interpolated from the parent model,
+    # and the wells
+    for ext in '.chd', '.wel':
+        lists = read_lists(sim_ws / f'pleasant-inset{ext}')
+        expected_lists = read_lists(expected / f'pleasant-inset{ext}')
+        assert lists.keys() == expected_lists.keys()
+        for per, records in expected_lists.items():
+            for name in records.dtype.names:
+                np.testing.assert_array_equal(lists[per][name], records[name])
+    assert _input_lines(sim_ws / 'pleasant-inset.chd') == \
+        _input_lines(expected / 'pleasant-inset.chd')
+
+    # only the stage for the edited block is rerun
+    cfg_file.write_text(cfg_file.read_text().replace(
+        'wel:\n  options:\n    print_input: True',
+        'wel:\n  options:\n    print_input: False'))
+    m = setup_from_yaml(cfg_file, cache_dir=cache_dir, verbose=False)
+    m.write_input()
+    os.chdir(pleasant)
+    rerun = {name for name, t in m.setup_tasks.tasks.items()
+             if t.status == 'run'}
+    assert rerun == {'pleasant-inset/tdis', 'pleasant-inset/ims',
+                     'pleasant-inset/wel'}
+    assert 'PRINT_INPUT' not in (sim_ws / 'pleasant-inset.wel').read_text()
+
+
+def test_setup_lgr(pleasant_lgr):
+    cfg_file = pleasant_lgr / 'pleasant_lgr_parent.yml'
+    cache_dir = pleasant_lgr / 'setup_cache'
+    sim_ws = pleasant_lgr / 'pleasant-lgr'
+    expected = pleasant_lgr / 'expected'
+
+    m = setup_from_yaml(cfg_file, cache_dir=cache_dir, verbose=False)
+    m.write_input()
+    os.chdir(pleasant_lgr)
+    graph = m.setup_tasks
+    assert {t.status for t in graph.tasks.values()} == {'run', 'ok'}
+    # the packages of each model in order, each inset package after
+    # the same parent package, and the exchanges once all are set up
+    inset_tasks = [name for name in graph.tasks
+                   if name.startswith('plsnt-lgr-inset/')]
+    assert inset_tasks
+    for name in inset_tasks:
+        parent_task = name.replace('plsnt-lgr-inset/', 'plsnt-lgr-parent/')
+        if parent_task in graph.tasks:
+            assert parent_task in graph.tasks[name].dependencies
+    exchanges = graph.tasks['lgr exchanges']
+    assert all(t.end <= exchanges.start for t in graph.tasks.values()
+               if t is not exchanges)
+    assert graph.critical_path()[-1] == 'lgr exchanges'
+    # the same input files as MF6model.setup_from_yaml
+    _assert_same_input(sim_ws, expected)
+
+    # the package stages of both models are restored from the cache
+    shutil.rmtree(sim_ws)
+    m = setup_from_yaml(cfg_file, cache_dir=cache_dir, verbose=False)
+    m.write_input()
+    os.chdir(pleasant_lgr)
+    status = {name: t.status for name, t in m.setup_tasks.tasks.items()}
+    run = {name for name, value in status.items() if value != 'cached'}
+    assert run == {'plsnt-lgr-parent/grid', 'plsnt-lgr-parent/tdis',
+                   'plsnt-lgr-parent/ims', 'lgr exchanges'}
+    assert 'plsnt-lgr-inset/lak' not in run
+    for ext in '.chd', '.wel':
+        lists = read_lists(sim_ws / f'plsnt-lgr-parent{ext}')
+        expected_lists = read_lists(expected / f'plsnt-lgr-parent{ext}')
+        assert lists.keys() == expected_lists.keys()
+        for per, records in expected_lists.items():
+            for name in records.dtype.names:
+                np.testing.assert_array_equal(lists[per][name], records[name])
+    assert _input_lines(sim_ws / 'pleasant-lgr.gwfgwf') == \
+        _input_lines(expected / 'pleasant-lgr.gwfgwf')
@@ -0,0 +1,118 @@
+import sys
+sys.path.append('notebooks/part1_flopy')
+import os
+from pathlib import Path
+import shutil
+import flopy
+import numpy as np
+import pytest
+from sim_cache import input_files, load_simulation
+
+data = Path('notebooks/part1_flopy/data')
+
+
+@pytest.fixture
+def sim_ws(tmp_path):
+    """Copy of the Pleasant Lake model input."""
+    sim_ws = tmp_path / 'pleasant-lake'
+    shutil.copytree(data / 'pleasant-lake', sim_ws,
+                    ignore=shutil.ignore_patterns('source_data'))
+    return sim_ws
+
+
+@pytest.fixture
+def flopy_loads(monkeypatch):
+    """Record the calls to MFSimulation.load."""
+    calls = []
+    load = flopy.mf6.MFSimulation.load
+
+    def counted_load(*args, **kwargs):
+        calls.append(kwargs)
+        return load(*args, **kwargs)
+    monkeypatch.setattr(flopy.mf6.MFSimulation, 'load', counted_load)
+    return calls
+
+
+def test_input_files(sim_ws):
+    files = input_files(sim_ws)
+    assert files[0] == Path('mfsim.nam')
+    for name in ('pleasant.tdis', 'pleasant.nam', 'pleasant.dis',
+                 'pleasant.sfr.obs', 'external/botm_000.dat',
+                 'external/600059060_stage_area_volume.dat'):
+        assert Path(name) in files
+    # model output isn't input
+    assert Path('pleasant.hds') not in files
+    assert all((sim_ws / f).is_file() for f in files)
+    assert len(set(files)) == len(files)
+
+
+def test_load_simulation(sim_ws, tmp_path, flopy_loads):
+    cache_dir = tmp_path / 'sim_cache'
+    sim = load_simulation(sim_ws, cache_dir=cache_dir)
+    assert len(flopy_loads) == 1
+    snapshots = list(cache_dir.glob('pleasant-lake-*.pkl'))
+    assert len(snapshots) == 1
+    assert Path(f'{snapshots[0]}.json').exists()
+    gwf = sim.get_model()
+    expected = flopy.mf6.MFSimulation.load(
+        sim_ws=str(sim_ws), verbosity_level=0).get_model()
+    flopy_loads.clear()
+    assert gwf.get_package_list() == expected.get_package_list()
+    np.testing.assert_array_equal(gwf.dis.botm.array, expected.dis.botm.array)
+
+    # the second load is from the snapshot, and independent of the first
+    sim2 = load_simulation(sim_ws, cache_dir=cache_dir)
+    assert not flopy_loads
+    gwf2 = sim2.get_model()
+    assert gwf2 is not gwf
+    assert gwf2.get_package_list() == expected.get_package_list()
+    np.testing.assert_array_equal(gwf2.dis.botm.array, expected.dis.botm.array)
+    np.testing.assert_array_equal(gwf2.wel.stress_period_data.get_data(1),
+                                  expected.wel.stress_period_data.get_data(1))
+    gwf2.npf.k = 1.
+    k = load_simulation(sim_ws, cache_dir=cache_dir).get_model().npf.k.array
+    np.testing.assert_array_equal(k, expected.npf.k.array)
+
+    # touching a file (without changing it) keeps the snapshot
+    os.utime(sim_ws / 'pleasant.npf', (1, 1))
+    load_simulation(sim_ws, cache_dir=cache_dir)
+    assert not flopy_loads
+
+    # as does editing a file that isn't input
+    (sim_ws / 'pleasant.hds').write_bytes(b'')
+    load_simulation(sim_ws, cache_dir=cache_dir)
+    assert not flopy_loads
+
+    # editing an input file (here an external array) reloads
+    botm_file = sim_ws / 'external/botm_000.dat'
+    botm = np.loadtxt(botm_file)
+    np.savetxt(botm_file, botm - 1.)
+    gwf = load_simulation(sim_ws, cache_dir=cache_dir).get_model()
+    assert len(flopy_loads) == 1
+    np.testing.assert_allclose(gwf.dis.botm.array[0], botm - 1.)
+    assert len(list(cache_dir.glob('*.pkl'))) == 1
+    load_simulation(sim_ws, cache_dir=cache_dir)
+    assert len(flopy_loads) == 1
+
+
+def test_load_simulation_packages(sim_ws, tmp_path, flopy_loads):
+    cache_dir = tmp_path / 'sim_cache'
+    gwf = load_simulation(sim_ws, packages=['dis', 'wel'],
+                          cache_dir=cache_dir).get_model()
+    packages = {p.lower() for p in gwf.get_package_list()}
+    assert {'dis', 'wel_0'} <= packages
+    assert not packages & {'sfr_0', 'lak_0', 'npf', 'rcha_0'}
+    # a separate snapshot for each set of packages
+    gwf = load_simulation(sim_ws, cache_dir=cache_dir).get_model()
+    assert 'SFR_0' in gwf.get_package_list()
+    assert len(list(cache_dir.glob('*.pkl'))) == 2
+    assert len(flopy_loads) == 2
+    load_simulation(sim_ws, packages=['dis', 'wel'], cache_dir=cache_dir)
+    assert len(flopy_loads) == 2
+
+
+def test_load_simulation_without_cache(sim_ws, flopy_loads):
+    gwf = load_simulation(sim_ws, packages=['dis']).get_model()
+    assert flopy_loads[0]['load_only'] == ['dis']
+    assert 'WEL_0' not in gwf.get_package_list()
+    assert not list(sim_ws.glob('*.pkl'))
@@ -0,0 +1,93 @@
+import sys
+sys.path.append('notebooks/part1_flopy')
+import threading
+import time
+import pytest
+from task_graph import TaskGraph
+
+
+def diamond(log, delays=None):
+    """grid -> (parent, inset) -> exchange, recording the order
+    in which the tasks start and finish."""
+    delays = delays or {}
+    lock = threading.Lock()
+
+    def task(name):
+        def func():
+            with lock:
+                log.append(('start', name))
+            time.sleep(delays.get(name, 0.))
+            with lock:
+                log.append(('end', name))
+        return func
+
+    graph = TaskGraph()
+    graph.add('grid', task('grid'))
+    graph.add('parent', task('parent'), ['grid'])
+    graph.add('inset', task('inset'), ['grid'])
+    graph.add('exchange', task('exchange'), ['parent', 'inset'])
+    return graph
+
+
+@pytest.mark.parametrize('max_workers', [1, 3])
+def test_dependency_order(max_workers):
+    log = []
+    graph = diamond(log, {'parent': 0.05, 'inset': 0.1})
+    graph.run(max_workers=max_workers)
+    events = {event: i for i, event in enumerate(log)}
+    for name, task in graph.tasks.items():
+        assert task.status == 'ok'
+        for dependency in task.dependencies:
+            assert events[('end', dependency)] < events[('start', name)]
+    if max_workers > 1:
+        # the independent tasks run at the same time
+        assert events[('start', 'inset')] < events[('end', 'parent')]
+    else:
+        assert [name for event, name in log if event == 'start'] == \
+            list(graph.tasks)
+
+
+def test_critical_path():
+    graph = diamond([], {'grid': 0.02, 'parent': 0.02, 'inset': 0.15})
+    graph.run(max_workers=2)
+    assert graph.critical_path() == ['grid', 'inset', 'exchange']
+    timings = {row['task']: row for row in graph.timings()}
+    assert not timings['parent']['critical']
+    assert timings['inset']['time'] >= 0.15
+    assert 'inset' in graph.format_timings()
+    assert TaskGraph().critical_path() == []
+
+
+@pytest.mark.parametrize('max_workers', [1, 2])
+def test_error_propagation(max_workers):
+    ran = []
+
+    def fail():
+        raise RuntimeError('setup failed')
+
+    graph = TaskGraph()
+    graph.add('grid', lambda: ran.append('grid'))
+    graph.add('parent', fail, ['grid'])
+    graph.add('exchange', lambda: ran.append('exchange'), ['parent'])
+    with pytest.raises(RuntimeError, match='setup failed'):
+        graph.run(max_workers=max_workers)
+    assert ran == ['grid']
+    assert graph.tasks['parent'].status == 'failed'
+    assert graph.tasks['exchange'].status is None
+    assert 'not run' in graph.format_timings()
+
+
+def test_add_and_rerun():
+    graph = TaskGraph()
+    calls = []
+    graph.add('grid', lambda: calls.append('grid') or 'cached')
+    with pytest.raises(ValueError):
+        graph.add('grid', lambda: None)
+    with pytest.raises(ValueError):
+        graph.add('dis', lambda: None, ['model'])
+    graph.run(max_workers=1)
+    assert graph.tasks['grid'].status == 'cached'
+    # only the tasks added since are run
+    graph.add('dis', lambda: calls.append('dis'), ['grid'])
+    graph.run(max_workers=1)
+    assert calls == ['grid', 'dis']
@@ -0,0 +1,80 @@
+import sys
+sys.path.append('notebooks/part0_python_intro/bonus_examples/solutions')
+import numpy as np
+import pytest
+from scipy import stats
+from scipy.special import exp1
+from theis_uncertainty import realizations, theis_quantiles
+
+quantiles = (0.05, 0.5, 0.95)
+min_drawdown = 1e-4
+
+
+def exact_quantiles(r, t, T, S, Q, n, batch_size):
+    """Quantiles of the drawdown at distances r, from all of the
+    realizations at once."""
+    batches = list(realizations(n, T, S, Q, batch_size=batch_size))
+    T, S, Q = [np.concatenate([b[name] for b in batches])[:, np.newaxis]
+               for name in ('T', 'S', 'Q')]
+    s = Q / (4 * np.pi * T) * exp1(r**2 * S / (4 * T * t))
+    s[s < min_drawdown] = 0
+    return np.quantile(s, quantiles, axis=0), s
+
+
+@pytest.mark.parametrize('batch_size', [8, 256])
+@pytest.mark.parametrize('spread', ['narrow', 'wide'])
+def test_theis_quantiles_accuracy(batch_size, spread):
+    if spread == 'narrow':
+        T = stats.lognorm(s=0.2, scale=1000)
+        S = stats.loguniform(2e-4, 4e-4)
+    else:
+        T = stats.lognorm(s=1.5, scale=1000)
+        S = stats.loguniform(1e-6, 1e-2)
+    Q = stats.norm(4088, 400)
+    x = np.linspace(1, 3000, 200)
+    n, bins = 2048, 128
+    result = theis_quantiles(x, 0, (0, 0), 10, T=T, S=S, Q=Q,
+                             n_realizations=n, batch_size=batch_size,
+                             bins=bins, tile_size=64, max_workers=1,
+                             min_drawdown=min_drawdown)[:, 0]
+    expected, s = exact_quantiles(x, 10, T, S, Q, n, batch_size)
+    assert result.shape == expected.shape
+    assert ((result == 0) == (expected == 0)).mean() > 0.99
+    # within the bin width at each point, which is at most twice
+    # the range of log drawdown (with a margin) divided into the bins
+    nonzero = (result > 0) & (expected > 0)
+    with np.errstate(divide='ignore'):
+        log_s = np.log(np.where(s > 0, s, np.nan))
+    log_range = np.nanmax(log_s, axis=0) - np.nanmin(log_s, axis=0)
+    tolerance = 2 * (1.2 * log_range + 2e-3) / bins
+    error = np.abs(np.log(result) - np.log(expected))
+    assert (error[nonzero] <= np.broadcast_to(tolerance, error.shape)[nonzero]
+            ).all()
+
+
+def test_theis_quantiles_parallel_matches_serial():
+    x, y = np.meshgrid(np.arange(0, 2000, 50.), np.arange(0, 2000, 50.))
+    T = stats.lognorm(s=0.5, scale=1000)
+    S = stats.loguniform(1e-4, 1e-3)
+    kwargs = dict(T=T, S=S, Q=4088, n_realizations=512, tile_size=128)
+    serial = theis_quantiles(x, y, (1000, 1000), [1, 10], max_workers=1,
+                             **kwargs)
+    parallel = theis_quantiles(x, y, (1000, 1000), [1, 10], max_workers=2,
+                               **kwargs)
+    assert serial.shape == (3, 2) + x.shape
+    np.testing.assert_array_equal(serial, parallel)
+    # infinite at the well, and symmetric around it
+    assert np.isinf(serial[:, :, 20, 20]).all()
+    np.testing.assert_array_equal(serial[:, :, 20, 21], serial[:, :, 21, 20])
+
+
+def test_realizations():
+    T = stats.lognorm(s=0.5, scale=1000)
+    batches = list(realizations(1000, T, 1e-4, 4088, batch_size=256))
+    assert [len(b['T']) for b in batches] == [256, 256, 256, 232]
+    assert all((b['S'] == 1e-4).all() for b in batches)
+    # the same seed gives the same realizations
+    again = list(realizations(1000, T, 1e-4, 4088, batch_size=256))
+    np.testing.assert_array_equal(batches[1]['T'], again[1]['T'])
+    with pytest.raises(ValueError):
+        next(realizations(10, T, 1e-4, 4088, batch_size=100))